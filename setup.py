@@ -11,6 +11,8 @@ requires = [
     'eth-utils',
     'eth-account',
     'eth-typing',
+    'hexbytes',
+    'requests',
     'web3',
 ]
 
@@ -0,0 +1,66 @@
+"""Compact representation for large numbers of addresses"""
+from typing import Iterable, Iterator, List, Union
+
+from eth_typing import Address, AnyAddress, ChecksumAddress
+from eth_utils import to_canonical_address
+
+from .web3_utils import to_address
+
+
+def to_address_bytes(address: Union[AnyAddress, bytes]) -> Address:
+    """Get the 20-byte form of address. Cheap compared to checksumming."""
+    if isinstance(address, bytes) and len(address) == 20:
+        # Also converts HexBytes (e.g. slices of log topics) to plain bytes
+        return Address(bytes(address))
+    return to_canonical_address(address)
+
+
+def to_hex_address(address: Union[AnyAddress, bytes]) -> str:
+    """Get the lowercase (non-checksummed) hex form of address, e.g. for raw JSON-RPC requests"""
+    return '0x' + to_address_bytes(address).hex()
+
+
+class AddressSet:
+    """
+    Set of addresses, stored as 20-byte keys.
+
+    Addresses can be added and looked up in any form. They are only checksummed when explicitly asked for
+    (see checksummed), since checksumming is orders of magnitude slower than anything else done with them.
+    """
+    def __init__(self, addresses: Iterable[Union[AnyAddress, bytes]] = ()):
+        self._keys = set()
+        self.update(addresses)
+
+    def __repr__(self):
+        return f'<AddressSet with {len(self)} addresses>'
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, address: Union[AnyAddress, bytes]) -> bool:
+        return to_address_bytes(address) in self._keys
+
+    def __iter__(self) -> Iterator[Address]:
+        return iter(self._keys)
+
+    def __ior__(self, other: Iterable[Union[AnyAddress, bytes]]) -> 'AddressSet':
+        self.update(other)
+        return self
+
+    def add(self, address: Union[AnyAddress, bytes]):
+        self._keys.add(to_address_bytes(address))
+
+    def update(self, addresses: Iterable[Union[AnyAddress, bytes]]):
+        if isinstance(addresses, AddressSet):
+            self._keys.update(addresses._keys)
+        else:
+            self._keys.update(to_address_bytes(a) for a in addresses)
+
+    def sorted(self) -> List[Address]:
+        """Get the addresses as a sorted list of 20-byte keys, so that they are always in the same order"""
+        return sorted(self._keys)
+
+    def checksummed(self) -> Iterator[ChecksumAddress]:
+        """Iterate the checksummed addresses in sorted order"""
+        for key in self.sorted():
+            yield to_address(key)
@@ -1,14 +1,25 @@
 import csv
+import os
+from collections import Counter, defaultdict
 from dataclasses import dataclass
-from typing import Iterable, List, Optional, Sequence
+from typing import Counter as CounterType, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 from eth_account.signers.local import LocalAccount
 from eth_typing import ChecksumAddress
 from eth_utils import to_hex
+from web3 import Web3
+from web3.contract import Contract, ContractFunction
+from web3.exceptions import MismatchedABI, TransactionNotFound
+from web3.types import TxReceipt
 
+from .addresses import to_address_bytes, to_hex_address
 from .config import Config
+from .journal import get_journal_file_path, read_journal
 from .tokens import Token
-from .web3_utils import retryable
+from .web3_utils import load_abi, retryable
+
+# (recipient, amount) of the Transfers that a sent transaction should emit, with counts
+TransferCounts = CounterType[Tuple[bytes, int]]
 
 
 class Airdrop:
@@ -31,6 +42,7 @@ class Airdrop:
         file_path: str,
         config: Config,
     ) -> 'Airdrop':
+        """Load the plan, with the transaction hashes from the send journal next to it (if any) applied"""
         airdrop = cls(config=config)
         with open(file_path, 'r') as f:
             reader = csv.DictReader(f)
@@ -40,14 +52,53 @@ class Airdrop:
                     reward_amount_wei=int(row['reward_amount_wei']),
                     transaction_nonce=int(row['transaction_nonce']),
                     transaction_hash=row['transaction_hash'] or None,
+                    # Older plans don't have the columns
+                    batch_number=int(row['batch_number']) if row.get('batch_number') else None,
+                    # Written checksummed
+                    rewarder_account_address=row.get('rewarder_account_address') or None,
                 )
+        airdrop.replay_journal(get_journal_file_path(file_path))
         return airdrop
 
+    def replay_journal(self, journal_file_path: str):
+        """Apply the transaction hashes recorded in the journal to the transactions with the same sender and nonce"""
+        transactions_by_nonce = defaultdict(list)
+        for transaction in self.transactions:
+            transactions_by_nonce[transaction.rewarder_account_address, transaction.transaction_nonce].append(
+                transaction
+            )
+        for record in read_journal(journal_file_path):
+            # All rows of a Disperse batch share the nonce
+            for transaction in transactions_by_nonce[record.rewarder_account_address, record.transaction_nonce]:
+                transaction.transaction_hash = record.transaction_hash
+
+    def save(self, file_path: str):
+        """
+        Write the whole plan to file_path and remove the send journal next to it, which the plan now includes.
+        """
+        self.to_file(file_path)
+        journal_file_path = get_journal_file_path(file_path)
+        # If we crash before removing it, replaying the journal again changes nothing
+        if os.path.exists(journal_file_path):
+            os.remove(journal_file_path)
+
     def to_file(self, file_path: str):
-        with open(file_path, 'w') as f:
+        """
+        Write the plan to file_path atomically: the file is either fully updated or left as is,
+        even if the process crashes while writing.
+        """
+        temp_file_path = file_path + '.tmp'
+        with open(temp_file_path, 'w') as f:
             writer = csv.DictWriter(
                 f,
-                fieldnames=['to_address', 'reward_amount_wei', 'transaction_nonce', 'transaction_hash']
+                fieldnames=[
+                    'to_address',
+                    'reward_amount_wei',
+                    'transaction_nonce',
+                    'transaction_hash',
+                    'batch_number',
+                    'rewarder_account_address',
+                ]
             )
             writer.writeheader()
             for transaction in self.transactions:
@@ -56,7 +107,12 @@ class Airdrop:
                     'reward_amount_wei': str(transaction.reward_amount_wei),
                     'transaction_nonce': str(transaction.transaction_nonce),
                     'transaction_hash': str(transaction.transaction_hash or ''),
+                    'batch_number': str(transaction.batch_number) if transaction.batch_number is not None else '',
+                    'rewarder_account_address': transaction.rewarder_account_address,
                 })
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file_path, file_path)
 
     def add_transaction(
         self,
@@ -65,13 +121,19 @@ class Airdrop:
         reward_amount_wei: int,
         transaction_nonce: int,
         transaction_hash: Optional[str] = None,
+        batch_number: Optional[int] = None,
+        rewarder_account_address: Optional[ChecksumAddress] = None,
     ):
+        if rewarder_account_address is None:
+            rewarder_account_address = self.config.rewarder_account_address
         transaction = AirdropTransaction(
             airdrop=self,
             to_address=to_address,
             reward_amount_wei=reward_amount_wei,
             transaction_nonce=transaction_nonce,
-            transaction_hash=transaction_hash
+            transaction_hash=transaction_hash,
+            batch_number=batch_number,
+            rewarder_account_address=rewarder_account_address,
         )
         self.transactions.append(transaction)
 
@@ -107,14 +169,119 @@ class Airdrop:
     def sent_transactions(self) -> Sequence['AirdropTransaction']:
         return [t for t in self.transactions if t.transaction_hash is not None]
 
+    def get_lanes(
+        self,
+        transactions: Iterable['AirdropTransaction'],
+    ) -> Dict[ChecksumAddress, List['AirdropTransaction']]:
+        """
+        Split transactions by the rewarder account that sends them. Every rewarder account has its own nonce
+        sequence, so the accounts (lanes) can send in parallel.
+        """
+        lanes = {address: [] for address in self.config.rewarder_account_addresses}
+        for transaction in transactions:
+            lanes.setdefault(transaction.rewarder_account_address, []).append(transaction)
+        return lanes
+
+    def get_disperse_contract(self) -> Contract:
+        if not self.config.disperse_address:
+            raise ValueError('disperseAddress is not set in the config')
+        return self.config.web3.eth.contract(
+            address=self.config.disperse_address,
+            abi=load_abi('Disperse'),
+        )
+
+    def group_into_units(self, transactions: Iterable['AirdropTransaction']) -> List['SendUnit']:
+        """
+        Group the rows of the plan into the units they are sent in: single transfers, and batches of rows with
+        the same batch number, in nonce order (per rewarder account)
+        """
+        units = []
+        batches = {}
+        for transaction in transactions:
+            if transaction.batch_number is None:
+                units.append(transaction)
+            elif transaction.batch_number in batches:
+                batches[transaction.batch_number].transactions.append(transaction)
+            else:
+                batch = AirdropBatch(airdrop=self, batch_number=transaction.batch_number, transactions=[transaction])
+                batches[transaction.batch_number] = batch
+                units.append(batch)
+        units.sort(key=lambda unit: unit.transaction_nonce)
+        return units
+
+    def assign_batches(self, *, batch_size: int, start_nonces: Dict[ChecksumAddress, int]) -> List['AirdropBatch']:
+        """
+        Group the unsent rows that aren't in a batch yet into batches of batch_size recipients, to be sent through
+        the Disperse contract. Batches don't span rewarder accounts, and the batches of every rewarder account get
+        consecutive nonces starting from the account's start nonce.
+        """
+        unbatched = [t for t in self.unsent_transactions if t.batch_number is None]
+        next_batch_number = max(
+            (t.batch_number for t in self.transactions if t.batch_number is not None),
+            default=0
+        ) + 1
+        batches = []
+        for rewarder_account_address, lane_transactions in self.get_lanes(unbatched).items():
+            for i in range(0, len(lane_transactions), batch_size):
+                batch = AirdropBatch(
+                    airdrop=self,
+                    batch_number=next_batch_number + len(batches),
+                    transactions=lane_transactions[i:i + batch_size],
+                )
+                for transaction in batch.transactions:
+                    transaction.batch_number = batch.batch_number
+                    transaction.transaction_nonce = start_nonces[rewarder_account_address] + i // batch_size
+                batches.append(batch)
+        return batches
+
+
+class SendUnitMixin:
+    """
+    Sending and verifying a transaction of the airdrop.
+    Subclasses have airdrop, rewarder_account_address, transaction_nonce and transaction_hash, and implement
+    get_contract_function and as_row.
+    """
+    def send(self):
+        if self.transaction_hash:
+            raise ValueError("Already sent")
+        tx_hash = self.get_contract_function().transact({
+            'from': self.rewarder_account_address,
+            # Always use the planned nonce, so that a transaction can never be sent twice
+            'nonce': self.transaction_nonce,
+        })
+        self.transaction_hash = to_hex(tx_hash)
+
+    def send_raw(self, raw_transaction: str, transaction_hash: str):
+        """Broadcast the pre-signed version of this transaction"""
+        if self.transaction_hash:
+            raise ValueError("Already sent")
+        tx_hash = to_hex(self.airdrop.config.web3.eth.send_raw_transaction(raw_transaction))
+        if tx_hash.lower() != transaction_hash.lower():
+            raise ValueError(f'Transaction hash {tx_hash} does not match the signed hash {transaction_hash}')
+        self.transaction_hash = tx_hash
+
+    def check_receipt(self, receipt: TxReceipt):
+        if not receipt.status:
+            raise ValueError(f'Transaction failed: {self.as_row()}')
+
+    @retryable()
+    def fetch_receipt(self) -> Optional[TxReceipt]:
+        """Get the receipt of the sent transaction without waiting, or None if it's not mined yet"""
+        try:
+            return self.airdrop.config.web3.eth.get_transaction_receipt(self.transaction_hash)
+        except TransactionNotFound:
+            return None
+
 
 @dataclass
-class AirdropTransaction:
+class AirdropTransaction(SendUnitMixin):
     airdrop: 'Airdrop'
     to_address: ChecksumAddress
     reward_amount_wei: int
     transaction_nonce: int
     transaction_hash: Optional[str]
+    batch_number: Optional[int] = None
+    rewarder_account_address: Optional[ChecksumAddress] = None
 
     def as_row(self):
         return airdrop_row_repr(
@@ -124,26 +291,116 @@ class AirdropTransaction:
             self.transaction_hash
         )
 
-    def send(self):
-        if self.transaction_hash:
-            raise ValueError("Already sent")
-        config = self.airdrop.config
-        reward_token_contract = config.reward_token.contract
-        tx_hash = reward_token_contract.functions.transfer(
+    def get_contract_function(self) -> ContractFunction:
+        return self.airdrop.reward_token.contract.functions.transfer(
             self.to_address,
             self.reward_amount_wei,
-        ).transact({'from': config.rewarder_account_address})
-        self.transaction_hash = to_hex(tx_hash)
+        )
+
+    def get_expected_transfers(self) -> TransferCounts:
+        return Counter({(to_address_bytes(self.to_address), self.reward_amount_wei): 1})
+
+
+@dataclass
+class AirdropBatch(SendUnitMixin):
+    """
+    Rows of the plan that are sent in a single transaction through the Disperse contract.
+    All rows of a batch share the nonce and the transaction hash.
+    """
+    airdrop: 'Airdrop'
+    batch_number: int
+    transactions: List[AirdropTransaction]
+
+    @property
+    def to_address(self) -> ChecksumAddress:
+        return self.airdrop.config.disperse_address
+
+    @property
+    def rewarder_account_address(self) -> ChecksumAddress:
+        return self.transactions[0].rewarder_account_address
+
+    @property
+    def reward_amount_wei(self) -> int:
+        return sum(t.reward_amount_wei for t in self.transactions)
 
-    def verify(self):
-        receipt = self._verify_with_retries()
+    @property
+    def transaction_nonce(self) -> int:
+        return self.transactions[0].transaction_nonce
+
+    @property
+    def transaction_hash(self) -> Optional[str]:
+        return self.transactions[0].transaction_hash
+
+    @transaction_hash.setter
+    def transaction_hash(self, transaction_hash: Optional[str]):
+        for transaction in self.transactions:
+            transaction.transaction_hash = transaction_hash
+
+    @property
+    def gas_limit(self) -> int:
+        return DISPERSE_BASE_GAS + DISPERSE_GAS_PER_RECIPIENT * len(self.transactions)
+
+    def as_row(self):
+        return airdrop_row_repr(
+            f'batch {self.batch_number} ({len(self.transactions)} recipients)',
+            self.airdrop.reward_token.str_amount(self.reward_amount_wei),
+            self.transaction_nonce,
+            self.transaction_hash
+        )
+
+    def get_contract_function(self) -> ContractFunction:
+        # disperseTokenSimple transfers straight from the rewarder account to every recipient, so the Transfer logs
+        # of a batch look the same as those of single transfers (disperseToken would send them from Disperse)
+        return self.airdrop.get_disperse_contract().functions.disperseTokenSimple(
+            self.airdrop.reward_token.address,
+            [t.to_address for t in self.transactions],
+            [t.reward_amount_wei for t in self.transactions],
+        )
+
+    def get_expected_transfers(self) -> TransferCounts:
+        return Counter(
+            (to_address_bytes(transaction.to_address), transaction.reward_amount_wei)
+            for transaction in self.transactions
+        )
+
+    def check_receipt(self, receipt: TxReceipt):
+        """Check that the batch transaction succeeded and that every recipient got its Transfer from the rewarder"""
         if not receipt.status:
             raise ValueError(f'Transaction failed: {self.as_row()}')
-        return receipt
+        transfer_event = self.airdrop.reward_token.contract.events.Transfer()
+        rewarder_account_address = to_address_bytes(self.rewarder_account_address)
+        transfers = Counter()
+        for log in receipt['logs']:
+            if log['address'].lower() != self.airdrop.reward_token.address.lower():
+                continue
+            try:
+                event = transfer_event.processLog(log)
+            except MismatchedABI:
+                continue
+            if to_address_bytes(event.args['from']) != rewarder_account_address:
+                continue
+            transfers[(to_address_bytes(event.args['to']), event.args['value'])] += 1
+        for (to_address, reward_amount_wei), count in self.get_expected_transfers().items():
+            if transfers[to_address, reward_amount_wei] < count:
+                raise ValueError(
+                    f'No Transfer found in batch {self.batch_number} for {to_hex_address(to_address)}: '
+                    f'{reward_amount_wei}'
+                )
 
-    @retryable()
-    def _verify_with_retries(self):
-        return self.airdrop.config.web3.eth.wait_for_transaction_receipt(self.transaction_hash, timeout=600)
+
+# Conservative estimates for the gas used by Disperse.disperseTokenSimple, which does one
+# transferFrom(rewarder account, recipient) per recipient
+DISPERSE_BASE_GAS = 50_000
+DISPERSE_GAS_PER_RECIPIENT = 60_000
+
+SendUnit = Union[AirdropTransaction, AirdropBatch]
+
+
+def get_disperse_batch_size(web3: Web3, *, block_gas_limit_fraction: float = 0.5) -> int:
+    """Get the largest batch size whose gas limit fits in the given fraction of the block gas limit"""
+    block_gas_limit = web3.eth.get_block('latest')['gasLimit']
+    usable_gas = int(block_gas_limit * block_gas_limit_fraction) - DISPERSE_BASE_GAS
+    return max(1, usable_gas // DISPERSE_GAS_PER_RECIPIENT)
 
 
 def airdrop_row_repr(to_address, reward_amount_wei, transaction_nonce, transaction_hash) -> str:
@@ -0,0 +1,119 @@
+"""Exact allocation of rewards proportionally to holder balances"""
+import bisect
+import itertools
+from dataclasses import dataclass
+from typing import Iterable, List, Sequence, Tuple
+
+
+@dataclass
+class SweepResult:
+    total_reward_wei: int
+    min_reward_wei: int
+    num_recipients: int
+    num_excluded: int
+    smallest_reward_wei: int  # 0 if there are no recipients
+    largest_reward_wei: int  # 0 if there are no recipients
+
+
+class RewardAllocator:
+    """
+    Allocates rewards between holders proportionally to their balances, with exact integer arithmetic.
+
+    Holders whose reward would be under the minimum reward are excluded and their share is redistributed to the
+    rest. Since excluding holders only increases the rewards of the others, the recipients are always the
+    largest holders: the largest k holders for which the smallest of them still gets the minimum reward
+    (total * b_k // (b_1 + ... + b_k) >= min). Holders with equal balances are either all included or all excluded.
+
+    The integer division leaves less than one wei per recipient undistributed. That dust is given to the recipients
+    with the largest remainders, one wei each, so that exactly the total reward is distributed.
+
+    The balances are sorted and summed once, after which allocating with any parameters (see sweep) only takes a
+    binary search, plus the division for every recipient when the rewards themselves are needed.
+    """
+    def __init__(self, balances: Sequence[int]):
+        if any(balance < 0 for balance in balances):
+            raise ValueError('Balances cannot be negative')
+        self.num_holders = len(balances)
+        # Largest balances first, ties in input order
+        self._order = sorted(range(len(balances)), key=lambda i: balances[i], reverse=True)
+        self._sorted_balances = [balances[i] for i in self._order]
+        # For bisecting, which needs ascending order
+        self._negated_sorted_balances = [-balance for balance in self._sorted_balances]
+        # _prefix_sums[k] is the sum of the k largest balances
+        self._prefix_sums = [0] + list(itertools.accumulate(self._sorted_balances))
+
+    def __repr__(self):
+        return f'<RewardAllocator for {self.num_holders} holders>'
+
+    def num_recipients(self, *, total_reward_wei: int, min_reward_wei: int) -> int:
+        """Get the number of holders that get a reward, i.e. the k largest holders that are included"""
+        # Nobody gets a zero reward
+        min_reward_wei = max(min_reward_wei, 1)
+        balances = self._sorted_balances
+        prefix_sums = self._prefix_sums
+
+        def is_included(k: int) -> bool:
+            # Is the smallest of the k largest holders included if the reward is split between the k largest?
+            return balances[k - 1] > 0 and total_reward_wei * balances[k - 1] >= min_reward_wei * prefix_sums[k]
+
+        # is_included is monotonic, as the k-th balance only gets smaller and the sum only gets larger with k
+        lo, hi = 0, self.num_holders
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if is_included(mid):
+                lo = mid
+            else:
+                hi = mid - 1
+        k = lo
+        if 0 < k < self.num_holders and balances[k] == balances[k - 1]:
+            # The next holder has the same balance, but doesn't fit. Exclude all holders with that balance.
+            k = bisect.bisect_left(self._negated_sorted_balances, -balances[k - 1])
+        return k
+
+    def allocate(self, *, total_reward_wei: int, min_reward_wei: int) -> List[int]:
+        """
+        Get the reward of every holder, in the order of the balances given to the constructor.
+        Excluded holders get 0. The rewards add up to total_reward_wei, unless all holders are excluded.
+        """
+        rewards = [0] * self.num_holders
+        k = self.num_recipients(total_reward_wei=total_reward_wei, min_reward_wei=min_reward_wei)
+        if k == 0:
+            return rewards
+        total_balance = self._prefix_sums[k]
+        products = [total_reward_wei * balance for balance in itertools.islice(self._sorted_balances, k)]
+        sorted_rewards = [product // total_balance for product in products]
+        remainders = [product % total_balance for product in products]
+        for position, reward in enumerate(sorted_rewards):
+            rewards[self._order[position]] = reward
+
+        # Largest remainders first, ties to the larger holders (sorted is stable, even when reversed)
+        dust = total_reward_wei - sum(sorted_rewards)
+        if dust:
+            positions_by_remainder = sorted(range(k), key=remainders.__getitem__, reverse=True)
+            for position in positions_by_remainder[:dust]:
+                rewards[self._order[position]] += 1
+        return rewards
+
+    def sweep(self, parameters: Iterable[Tuple[int, int]]) -> List[SweepResult]:
+        """
+        Evaluate (total_reward_wei, min_reward_wei) combinations without allocating the rewards of every holder.
+
+        The smallest and largest rewards are computed before assigning the dust, which adds at most one wei to them.
+        """
+        ret = []
+        for total_reward_wei, min_reward_wei in parameters:
+            k = self.num_recipients(total_reward_wei=total_reward_wei, min_reward_wei=min_reward_wei)
+            smallest_reward_wei = largest_reward_wei = 0
+            if k > 0:
+                total_balance = self._prefix_sums[k]
+                smallest_reward_wei = total_reward_wei * self._sorted_balances[k - 1] // total_balance
+                largest_reward_wei = total_reward_wei * self._sorted_balances[0] // total_balance
+            ret.append(SweepResult(
+                total_reward_wei=total_reward_wei,
+                min_reward_wei=min_reward_wei,
+                num_recipients=k,
+                num_excluded=self.num_holders - k,
+                smallest_reward_wei=smallest_reward_wei,
+                largest_reward_wei=largest_reward_wei,
+            ))
+        return ret
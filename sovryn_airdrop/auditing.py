@@ -0,0 +1,165 @@
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Set
+
+import click
+from web3 import Web3
+
+from .addresses import to_hex_address
+from .airdrop import Airdrop
+from .cli_base import cli, config_file_option, echo, hilight
+from .config import Config
+from .reconciliation import AuditResult, TransferRecord, normalize_hash, reconcile
+from .web3_utils import address_to_topic, iter_event_log_batches, log_provider_stats, make_batch_request
+
+
+@cli.command()
+@config_file_option
+@click.option('-p', '--plan-file', required=True, metavar='PATH', help='Path to read the plan file from')
+@click.option(
+    '--from-block',
+    type=click.IntRange(min=0),
+    required=True,
+    metavar='BLOCK',
+    help='First block of the range the airdrop was sent in'
+)
+@click.option(
+    '--to-block',
+    type=click.IntRange(min=0),
+    default=None,
+    metavar='BLOCK',
+    help='Last block of the range the airdrop was sent in (the latest block if not given)'
+)
+@click.option(
+    '--concurrency',
+    type=click.IntRange(min=1),
+    default=1,
+    metavar='N',
+    help='Fetch the events of the block range with N concurrent workers'
+)
+@click.option(
+    '--rpc-batch-size',
+    type=click.IntRange(min=1),
+    default=100,
+    metavar='N',
+    help='Fetch the nonces of N transactions per JSON-RPC batch request'
+)
+def audit(
+    config_file: str,
+    plan_file: str,
+    from_block: int,
+    to_block: Optional[int],
+    concurrency: int,
+    rpc_batch_size: int,
+):
+    """
+    Check a sent airdrop against the chain.
+
+    All Transfers of the reward token from the rewarder accounts in the block range are fetched with eth_getLogs
+    and reconciled with the rows of the plan file (recipient, amount, transaction hash and nonce).
+    """
+    config = Config.from_file(config_file, max_connections=concurrency)
+    airdrop = Airdrop.from_file(file_path=plan_file, config=config)
+    web3 = config.web3
+    if to_block is None:
+        to_block = web3.eth.block_number
+    rewarder_account_addresses = list(airdrop.get_lanes(airdrop.transactions))
+    echo(
+        'Auditing',
+        hilight(len(airdrop.transactions)),
+        'plan rows against the Transfers of',
+        hilight(config.reward_token.symbol),
+        'from',
+        hilight(', '.join(rewarder_account_addresses)),
+        'in blocks',
+        hilight(from_block),
+        '...',
+        hilight(to_block),
+    )
+
+    transfers = fetch_transfers(
+        web3=web3,
+        airdrop=airdrop,
+        rewarder_account_addresses=rewarder_account_addresses,
+        from_block=from_block,
+        to_block=to_block,
+        concurrency=concurrency,
+    )
+    echo('Found', hilight(len(transfers)), 'Transfers')
+    log_provider_stats(web3, 'the Transfer event scan')
+    transaction_nonces = fetch_transaction_nonces(
+        web3=web3,
+        transaction_hashes=set(transfer.transaction_hash for transfer in transfers),
+        batch_size=rpc_batch_size,
+    )
+    result = reconcile(
+        transactions=airdrop.transactions,
+        transfers=transfers,
+        transaction_nonces=transaction_nonces,
+    )
+    echo_audit_result(airdrop, result)
+    if result.issues:
+        raise click.ClickException(f'The audit found {len(result.issues)} issues')
+    echo('All plan rows match the Transfers on the chain.')
+
+
+def fetch_transfers(
+    *,
+    web3: Web3,
+    airdrop: Airdrop,
+    rewarder_account_addresses: Sequence[str],
+    from_block: int,
+    to_block: int,
+    concurrency: int,
+) -> List[TransferRecord]:
+    """Fetch the reward token Transfers sent by the rewarder accounts, in a single sweep over the block range"""
+    transfers = []
+    with click.progressbar(length=to_block - from_block + 1, label='Fetching Transfer events') as bar:
+        for batch in iter_event_log_batches(
+            event=airdrop.reward_token.contract.events.Transfer,
+            from_block=from_block,
+            to_block=to_block,
+            batch_size=1000,
+            adaptive=True,
+            concurrency=concurrency,
+            # Transfer(address indexed from, address indexed to, uint256 value)
+            argument_topics=[[address_to_topic(address) for address in rewarder_account_addresses]],
+        ):
+            transfers.extend(TransferRecord.from_log(log) for log in batch.logs)
+            bar.update(batch.to_block - batch.from_block + 1)
+    return transfers
+
+
+def fetch_transaction_nonces(*, web3: Web3, transaction_hashes: Set[str], batch_size: int) -> Dict[str, int]:
+    """Fetch the nonces of transactions with JSON-RPC batch requests, returning {transaction hash: nonce}"""
+    nonces = {}
+    hashes = sorted(transaction_hashes)
+    for i in range(0, len(hashes), batch_size):
+        chunk = hashes[i:i + batch_size]
+        transactions = make_batch_request(web3, [
+            ('eth_getTransactionByHash', [transaction_hash])
+            for transaction_hash in chunk
+        ])
+        for transaction_hash, transaction in zip(chunk, transactions):
+            # Failed lookups just leave the nonce unchecked
+            if isinstance(transaction, dict) and transaction.get('nonce') is not None:
+                nonces[normalize_hash(transaction_hash)] = int(transaction['nonce'], 16)
+    return nonces
+
+
+def echo_audit_result(airdrop: Airdrop, result: AuditResult):
+    reward_token = airdrop.reward_token
+    echo('\nPlan rows:', hilight(result.num_rows))
+    echo('Transfers found:', hilight(result.num_transfers))
+    echo('Plan rows matched with a Transfer:', hilight(result.num_matched))
+    echo('Summary of issues:', Counter(issue.kind for issue in result.issues))
+    for issue in result.issues:
+        if issue.transaction is not None:
+            subject = issue.transaction.as_row()
+        else:
+            subject = (
+                f'{to_hex_address(issue.transfer.to_address)} '
+                f'{reward_token.str_amount(issue.transfer.amount_wei)} in {issue.transfer.transaction_hash}'
+            )
+        echo(issue.kind.ljust(24), subject)
+        echo(' ' * 24, issue.message)
+
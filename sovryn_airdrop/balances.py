@@ -0,0 +1,445 @@
+"""Fetching snapshot balances of possible token holders"""
+import itertools
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Iterator, List, Optional, Sequence, Tuple
+
+from eth_typing import AnyAddress
+from web3 import Web3
+from web3.contract import Contract, ContractFunction
+from web3.exceptions import BadFunctionCallOutput
+from web3.types import BlockIdentifier
+
+from .addresses import AddressSet, to_address_bytes, to_hex_address
+from .cache import ContractClassificationCache
+from .tokens import Token
+from .web3_utils import (
+    JSONRPCError,
+    decode_contract_call_result,
+    encode_contract_call,
+    is_call_too_large_error,
+    is_contract,
+    is_contract_code,
+    is_retryable_error,
+    make_batch_request,
+    retryable,
+)
+
+if TYPE_CHECKING:
+    from .ledger import StakedBalanceIndex
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class AddressBalances:
+    """Snapshot balances of a single address. Balances are not fetched for contracts."""
+    address: AnyAddress  # in the form it was given to the fetcher
+    is_contract: bool
+    holding_token_balance_on_account_wei: int = 0
+    lp_token_balance_on_account_wei: int = 0
+    lp_token_balance_on_liquidity_mining_wei: int = 0
+
+
+def balance_of_call(*, token: Token, address) -> ContractFunction:
+    return token.contract.functions.balanceOf(address)
+
+
+def liquidity_mining_user_info_call(*, liquidity_mining: Contract, pool_token: Token, address) -> ContractFunction:
+    return liquidity_mining.functions.getUserInfo(
+        pool_token.contract.address,
+        address
+    )
+
+
+@retryable()
+def fetch_balance_in_block(*, token: Token, address, block_number: int) -> int:
+    return balance_of_call(token=token, address=address).call(
+        block_identifier=block_number
+    )
+
+
+@retryable()
+def fetch_balance_on_liquidity_mining_in_block(
+    *,
+    pool_token: Token,
+    address,
+    block_number: int,
+    liquidity_mining: Optional[Contract]
+) -> int:
+    if liquidity_mining is None:
+        return 0
+    amount, debt, accumulated = liquidity_mining_user_info_call(
+        liquidity_mining=liquidity_mining,
+        pool_token=pool_token,
+        address=address,
+    ).call(block_identifier=block_number)
+    return amount
+
+
+@dataclass
+class BalanceFetcher:
+    """
+    Fetches the snapshot balances of addresses one call at a time
+    """
+    web3: Web3
+    holding_token: Token
+    lp_token: Token
+    liquidity_mining: Optional[Contract]
+    block_number: int
+    chunk_size: int = 1
+    contract_cache: Optional[ContractClassificationCache] = None
+    known_eoas: Optional[AddressSet] = None  # addresses known not to be contracts, e.g. transaction senders
+    staked_balances: Optional['StakedBalanceIndex'] = None  # used instead of calling LiquidityMining.getUserInfo
+    _chain_id: Optional[int] = field(default=None, init=False, repr=False)
+
+    def fetch(self, addresses: Sequence[AnyAddress]) -> List[AddressBalances]:
+        contract_flags = self.get_contract_flags(addresses)
+        non_contract_addresses = [
+            address for (address, flag) in zip(addresses, contract_flags)
+            if not flag
+        ]
+        account_balances = iter(self.fetch_account_balances(non_contract_addresses))
+        return [
+            AddressBalances(address=address, is_contract=True) if flag else next(account_balances)
+            for (address, flag) in zip(addresses, contract_flags)
+        ]
+
+    def fetch_one(self, address: AnyAddress) -> AddressBalances:
+        if is_contract(web3=self.web3, address=address, block_identifier=self.block_number):
+            return AddressBalances(address=address, is_contract=True)
+        return self.fetch_account_balances_one(address)
+
+    def get_contract_flags(self, addresses: Sequence[AnyAddress]) -> List[bool]:
+        """
+        Check which addresses are contracts in the snapshot block, using the known EOAs and the contract cache if
+        available. Only the addresses whose classification at the snapshot block isn't known are checked.
+        """
+        if self.contract_cache is None and self.known_eoas is None:
+            return self.fetch_contract_flags(addresses)
+
+        keys = [to_address_bytes(address) for address in addresses]
+        known = {}
+        if self.known_eoas is not None:
+            known.update((key, False) for key in keys if key in self.known_eoas)
+        if self.contract_cache is not None:
+            known.update(self.contract_cache.get_known(
+                chain_id=self._get_chain_id(),
+                addresses=[key for key in keys if key not in known],
+                block_number=self.block_number,
+            ))
+
+        unknown = [(key, address) for (key, address) in zip(keys, addresses) if key not in known]
+        if unknown:
+            fetched = dict(zip(
+                [key for (key, _) in unknown],
+                self.fetch_contract_flags([address for (_, address) in unknown])
+            ))
+            if self.contract_cache is not None:
+                self.contract_cache.store(
+                    chain_id=self._get_chain_id(),
+                    classifications=fetched,
+                    block_number=self.block_number,
+                )
+            known.update(fetched)
+        return [known[key] for key in keys]
+
+    def fetch_contract_flags(self, addresses: Sequence[AnyAddress]) -> List[bool]:
+        return [
+            is_contract(web3=self.web3, address=address, block_identifier=self.block_number)
+            for address in addresses
+        ]
+
+    def _get_chain_id(self) -> int:
+        if self._chain_id is None:
+            self._chain_id = self.web3.eth.chain_id
+        return self._chain_id
+
+    def fetch_account_balances(self, addresses: Sequence[AnyAddress]) -> List[AddressBalances]:
+        return [self.fetch_account_balances_one(address) for address in addresses]
+
+    def fetch_account_balances_one(self, address: AnyAddress) -> AddressBalances:
+        return AddressBalances(
+            address=address,
+            is_contract=False,
+            holding_token_balance_on_account_wei=fetch_balance_in_block(
+                token=self.holding_token,
+                address=address,
+                block_number=self.block_number,
+            ),
+            lp_token_balance_on_account_wei=fetch_balance_in_block(
+                token=self.lp_token,
+                address=address,
+                block_number=self.block_number,
+            ),
+            lp_token_balance_on_liquidity_mining_wei=self.fetch_staked_balance(address),
+        )
+
+    def fetch_staked_balance(self, address: AnyAddress) -> int:
+        if self.staked_balances is not None:
+            return self.staked_balances.balance_of(address)
+        return fetch_balance_on_liquidity_mining_in_block(
+            pool_token=self.lp_token,
+            address=address,
+            block_number=self.block_number,
+            liquidity_mining=self.liquidity_mining,
+        )
+
+    def iter_balances(
+        self,
+        addresses: Sequence[AnyAddress],
+        *,
+        concurrency: int = 1,
+    ) -> Iterator[List[AddressBalances]]:
+        """
+        Fetch balances chunk by chunk, yielding the results of each chunk in the same order as addresses.
+
+        With concurrency > 1, up to that many chunks are fetched at the same time in worker threads. The results are
+        still yielded in order.
+        """
+        chunks = [
+            addresses[i:i + self.chunk_size]
+            for i in range(0, len(addresses), self.chunk_size)
+        ]
+        if concurrency <= 1:
+            for chunk in chunks:
+                yield self.fetch(chunk)
+            return
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='balances') as executor:
+            # Keep a bounded number of chunks in flight so that the results don't pile up in memory
+            pending = deque()
+            chunk_iter = iter(chunks)
+            for chunk in itertools.islice(chunk_iter, concurrency * 2):
+                pending.append(executor.submit(self.fetch, chunk))
+            while pending:
+                result = pending.popleft().result()
+                for chunk in itertools.islice(chunk_iter, 1):
+                    pending.append(executor.submit(self.fetch, chunk))
+                yield result
+
+    def get_balance_calls(self, address: AnyAddress) -> List[ContractFunction]:
+        """Get the contract calls needed for the balances of address, in the order of AddressBalances fields"""
+        functions = [
+            balance_of_call(token=self.holding_token, address=address),
+            balance_of_call(token=self.lp_token, address=address),
+        ]
+        if self.liquidity_mining is not None and self.staked_balances is None:
+            functions.append(liquidity_mining_user_info_call(
+                liquidity_mining=self.liquidity_mining,
+                pool_token=self.lp_token,
+                address=address,
+            ))
+        return functions
+
+    def to_account_balances(self, address: AnyAddress, values: Sequence[Any]) -> AddressBalances:
+        """Build AddressBalances from the decoded results of get_balance_calls"""
+        if len(values) > 2:
+            # getUserInfo returns (amount, rewardDebt, accumulatedReward)
+            staked_balance = values[2][0]
+        elif self.staked_balances is not None:
+            staked_balance = self.staked_balances.balance_of(address)
+        else:
+            staked_balance = 0
+        return AddressBalances(
+            address=address,
+            is_contract=False,
+            holding_token_balance_on_account_wei=values[0],
+            lp_token_balance_on_account_wei=values[1],
+            lp_token_balance_on_liquidity_mining_wei=staked_balance,
+        )
+
+
+@dataclass
+class BatchBalanceFetcher(BalanceFetcher):
+    """
+    Fetches the snapshot balances of chunk_size addresses at a time using JSON-RPC batch requests.
+
+    The code of all addresses is fetched in one batch and the balances of the non-contract addresses in another.
+    If any call for an address fails or returns data that can't be decoded, the data of that address is re-fetched
+    with the (retryable) single-call functions, so partial failures don't fail the whole batch.
+    """
+    chunk_size: int = 100
+
+    def fetch_contract_flags(self, addresses: Sequence[AnyAddress]) -> List[bool]:
+        return batch_fetch_contract_flags(web3=self.web3, addresses=addresses, block_identifier=self.block_number)
+
+    def fetch_account_balances(self, addresses: Sequence[AnyAddress]) -> List[AddressBalances]:
+        calls_by_address = [(address, self.get_balance_calls(address)) for address in addresses]
+        results = iter(make_batch_request(self.web3, [
+            ('eth_call', [encode_contract_call(function), hex(self.block_number)])
+            for _, functions in calls_by_address
+            for function in functions
+        ]))
+        ret = []
+        for address, functions in calls_by_address:
+            address_results = [next(results) for _ in functions]
+            errors = [r for r in address_results if isinstance(r, JSONRPCError)]
+            if errors:
+                logger.warning('batched eth_call failed for %s: %s, fetching separately', address, errors[0])
+                ret.append(self.fetch_account_balances_one(address))
+                continue
+            try:
+                values = [
+                    decode_contract_call_result(function, result)
+                    for (function, result) in zip(functions, address_results)
+                ]
+            except BadFunctionCallOutput as e:
+                logger.warning('batched eth_call result for %s is invalid: %s, fetching separately', address, e)
+                ret.append(self.fetch_account_balances_one(address))
+                continue
+            ret.append(self.to_account_balances(address, values))
+        return ret
+
+
+# Aggregated calls that must succeed in a row before a shrunk aggregate size is doubled again
+AGGREGATE_SIZE_RECOVERY_SUCCESSES = 10
+
+
+@dataclass
+class MulticallBalanceFetcher(BalanceFetcher):
+    """
+    Fetches the snapshot balances of chunk_size addresses at a time by aggregating the eth_calls
+    through a Multicall2-compatible contract (tryAggregate) deployed on the chain.
+
+    If an aggregated call runs out of gas or its response is too large, the chunk is split in half and the halves are
+    retried, and the smaller size is used for the following aggregated calls. The size is doubled back towards
+    chunk_size after AGGREGATE_SIZE_RECOVERY_SUCCESSES successful calls in a row. Other retryable errors are retried
+    without splitting. Sub-calls that fail inside the aggregate or return data that can't be decoded are re-fetched
+    separately with the retryable single-call functions.
+    """
+    multicall: Optional[Contract] = None
+    chunk_size: int = 200
+    batch_contract_checks: bool = False
+    _aggregate_size: Optional[int] = field(default=None, init=False, repr=False)  # None means chunk_size
+    _num_aggregate_successes: int = field(default=0, init=False, repr=False)
+    # Guards the two fields above, which the worker threads of iter_balances share
+    _aggregate_size_lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def fetch_contract_flags(self, addresses: Sequence[AnyAddress]) -> List[bool]:
+        # Contract code can't be read with the aggregator
+        if self.batch_contract_checks:
+            return batch_fetch_contract_flags(web3=self.web3, addresses=addresses, block_identifier=self.block_number)
+        return super().fetch_contract_flags(addresses)
+
+    @property
+    def aggregate_size(self) -> int:
+        """How many addresses are aggregated in a single call"""
+        with self._aggregate_size_lock:
+            return self._get_aggregate_size()
+
+    def _get_aggregate_size(self) -> int:
+        if self._aggregate_size is None:
+            return self.chunk_size
+        return self._aggregate_size
+
+    def fetch_account_balances(self, addresses: Sequence[AnyAddress]) -> List[AddressBalances]:
+        ret = []
+        i = 0
+        while i < len(addresses):
+            chunk = addresses[i:i + self.aggregate_size]
+            ret.extend(self._fetch_account_balances_aggregated(chunk))
+            i += len(chunk)
+        return ret
+
+    def _fetch_account_balances_aggregated(self, addresses: Sequence[AnyAddress]) -> List[AddressBalances]:
+        calls_by_address = [(address, self.get_balance_calls(address)) for address in addresses]
+        aggregated_functions = [
+            function
+            for _, functions in calls_by_address
+            for function in functions
+        ]
+        try:
+            results = self._try_aggregate(aggregated_functions)
+        except Exception as e:
+            if not is_retryable_error(e):
+                raise
+            if not is_call_too_large_error(e):
+                results = retryable()(self._try_aggregate)(aggregated_functions)
+            elif len(addresses) == 1:
+                logger.warning('aggregated call failed for %s: %s, fetching separately', addresses[0], e)
+                return [self.fetch_account_balances_one(addresses[0])]
+            else:
+                half = (len(addresses) + 1) // 2
+                logger.warning(
+                    'aggregated call for %s addresses too large: %s, splitting to chunks of %s',
+                    len(addresses),
+                    e,
+                    half,
+                )
+                with self._aggregate_size_lock:
+                    self._aggregate_size = min(self._get_aggregate_size(), half)
+                    self._num_aggregate_successes = 0
+                return (
+                    self._fetch_account_balances_aggregated(addresses[:half]) +
+                    self._fetch_account_balances_aggregated(addresses[half:])
+                )
+        self._on_aggregate_success()
+
+        results = iter(results)
+        ret = []
+        for address, functions in calls_by_address:
+            address_results = [next(results) for _ in functions]
+            if not all(success for (success, _) in address_results):
+                logger.warning('aggregated sub-call failed for %s, fetching separately', address)
+                ret.append(self.fetch_account_balances_one(address))
+                continue
+            try:
+                values = [
+                    decode_contract_call_result(function, return_data)
+                    for (function, (_, return_data)) in zip(functions, address_results)
+                ]
+            except BadFunctionCallOutput as e:
+                logger.warning('aggregated sub-call result for %s is invalid: %s, fetching separately', address, e)
+                ret.append(self.fetch_account_balances_one(address))
+                continue
+            ret.append(self.to_account_balances(address, values))
+        return ret
+
+    def _on_aggregate_success(self):
+        with self._aggregate_size_lock:
+            if self._aggregate_size is None:
+                return
+            self._num_aggregate_successes += 1
+            if self._num_aggregate_successes < AGGREGATE_SIZE_RECOVERY_SUCCESSES:
+                return
+            self._num_aggregate_successes = 0
+            self._aggregate_size = min(self._aggregate_size * 2, self.chunk_size)
+            aggregate_size = self._aggregate_size
+            if self._aggregate_size >= self.chunk_size:
+                self._aggregate_size = None
+        logger.info('increasing aggregate size to %s', aggregate_size)
+
+    def _try_aggregate(self, functions: Sequence[ContractFunction]) -> List[Tuple[bool, bytes]]:
+        calls = [
+            (function.address, function._encode_transaction_data())
+            for function in functions
+        ]
+        return self.multicall.functions.tryAggregate(False, calls).call(
+            block_identifier=self.block_number
+        )
+
+
+def batch_fetch_contract_flags(
+    *,
+    web3: Web3,
+    addresses: Sequence[AnyAddress],
+    block_identifier: BlockIdentifier = 'latest',
+) -> List[bool]:
+    """Check which addresses are contracts in the given block with a single JSON-RPC batch request"""
+    block_param = hex(block_identifier) if isinstance(block_identifier, int) else block_identifier
+    codes = make_batch_request(web3, [
+        ('eth_getCode', [to_hex_address(address), block_param])
+        for address in addresses
+    ])
+    ret = []
+    for address, code in zip(addresses, codes):
+        if isinstance(code, JSONRPCError):
+            logger.warning('batched eth_getCode failed for %s: %s, fetching separately', address, code)
+            ret.append(is_contract(web3=web3, address=address, block_identifier=block_identifier))
+        else:
+            ret.append(is_contract_code(code))
+    return ret
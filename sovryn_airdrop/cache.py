@@ -0,0 +1,277 @@
+"""Persistent on-disk caches for data fetched from the chain"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.datastructures import AttributeDict
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteCache:
+    """Base class for caches stored in a SQLite database. Safe to use from multiple threads."""
+    schema: str = ''
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(self.schema)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} at {self.path!r}>'
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class EventLogCache(SQLiteCache):
+    """
+    Stores raw event logs by chain id, contract address and event topic, and keeps track of the block ranges
+    that have been fetched, so that only the missing ranges need to be requested from the node.
+
+    Only finalized blocks should be stored, as the cached logs are never invalidated.
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS event_logs (
+            chain_id INTEGER NOT NULL,
+            address TEXT NOT NULL,
+            topic TEXT NOT NULL,
+            block_number INTEGER NOT NULL,
+            log_index INTEGER NOT NULL,
+            log TEXT NOT NULL,
+            PRIMARY KEY (chain_id, address, topic, block_number, log_index)
+        );
+        CREATE TABLE IF NOT EXISTS event_log_ranges (
+            chain_id INTEGER NOT NULL,
+            address TEXT NOT NULL,
+            topic TEXT NOT NULL,
+            from_block INTEGER NOT NULL,
+            to_block INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS event_log_ranges_key ON event_log_ranges (chain_id, address, topic);
+    '''
+
+    def get_cached_ranges(self, *, chain_id: int, address: str, topic: str) -> List[Tuple[int, int]]:
+        """Get the (inclusive) block ranges that are stored in the cache, sorted and merged"""
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT from_block, to_block FROM event_log_ranges '
+                'WHERE chain_id = ? AND address = ? AND topic = ? ORDER BY from_block',
+                (chain_id, address.lower(), topic.lower())
+            ).fetchall()
+        return merge_block_ranges(rows)
+
+    def split_range(
+        self,
+        *,
+        chain_id: int,
+        address: str,
+        topic: str,
+        from_block: int,
+        to_block: int
+    ) -> List[Tuple[int, int, bool]]:
+        """
+        Split the block range from_block...to_block into consecutive (from_block, to_block, is_cached) segments
+        """
+        ret = []
+        current = from_block
+        for cached_from, cached_to in self.get_cached_ranges(chain_id=chain_id, address=address, topic=topic):
+            if cached_to < current:
+                continue
+            if cached_from > to_block:
+                break
+            if cached_from > current:
+                ret.append((current, cached_from - 1, False))
+            ret.append((max(cached_from, current), min(cached_to, to_block), True))
+            current = cached_to + 1
+        if current <= to_block:
+            ret.append((current, to_block, False))
+        return ret
+
+    def get_logs(
+        self,
+        *,
+        chain_id: int,
+        address: str,
+        topic: str,
+        from_block: int,
+        to_block: int
+    ) -> List[AttributeDict]:
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT log FROM event_logs '
+                'WHERE chain_id = ? AND address = ? AND topic = ? AND block_number BETWEEN ? AND ? '
+                'ORDER BY block_number, log_index',
+                (chain_id, address.lower(), topic.lower(), from_block, to_block)
+            ).fetchall()
+        return [deserialize_log(log) for (log,) in rows]
+
+    def store_logs(
+        self,
+        *,
+        chain_id: int,
+        address: str,
+        topic: str,
+        from_block: int,
+        to_block: int,
+        logs: Iterable[Dict[str, Any]]
+    ):
+        """Store all logs of the (inclusive) block range from_block...to_block and mark the range as cached"""
+        address = address.lower()
+        topic = topic.lower()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO event_logs (chain_id, address, topic, block_number, log_index, log) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [
+                    (chain_id, address, topic, log['blockNumber'], log['logIndex'], serialize_log(log))
+                    for log in logs
+                ]
+            )
+            ranges = self._connection.execute(
+                'SELECT from_block, to_block FROM event_log_ranges WHERE chain_id = ? AND address = ? AND topic = ?',
+                (chain_id, address, topic)
+            ).fetchall()
+            self._connection.execute(
+                'DELETE FROM event_log_ranges WHERE chain_id = ? AND address = ? AND topic = ?',
+                (chain_id, address, topic)
+            )
+            self._connection.executemany(
+                'INSERT INTO event_log_ranges (chain_id, address, topic, from_block, to_block) VALUES (?, ?, ?, ?, ?)',
+                [
+                    (chain_id, address, topic, range_from, range_to)
+                    for (range_from, range_to) in merge_block_ranges(ranges + [(from_block, to_block)])
+                ]
+            )
+
+
+def merge_block_ranges(ranges: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Merge overlapping and adjacent inclusive block ranges"""
+    ret = []
+    for from_block, to_block in sorted(ranges):
+        if ret and from_block <= ret[-1][1] + 1:
+            ret[-1] = (ret[-1][0], max(ret[-1][1], to_block))
+        else:
+            ret.append((from_block, to_block))
+    return ret
+
+
+def serialize_log(log: Dict[str, Any]) -> str:
+    return Web3.toJSON(log)
+
+
+def deserialize_log(raw: str) -> AttributeDict:
+    log = json.loads(raw)
+    for key in ('blockHash', 'transactionHash'):
+        if log.get(key) is not None:
+            log[key] = HexBytes(log[key])
+    log['topics'] = [HexBytes(topic) for topic in log['topics']]
+    return AttributeDict(log)
+
+
+class ContractClassificationCache(SQLiteCache):
+    """
+    Remembers which addresses are contracts and which are not (EOAs), by chain id.
+
+    For contracts, the earliest block at which the address was seen to have code is stored, and for EOAs the latest
+    block at which it was seen to have no code. Contracts are assumed to stay contracts, so an address is known to be
+    a contract at block N if it had code at or before N, and known to be an EOA at block N if it had no code at or
+    after N.
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS contract_classifications (
+            chain_id INTEGER NOT NULL,
+            address BLOB NOT NULL,
+            contract_since_block INTEGER,
+            eoa_until_block INTEGER,
+            PRIMARY KEY (chain_id, address)
+        );
+    '''
+
+    def get_known(self, *, chain_id: int, addresses: Iterable[bytes], block_number: int) -> Dict[bytes, bool]:
+        """
+        Get {address: is_contract} for the given 20-byte addresses whose classification at block_number is known
+        """
+        ret = {}
+        with self._lock:
+            for address in addresses:
+                row = self._connection.execute(
+                    'SELECT contract_since_block, eoa_until_block FROM contract_classifications '
+                    'WHERE chain_id = ? AND address = ?',
+                    (chain_id, address)
+                ).fetchone()
+                if row is None:
+                    continue
+                contract_since_block, eoa_until_block = row
+                if contract_since_block is not None and contract_since_block <= block_number:
+                    ret[address] = True
+                elif eoa_until_block is not None and eoa_until_block >= block_number:
+                    ret[address] = False
+        return ret
+
+    def store(self, *, chain_id: int, classifications: Dict[bytes, bool], block_number: int):
+        """Store {address: is_contract} for 20-byte addresses, as seen at block_number"""
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT INTO contract_classifications (chain_id, address, contract_since_block, eoa_until_block) '
+                'VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (chain_id, address) DO UPDATE SET '
+                'contract_since_block = MIN(COALESCE(contract_since_block, excluded.contract_since_block), '
+                'COALESCE(excluded.contract_since_block, contract_since_block)), '
+                'eoa_until_block = MAX(COALESCE(eoa_until_block, excluded.eoa_until_block), '
+                'COALESCE(excluded.eoa_until_block, eoa_until_block))',
+                [
+                    (
+                        chain_id,
+                        address,
+                        block_number if is_contract else None,
+                        None if is_contract else block_number,
+                    )
+                    for (address, is_contract) in classifications.items()
+                ]
+            )
+
+
+class ResponseCache(SQLiteCache):
+    """
+    Stores the results of JSON-RPC requests by chain id, method and params.
+
+    Only requests whose result can never change should be stored, i.e. requests for finalized historical blocks.
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS responses (
+            chain_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            params TEXT NOT NULL,
+            result TEXT NOT NULL,
+            PRIMARY KEY (chain_id, method, params)
+        );
+    '''
+
+    def get(self, *, chain_id: int, method: str, params: str) -> Optional[Any]:
+        """Get the stored result of the request (with params serialized), or None if it's not stored"""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT result FROM responses WHERE chain_id = ? AND method = ? AND params = ?',
+                (chain_id, method, params)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def store(self, *, chain_id: int, method: str, params: str, result: Any):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses (chain_id, method, params, result) VALUES (?, ?, ?, ?)',
+                (chain_id, method, params, json.dumps(result))
+            )
@@ -0,0 +1,128 @@
+"""Checkpoints of an unfinished holder snapshot, so that a crashed snapshot can be resumed instead of started over"""
+import json
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional
+
+from eth_typing import Address
+
+from .addresses import to_address_bytes, to_hex_address
+from .balances import AddressBalances
+from .journal import truncate_incomplete_record
+
+CHECKPOINT_FORMAT_VERSION = 1
+
+
+def get_checkpoint_file_path(output_file: str) -> str:
+    return output_file + '.checkpoint'
+
+
+@dataclass
+class SnapshotCheckpointData:
+    """The state of a snapshot as of its last checkpoint"""
+    identity: Dict[str, Any]
+    possible_addresses: List[Address]
+    balances: List[AddressBalances]
+
+
+class SnapshotCheckpoint:
+    """
+    Writes the checkpoint file of a snapshot. The first line has what identifies the snapshot (chain, blocks, tokens
+    and where the balances come from) and the possible token holder addresses found by the event scan. Every line
+    after it has the balances of one fetched chunk of addresses, contracts included, so that the exclusion reasons can
+    be derived again on resume.
+
+    Lines are fsynced as they are written. A crash can only leave the last line incomplete, which is skipped when
+    reading and removed before appending.
+    """
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        truncate_incomplete_record(file_path)
+        self._file = open(file_path, 'a')
+
+    def __repr__(self):
+        return f'<SnapshotCheckpoint at {self.file_path!r}>'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @classmethod
+    def create(
+        cls,
+        file_path: str,
+        *,
+        identity: Dict[str, Any],
+        possible_addresses: Iterable[Address],
+    ) -> 'SnapshotCheckpoint':
+        """Start a new checkpoint file, replacing any old one"""
+        header = {
+            'version': CHECKPOINT_FORMAT_VERSION,
+            'identity': identity,
+            'possibleAddresses': [to_hex_address(address) for address in possible_addresses],
+        }
+        temp_file_path = file_path + '.tmp'
+        with open(temp_file_path, 'w') as f:
+            f.write(json.dumps(header) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file_path, file_path)
+        return cls(file_path)
+
+    def record_balances(self, chunk: Iterable[AddressBalances]):
+        line = json.dumps({
+            'balances': [
+                [
+                    to_hex_address(balances.address),
+                    balances.is_contract,
+                    # Large numbers are stored as strings, like in the snapshot files
+                    str(balances.holding_token_balance_on_account_wei),
+                    str(balances.lp_token_balance_on_account_wei),
+                    str(balances.lp_token_balance_on_liquidity_mining_wei),
+                ]
+                for balances in chunk
+            ]
+        }) + '\n'
+        self._file.write(line)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def load_checkpoint(file_path: str) -> Optional[SnapshotCheckpointData]:
+    """Load a checkpoint file, or None if there is no (complete) checkpoint at file_path"""
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as f:
+        lines = [line for line in f if line.endswith('\n')]
+    if not lines:
+        return None
+    header = json.loads(lines[0])
+    if header.get('version') != CHECKPOINT_FORMAT_VERSION:
+        raise ValueError(f'Unsupported checkpoint version: {header.get("version")!r}')
+    balances = []
+    for line in lines[1:]:
+        for address, is_contract, holding_wei, lp_on_account_wei, lp_on_liquidity_mining_wei in (
+            json.loads(line)['balances']
+        ):
+            balances.append(AddressBalances(
+                address=to_address_bytes(address),
+                is_contract=is_contract,
+                holding_token_balance_on_account_wei=int(holding_wei),
+                lp_token_balance_on_account_wei=int(lp_on_account_wei),
+                lp_token_balance_on_liquidity_mining_wei=int(lp_on_liquidity_mining_wei),
+            ))
+    return SnapshotCheckpointData(
+        identity=header['identity'],
+        possible_addresses=[to_address_bytes(address) for address in header['possibleAddresses']],
+        balances=balances,
+    )
+
+
+def remove_checkpoint(file_path: str):
+    if os.path.exists(file_path):
+        os.remove(file_path)
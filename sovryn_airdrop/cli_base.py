@@ -13,6 +13,13 @@ config_file_option = click.option(
     help='Path to JSON config file'
 )
 
+cache_dir_option = click.option(
+    '--cache-dir',
+    metavar='PATH',
+    envvar='SOVRYN_AIRDROP_CACHE_DIR',
+    help='Directory for caching finalized data fetched from the chain (not cached if not given)',
+)
+
 
 @click.group('sovryn_airdrop')
 def cli():
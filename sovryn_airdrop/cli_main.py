@@ -1,5 +1,6 @@
 from .cli_base import cli
 # Make sure the subcommands are imported properly
+from . import auditing  # noqa
 from . import planning  # noqa
 from . import sending  # noqa
 
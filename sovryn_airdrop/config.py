@@ -1,11 +1,11 @@
 import json
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import dataclass, field, replace
+from typing import List, Optional, Sequence, Union
 
 from eth_typing import ChecksumAddress
 from web3 import Web3
 
-from .web3_utils import get_web3, to_address
+from .web3_utils import get_erc20_contract, get_web3, to_address
 from .tokens import Token, load_token
 
 
@@ -14,17 +14,24 @@ class JSONConfig:
     """
     Raw config, as it exists as JSON on disk
     """
-    rpcUrl: str
+    # Either one RPC URL, or a list of them to spread the requests over
+    rpcUrl: Union[str, List[str]]
     holdingTokenAddress: str
     holdingTokenLiquidityPoolAddress: str
     rewardTokenAddress: str
-    rewarderAccountAddress: str
     snapshotBlockNumber: int
     firstScannedBlockNumber: int
+    # Either one rewarder account, or a list of them to send from in parallel
+    rewarderAccountAddress: Optional[str] = None
+    rewarderAccountAddresses: Optional[List[str]] = None
     totalRewardAmountWei: Optional[str] = None
     totalRewardAmountDecimal: Optional[str] = None
     minRewardWei: Optional[str] = None
     liquidityMiningAddress: Optional[str] = None
+    multicallAddress: Optional[str] = None
+    disperseAddress: Optional[str] = None
+    # Lowest rate (requests per second per node) that the rate limiter slows down to
+    minRequestRate: Optional[float] = None
 
     @classmethod
     def from_file(cls, file_path: str) -> 'JSONConfig':
@@ -40,16 +47,23 @@ class Config:
     Config that contains data in a nice form, possibly pre-loaded from web3
     """
     web3: Web3
-    rpc_url: str  # we could get rid of this
+    rpc_url: Union[str, List[str]]  # we could get rid of this
     holding_token: Token
     holding_token_liquidity_pool_address: ChecksumAddress  # Let's make it non-optional for now
     reward_token: Token
-    rewarder_account_address: ChecksumAddress
+    rewarder_account_address: ChecksumAddress  # The first of rewarder_account_addresses
     total_reward_amount_wei: int
     min_reward_wei: int
     snapshot_block_number: int
     first_scanned_block_number: int
     liquidity_mining_address: Optional[str] = None
+    multicall_address: Optional[ChecksumAddress] = None
+    disperse_address: Optional[ChecksumAddress] = None
+    rewarder_account_addresses: List[ChecksumAddress] = field(default_factory=list)
+
+    def __post_init__(self):
+        if not self.rewarder_account_addresses:
+            self.rewarder_account_addresses = [self.rewarder_account_address]
 
     @property
     def holding_token_address(self) -> ChecksumAddress:
@@ -60,18 +74,51 @@ class Config:
         return to_address(self.reward_token.address)
 
     @classmethod
-    def from_file(cls, file_path: str) -> 'Config':
+    def from_file(
+        cls,
+        file_path: str,
+        *,
+        max_connections: Optional[int] = None,
+        known_tokens: Sequence[Token] = (),
+        cache_dir: Optional[str] = None,
+    ) -> 'Config':
+        """
+        Load the config. Token info (and the chain id) is fetched from the chain, unless the token is one of
+        known_tokens (e.g. loaded from a snapshot). Responses for finalized blocks are cached in cache_dir, if given.
+        """
         raw = JSONConfig.from_file(file_path)
+        if not raw.rpcUrl:
+            raise ValueError('rpcUrl must be a URL or a non-empty list of URLs')
+        if raw.rewarderAccountAddresses:
+            rewarder_account_addresses = [to_address(address) for address in raw.rewarderAccountAddresses]
+        elif raw.rewarderAccountAddress:
+            rewarder_account_addresses = [to_address(raw.rewarderAccountAddress)]
+        else:
+            raise ValueError('Either rewarderAccountAddress or rewarderAccountAddresses is required')
+        if raw.rewarderAccountAddress and to_address(raw.rewarderAccountAddress) not in rewarder_account_addresses:
+            raise ValueError('rewarderAccountAddress must be one of rewarderAccountAddresses')
+        if len(set(rewarder_account_addresses)) != len(rewarder_account_addresses):
+            raise ValueError('rewarderAccountAddresses contains duplicates')
 
-        web3 = get_web3(raw.rpcUrl)
-        holding_token = load_token(
-            address=to_address(raw.holdingTokenAddress),
-            web3=web3
-        )
-        reward_token = load_token(
-            address=to_address(raw.rewardTokenAddress),
-            web3=web3
+        web3 = get_web3(
+            raw.rpcUrl,
+            max_connections=max_connections,
+            # All tokens are on the same chain
+            chain_id=known_tokens[0].chain_id if known_tokens else None,
+            cache_dir=cache_dir,
+            min_request_rate=raw.minRequestRate,
         )
+        known_tokens_by_address = {to_address(token.address): token for token in known_tokens}
+
+        def get_token(address: str) -> Token:
+            address = to_address(address)
+            token = known_tokens_by_address.get(address)
+            if token is None:
+                return load_token(address=address, web3=web3)
+            return replace(token, contract=get_erc20_contract(token_address=address, web3=web3))
+
+        holding_token = get_token(raw.holdingTokenAddress)
+        reward_token = get_token(raw.rewardTokenAddress)
 
         return cls(
             web3=web3,
@@ -79,7 +126,8 @@ class Config:
             holding_token=holding_token,
             holding_token_liquidity_pool_address=to_address(raw.holdingTokenLiquidityPoolAddress),
             reward_token=reward_token,
-            rewarder_account_address=to_address(raw.rewarderAccountAddress),
+            rewarder_account_address=rewarder_account_addresses[0],
+            rewarder_account_addresses=rewarder_account_addresses,
             total_reward_amount_wei=int(raw.totalRewardAmountWei),
             min_reward_wei=int(raw.minRewardWei) if raw.minRewardWei is not None else 1,
             snapshot_block_number=int(raw.snapshotBlockNumber),
@@ -89,4 +137,14 @@ class Config:
                 if raw.liquidityMiningAddress
                 else None
             ),
+            multicall_address=(
+                to_address(raw.multicallAddress)
+                if raw.multicallAddress
+                else None
+            ),
+            disperse_address=(
+                to_address(raw.disperseAddress)
+                if raw.disperseAddress
+                else None
+            ),
         )
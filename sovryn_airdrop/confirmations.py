@@ -0,0 +1,184 @@
+"""Confirming sent airdrop transactions by scanning Transfer logs, instead of polling the receipt of every one"""
+import logging
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Sequence
+
+from hexbytes import HexBytes
+from web3.types import LogReceipt
+
+from .addresses import to_address_bytes
+from .airdrop import Airdrop, SendUnit
+from .web3_utils import (
+    address_to_topic,
+    fetch_event_logs,
+    is_block_range_too_large_error,
+    pinned_requests,
+    retryable,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ConfirmationTracker:
+    """
+    Tracks sent transactions until they are mined, by scanning the reward token Transfer logs sent by the rewarder
+    accounts in new blocks. A single eth_getLogs request confirms every transaction mined in the scanned blocks,
+    however many there are.
+
+    Failed transactions have no logs. A transaction is considered missing when the nonce of its rewarder account at
+    the last scanned block is past the transaction's nonce, but no logs of it were found. The receipts of missing
+    transactions are fetched to find out what happened (see SendUnit.check_receipt).
+
+    With multiple RPC nodes, all requests of a poll go to the pinned node, so that the logs are fetched from the node
+    whose head block is scanned up to. A node lagging behind that head would return no logs for the blocks it doesn't
+    have yet, and they would never be scanned again.
+    """
+    def __init__(
+        self,
+        *,
+        airdrop: Airdrop,
+        rewarder_account_addresses: Sequence[str],
+        from_block: int,
+        max_block_range: int = 1000,
+    ):
+        self.airdrop = airdrop
+        self.web3 = airdrop.config.web3
+        self.rewarder_account_addresses = list(rewarder_account_addresses)
+        self.next_block = from_block
+        self.max_block_range = max_block_range
+        self._transfer_event = airdrop.reward_token.contract.events.Transfer
+        self._outstanding: Dict[bytes, SendUnit] = {}
+
+    def __repr__(self):
+        return f'<ConfirmationTracker at block {self.next_block} with {len(self._outstanding)} outstanding>'
+
+    @property
+    def num_outstanding(self) -> int:
+        return len(self._outstanding)
+
+    @property
+    def outstanding(self) -> List[SendUnit]:
+        return list(self._outstanding.values())
+
+    def add(self, unit: SendUnit):
+        if not unit.transaction_hash:
+            raise ValueError(f'Transaction is not sent: {unit.as_row()}')
+        self._outstanding[bytes(HexBytes(unit.transaction_hash))] = unit
+
+    def poll(self) -> List[SendUnit]:
+        """
+        Scan the blocks mined since the last poll and return the transactions that were confirmed in them.
+        Raises if a transaction failed or doesn't match the plan.
+        """
+        if not self._outstanding:
+            return []
+        with pinned_requests(self.web3):
+            return self._poll()
+
+    def _poll(self) -> List[SendUnit]:
+        head_block = self.web3.eth.block_number
+        if head_block < self.next_block:
+            return []
+        transfers: Dict[bytes, Counter] = defaultdict(Counter)
+        for from_block in range(self.next_block, head_block + 1, self.max_block_range):
+            to_block = min(from_block + self.max_block_range - 1, head_block)
+            for log in self._fetch_logs(from_block, to_block):
+                transaction_hash = bytes(log['transactionHash'])
+                if transaction_hash not in self._outstanding:
+                    continue
+                # Transfer(address indexed from, address indexed to, uint256 value)
+                to_address = to_address_bytes(log['topics'][2][-20:])
+                value = int.from_bytes(HexBytes(log['data'])[:32], 'big')
+                transfers[transaction_hash][to_address, value] += 1
+        self.next_block = head_block + 1
+
+        confirmed = []
+        # All logs of a transaction are in the same block, so the transfers of the found transactions are complete
+        for transaction_hash, transaction_transfers in transfers.items():
+            unit = self._outstanding.pop(transaction_hash)
+            if transaction_transfers != unit.get_expected_transfers():
+                raise ValueError(f'Transfers of the transaction do not match the plan: {unit.as_row()}')
+            confirmed.append(unit)
+        confirmed.extend(self._check_missing(head_block))
+        return confirmed
+
+    def _check_missing(self, head_block: int) -> List[SendUnit]:
+        outstanding_by_account = defaultdict(list)
+        for unit in self._outstanding.values():
+            outstanding_by_account[unit.rewarder_account_address].append(unit)
+        confirmed = []
+        for rewarder_account_address, units in outstanding_by_account.items():
+            nonce = self.web3.eth.get_transaction_count(rewarder_account_address, block_identifier=head_block)
+            for unit in units:
+                if unit.transaction_nonce >= nonce:
+                    continue
+                receipt = unit.fetch_receipt()
+                if receipt is None:
+                    raise ValueError(
+                        f'Nonce {unit.transaction_nonce} of {rewarder_account_address} was used by another '
+                        f'transaction: {unit.as_row()}'
+                    )
+                # Raises if the transaction failed
+                unit.check_receipt(receipt)
+                # Mined after the scanned block was fetched (or logs missing from the node)
+                logger.warning('Transaction %s confirmed from its receipt instead of logs', unit.transaction_hash)
+                del self._outstanding[bytes(HexBytes(unit.transaction_hash))]
+                confirmed.append(unit)
+        return confirmed
+
+    def _fetch_logs(self, from_block: int, to_block: int) -> List[LogReceipt]:
+        try:
+            return self._fetch_logs_with_retries(from_block, to_block)
+        except Exception as e:
+            if from_block == to_block or not is_block_range_too_large_error(e):
+                raise
+            middle_block = (from_block + to_block) // 2
+            return self._fetch_logs(from_block, middle_block) + self._fetch_logs(middle_block + 1, to_block)
+
+    @retryable(max_attempts=3)
+    def _fetch_logs_with_retries(self, from_block: int, to_block: int) -> List[LogReceipt]:
+        return fetch_event_logs(
+            event=self._transfer_event,
+            from_block=from_block,
+            to_block=to_block,
+            argument_topics=[[address_to_topic(address) for address in self.rewarder_account_addresses]],
+        )
+
+
+def get_confirmation_start_block(airdrop: Airdrop, units: Sequence[SendUnit]) -> int:
+    """
+    Get the block to start scanning from to confirm already sent transactions. Transactions of a rewarder account are
+    mined in nonce order, so only the receipt of the first one of every account is needed.
+    """
+    start_block = airdrop.config.web3.eth.block_number
+    first_units = {}
+    for unit in units:
+        first_unit = first_units.get(unit.rewarder_account_address)
+        if first_unit is None or unit.transaction_nonce < first_unit.transaction_nonce:
+            first_units[unit.rewarder_account_address] = unit
+    for unit in first_units.values():
+        receipt = unit.fetch_receipt()
+        if receipt is not None:
+            start_block = min(start_block, receipt['blockNumber'])
+    return start_block
+
+
+def wait_for_confirmations(
+    tracker: ConfirmationTracker,
+    *,
+    poll_interval: float,
+    timeout: float,
+) -> List[SendUnit]:
+    """Poll the tracker until at least one outstanding transaction is confirmed, and return the confirmed ones"""
+    deadline = time.monotonic() + timeout
+    while True:
+        confirmed = tracker.poll()
+        if confirmed:
+            return confirmed
+        if time.monotonic() > deadline:
+            raise TimeoutError(
+                f'None of the {tracker.num_outstanding} outstanding transactions were mined in {timeout} seconds, '
+                f'first outstanding: {tracker.outstanding[0].as_row()}'
+            )
+        time.sleep(poll_interval)
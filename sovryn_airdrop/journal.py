@@ -0,0 +1,95 @@
+"""Append-only journal of sent transactions, so that the plan file doesn't need to be rewritten after every send"""
+import json
+import os
+import threading
+from dataclasses import asdict, dataclass
+from typing import Iterator
+
+JOURNAL_STATUS_SENT = 'sent'
+JOURNAL_STATUS_MINED = 'mined'
+
+
+@dataclass
+class JournalRecord:
+    rewarder_account_address: str
+    transaction_nonce: int
+    transaction_hash: str
+    status: str
+
+
+def get_journal_file_path(plan_file: str) -> str:
+    return plan_file + '.journal'
+
+
+class SendJournal:
+    """
+    Records of sent transactions, one JSON object per line, appended to the journal file next to the plan file.
+
+    Every record is fsynced before record() returns, so a sent transaction is never forgotten. A crash while writing
+    can only leave the last line incomplete, which is skipped when reading and removed before appending.
+    Records can be written from multiple threads.
+    """
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        if os.path.exists(file_path):
+            # Records appended after an incomplete line would be lost with it
+            truncate_incomplete_record(file_path)
+        self._file = open(file_path, 'a')
+
+    def __repr__(self):
+        return f'<SendJournal at {self.file_path!r}>'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def record(self, *, rewarder_account_address: str, transaction_nonce: int, transaction_hash: str, status: str):
+        line = json.dumps(asdict(JournalRecord(
+            rewarder_account_address=rewarder_account_address,
+            transaction_nonce=transaction_nonce,
+            transaction_hash=transaction_hash,
+            status=status,
+        ))) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def truncate_incomplete_record(file_path: str, *, chunk_size: int = 4096):
+    """Remove the incomplete last line of the file, if any"""
+    with open(file_path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(position - chunk_size, 0)
+            f.seek(start)
+            chunk = f.read(position - start)
+            newline_index = chunk.rfind(b'\n')
+            if newline_index != -1:
+                position = start + newline_index + 1
+                break
+            position = start
+        if position != end:
+            f.truncate(position)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def read_journal(file_path: str) -> Iterator[JournalRecord]:
+    """Read the records of a journal file in the order they were written. A missing file has no records."""
+    if not os.path.exists(file_path):
+        return
+    with open(file_path) as f:
+        for line in f:
+            if not line.endswith('\n'):
+                # Torn write of the last record, which was never acknowledged
+                break
+            yield JournalRecord(**json.loads(line))
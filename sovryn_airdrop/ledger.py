@@ -0,0 +1,261 @@
+"""Balances computed by replaying event logs instead of calling the contracts"""
+import logging
+import random
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+from eth_typing import Address, AnyAddress, ChecksumAddress
+from hexbytes import HexBytes
+from web3.contract import Contract, ContractEvent
+from web3.types import LogReceipt
+
+from .addresses import to_address_bytes
+from .balances import (
+    AddressBalances,
+    BalanceFetcher,
+    batch_fetch_contract_flags,
+    fetch_balance_in_block,
+    fetch_balance_on_liquidity_mining_in_block,
+)
+from .tokens import Token
+from .web3_utils import get_event_topic, to_address
+
+logger = logging.getLogger(__name__)
+
+ZERO_ADDRESS = Address(b'\x00' * 20)
+
+
+class ReplayedBalances:
+    """Balances of addresses, computed by folding event logs into them"""
+    def __init__(self, *, target_block_number: int):
+        self.target_block_number = target_block_number
+        self._balances: Dict[Address, int] = defaultdict(int)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} at block {self.target_block_number} with {len(self._balances)} addresses>'
+
+    def balance_of(self, address) -> int:
+        return self._balances.get(to_address_bytes(address), 0)
+
+    @property
+    def total(self) -> int:
+        return sum(self._balances.values())
+
+    def get_negative_balance_addresses(self) -> List[Address]:
+        """
+        Addresses with a negative balance. If there are any, events are missing, usually because the scan didn't
+        start early enough.
+        """
+        return [address for (address, balance) in self._balances.items() if balance < 0]
+
+    def get_nonzero_balance_addresses(self) -> List[Address]:
+        return [address for (address, balance) in self._balances.items() if balance != 0]
+
+
+class BalanceLedger(ReplayedBalances):
+    """
+    Token balances of every address at target_block_number, computed by folding the token's Transfer logs.
+
+    The balances are only correct if all Transfer logs from the token's deployment up to target_block_number are
+    applied. Logs after target_block_number are ignored, and the logs can be applied in any order.
+    """
+    def __init__(self, *, target_block_number: int):
+        super().__init__(target_block_number=target_block_number)
+        self.num_transfers = 0
+
+    def apply_transfer_log(self, log: LogReceipt):
+        if log['blockNumber'] > self.target_block_number:
+            return
+        # Transfer(address indexed from, address indexed to, uint256 value)
+        topics = log['topics']
+        from_address = to_address_bytes(topics[1][-20:])
+        to_address_ = to_address_bytes(topics[2][-20:])
+        value = int.from_bytes(HexBytes(log['data'])[:32], 'big')
+        # The zero address is the source of mints and the target of burns, its balance is meaningless
+        if from_address != ZERO_ADDRESS:
+            self._balances[from_address] -= value
+        if to_address_ != ZERO_ADDRESS:
+            self._balances[to_address_] += value
+        self.num_transfers += 1
+
+    def apply_transfer_logs(self, logs: Iterable[LogReceipt]):
+        for log in logs:
+            self.apply_transfer_log(log)
+
+    @property
+    def total_supply(self) -> int:
+        return self.total
+
+
+def get_staking_events(liquidity_mining: Contract) -> List[ContractEvent]:
+    """Get the LiquidityMining events that change the staked amounts of users"""
+    return [
+        liquidity_mining.events.Deposit,
+        liquidity_mining.events.Withdraw,
+        liquidity_mining.events.EmergencyWithdraw,
+    ]
+
+
+class StakedBalanceIndex(ReplayedBalances):
+    """
+    Amounts of pool_token staked in LiquidityMining by every user at target_block_number, computed by folding the
+    Deposit, Withdraw and EmergencyWithdraw logs of the contract.
+
+    Logs of other pool tokens and logs after target_block_number are ignored, and the logs can be applied in any
+    order. The amounts are only correct if all logs since the pool token was added to LiquidityMining are applied.
+    """
+    def __init__(self, *, liquidity_mining: Contract, pool_token_address: AnyAddress, target_block_number: int):
+        super().__init__(target_block_number=target_block_number)
+        self.pool_token_address = to_address_bytes(pool_token_address)
+        deposit, withdraw, emergency_withdraw = get_staking_events(liquidity_mining)
+        # Deposit(user, poolToken, amount), Withdraw(user, poolToken, amount) and
+        # EmergencyWithdraw(user, poolToken, amount, accumulatedReward), with user and poolToken indexed.
+        # EmergencyWithdraw always withdraws the whole staked amount.
+        self._signs = {
+            bytes(HexBytes(get_event_topic(deposit))): 1,
+            bytes(HexBytes(get_event_topic(withdraw))): -1,
+            bytes(HexBytes(get_event_topic(emergency_withdraw))): -1,
+        }
+        self.num_events = 0
+
+    def apply_log(self, log: LogReceipt):
+        if log['blockNumber'] > self.target_block_number:
+            return
+        topics = log['topics']
+        sign = self._signs.get(bytes(topics[0]))
+        if sign is None:
+            return
+        if to_address_bytes(topics[2][-20:]) != self.pool_token_address:
+            return
+        user = to_address_bytes(topics[1][-20:])
+        amount = int.from_bytes(HexBytes(log['data'])[:32], 'big')
+        self._balances[user] += sign * amount
+        self.num_events += 1
+
+    def apply_logs(self, logs: Iterable[LogReceipt]):
+        for log in logs:
+            self.apply_log(log)
+
+
+@dataclass
+class LedgerMismatch:
+    address: Address
+    ledger_balance_wei: int
+    actual_balance_wei: int
+
+
+def verify_ledger_sample(
+    *,
+    ledger: BalanceLedger,
+    token: Token,
+    addresses: Iterable[Address],
+    sample_size: int = 20,
+    rng: Optional[random.Random] = None,
+) -> List[LedgerMismatch]:
+    """
+    Compare the ledger balances of a random sample of addresses with balanceOf at the ledger's target block.
+
+    Returns the mismatches, which should be empty.
+    """
+    return _verify_sample(
+        balances=ledger,
+        addresses=addresses,
+        fetch_actual_balance=lambda address: fetch_balance_in_block(
+            token=token,
+            address=address,
+            block_number=ledger.target_block_number,
+        ),
+        description=f'ledger balance of {token.symbol}',
+        sample_size=sample_size,
+        rng=rng,
+    )
+
+
+def verify_staked_balance_sample(
+    *,
+    index: StakedBalanceIndex,
+    liquidity_mining: Contract,
+    pool_token: Token,
+    addresses: Iterable[Address],
+    sample_size: int = 20,
+    rng: Optional[random.Random] = None,
+) -> List[LedgerMismatch]:
+    """
+    Compare the staked amounts of a random sample of addresses with getUserInfo at the index's target block.
+
+    Returns the mismatches, which should be empty.
+    """
+    return _verify_sample(
+        balances=index,
+        addresses=addresses,
+        fetch_actual_balance=lambda address: fetch_balance_on_liquidity_mining_in_block(
+            pool_token=pool_token,
+            address=address,
+            block_number=index.target_block_number,
+            liquidity_mining=liquidity_mining,
+        ),
+        description=f'staked amount of {pool_token.symbol}',
+        sample_size=sample_size,
+        rng=rng,
+    )
+
+
+def _verify_sample(
+    *,
+    balances: ReplayedBalances,
+    addresses: Iterable[Address],
+    fetch_actual_balance: Callable[[ChecksumAddress], int],
+    description: str,
+    sample_size: int,
+    rng: Optional[random.Random],
+) -> List[LedgerMismatch]:
+    if rng is None:
+        rng = random.Random()
+    addresses = sorted(addresses)
+    sample = rng.sample(addresses, min(sample_size, len(addresses)))
+    ret = []
+    for address in sample:
+        actual_balance_wei = fetch_actual_balance(to_address(address))
+        ledger_balance_wei = balances.balance_of(address)
+        if actual_balance_wei != ledger_balance_wei:
+            logger.warning(
+                '%s for %s is %s but the contract returned %s',
+                description,
+                to_address(address),
+                ledger_balance_wei,
+                actual_balance_wei,
+            )
+            ret.append(LedgerMismatch(
+                address=address,
+                ledger_balance_wei=ledger_balance_wei,
+                actual_balance_wei=actual_balance_wei,
+            ))
+    return ret
+
+
+@dataclass
+class LedgerBalanceFetcher(BalanceFetcher):
+    """
+    Takes the holding and LP token balances from ledgers instead of calling balanceOf.
+
+    Only the LiquidityMining balances (and the contract checks) are fetched from the node.
+    """
+    holding_token_ledger: Optional[BalanceLedger] = None
+    lp_token_ledger: Optional[BalanceLedger] = None
+    chunk_size: int = 100
+    batch_contract_checks: bool = False
+
+    def fetch_contract_flags(self, addresses: Sequence[AnyAddress]) -> List[bool]:
+        if self.batch_contract_checks:
+            return batch_fetch_contract_flags(web3=self.web3, addresses=addresses, block_identifier=self.block_number)
+        return super().fetch_contract_flags(addresses)
+
+    def fetch_account_balances_one(self, address: AnyAddress) -> AddressBalances:
+        return AddressBalances(
+            address=address,
+            is_contract=False,
+            holding_token_balance_on_account_wei=self.holding_token_ledger.balance_of(address),
+            lp_token_balance_on_account_wei=self.lp_token_ledger.balance_of(address),
+            lp_token_balance_on_liquidity_mining_wei=self.fetch_staked_balance(address),
+        )
@@ -1,57 +1,366 @@
+import itertools
+import logging
 import os
 from collections import Counter, defaultdict
-from dataclasses import dataclass
 from decimal import Decimal
-from typing import Optional, Set
+from typing import Any, Dict, Iterable, Optional, Sequence, Set, Tuple
 
 import click
-from eth_typing import ChecksumAddress
+from eth_utils import to_hex
+from eth_typing import Address
 from web3 import Web3
 from web3.contract import Contract
+from web3.types import LogReceipt
 
+from .addresses import AddressSet, to_address_bytes
 from .airdrop import Airdrop
-from .cli_base import cli, bold, echo, echo_token_info, hilight, config_file_option
+from .allocation import RewardAllocator
+from .balances import (
+    AddressBalances,
+    BalanceFetcher,
+    BatchBalanceFetcher,
+    MulticallBalanceFetcher,
+    fetch_balance_in_block,
+)
+from .cache import ContractClassificationCache, EventLogCache
+from .checkpoint import (
+    SnapshotCheckpoint,
+    SnapshotCheckpointData,
+    get_checkpoint_file_path,
+    load_checkpoint,
+    remove_checkpoint,
+)
+from .cli_base import cli, bold, cache_dir_option, echo, echo_token_info, hilight, config_file_option
 from .config import Config
+from .ledger import (
+    BalanceLedger,
+    LedgerBalanceFetcher,
+    StakedBalanceIndex,
+    get_staking_events,
+    verify_ledger_sample,
+    verify_staked_balance_sample,
+)
+from .snapshot import HolderSnapshot, TokenHolder
 from .tokens import Token, load_token
-from .web3_utils import EventBatchComplete, get_erc20_contract, get_events, is_contract, load_abi, retryable, to_address
+from .web3_utils import (
+    EventBatchComplete,
+    iter_event_log_batches,
+    load_abi,
+    log_provider_stats,
+    make_batch_request,
+    to_address,
+)
 
+logger = logging.getLogger(__name__)
 
-@dataclass
-class TokenHolder:
-    address: ChecksumAddress
-    holding_token_balance_on_account_wei: int
-    lp_token_balance_on_account_wei: int
-    lp_token_balance_on_liquidity_mining_wei: int
-    holding_token_balance_on_lp_wei: int
 
-    @property
-    def total_holding_token_balance_wei(self) -> int:
-        return self.holding_token_balance_on_account_wei + self.holding_token_balance_on_lp_wei
+def snapshot_options(func):
+    """Options for taking the holder snapshot, shared by the plan and snapshot commands"""
+    options = [
+        click.option(
+            '--rpc-batch-size',
+            type=int,
+            default=0,
+            metavar='N',
+            help='Fetch snapshot balances of N addresses per JSON-RPC batch request (0 to disable batching)'
+        ),
+        click.option(
+            '--multicall',
+            is_flag=True,
+            default=False,
+            help=(
+                'Aggregate snapshot balance calls through the Multicall2 contract at multicallAddress '
+                'from the config'
+            )
+        ),
+        click.option(
+            '--concurrency',
+            type=click.IntRange(min=1),
+            default=1,
+            metavar='N',
+            help='Scan events and fetch snapshot balances with N concurrent workers'
+        ),
+        click.option(
+            '--infer-eoas-from-senders',
+            is_flag=True,
+            default=False,
+            help=(
+                'Fetch the transactions of the scanned Transfer events and treat their senders as non-contracts '
+                'without checking their code'
+            )
+        ),
+        click.option(
+            '--balances-from-events',
+            is_flag=True,
+            default=False,
+            help=(
+                'Compute holding and LP token balances by replaying the scanned Transfer events '
+                'instead of calling balanceOf. Requires firstScannedBlockNumber to be at or before the deployment '
+                'of both tokens.'
+            )
+        ),
+        click.option(
+            '--staked-balances-from-events',
+            is_flag=True,
+            default=False,
+            help=(
+                'Compute the LP token amounts staked in LiquidityMining by replaying its Deposit/Withdraw events '
+                'instead of calling getUserInfo for every address.'
+            )
+        ),
+        cache_dir_option,
+        click.option(
+            '--resume',
+            is_flag=True,
+            default=False,
+            help=(
+                'Continue from the checkpoint file next to the output file, left behind by an earlier run that '
+                'did not finish'
+            )
+        ),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+snapshot_file_option = click.option(
+    '-s',
+    '--snapshot-file',
+    required=True,
+    metavar='PATH',
+    help='Path to the holder snapshot file',
+)
 
 
 @cli.command()
 @config_file_option
 @click.option('-p', '--plan-file', required=True, metavar='PATH', help='Path to write the plan file to')
-def plan(config_file: str, plan_file: str):
+@snapshot_options
+def plan(
+    config_file: str,
+    plan_file: str,
+    rpc_batch_size: int,
+    multicall: bool,
+    concurrency: int,
+    infer_eoas_from_senders: bool,
+    balances_from_events: bool,
+    staked_balances_from_events: bool,
+    cache_dir: Optional[str],
+    resume: bool,
+):
     """
     Plan an airdrop, generating a file that can be used to execute the airdrop.
+
+    This is the same as running snapshot and allocate, without storing the snapshot.
     """
-    config = Config.from_file(config_file)
+    config = Config.from_file(config_file, max_connections=concurrency, cache_dir=cache_dir)
     echo(f'Planning airdrop with config {config}')
-    echo(
-        'Total reward amount:',
-        hilight(config.reward_token.str_amount(config.total_reward_amount_wei)),
-        hilight(config.reward_token.symbol)
+    echo_reward_info(config)
+
+    if os.path.exists(plan_file):
+        click.confirm(f'A plan file already exists at {plan_file!r}, overwrite?', abort=True)
+
+    checkpoint_file = get_checkpoint_file_path(plan_file)
+    snapshot = take_snapshot(
+        config=config,
+        rpc_batch_size=rpc_batch_size,
+        multicall=multicall,
+        concurrency=concurrency,
+        infer_eoas_from_senders=infer_eoas_from_senders,
+        balances_from_events=balances_from_events,
+        staked_balances_from_events=staked_balances_from_events,
+        cache_dir=cache_dir,
+        checkpoint_file=checkpoint_file,
+        resume=resume,
     )
-    echo(
-        'Minimum reward:',
-        hilight(config.reward_token.str_amount(config.min_reward_wei)),
-        hilight(config.reward_token.symbol)
+    allocate_and_save_plan(config=config, snapshot=snapshot, plan_file=plan_file)
+    remove_checkpoint(checkpoint_file)
+
+
+@cli.command()
+@config_file_option
+@snapshot_file_option
+@snapshot_options
+def snapshot(
+    config_file: str,
+    snapshot_file: str,
+    rpc_batch_size: int,
+    multicall: bool,
+    concurrency: int,
+    infer_eoas_from_senders: bool,
+    balances_from_events: bool,
+    staked_balances_from_events: bool,
+    cache_dir: Optional[str],
+    resume: bool,
+):
+    """
+    Find the token holders and their balances at the snapshot block, and save them to a snapshot file
+    that can be used to allocate the rewards.
+    """
+    config = Config.from_file(config_file, max_connections=concurrency, cache_dir=cache_dir)
+    echo(f'Taking holder snapshot with config {config}')
+
+    if os.path.exists(snapshot_file):
+        click.confirm(f'A snapshot file already exists at {snapshot_file!r}, overwrite?', abort=True)
+
+    checkpoint_file = get_checkpoint_file_path(snapshot_file)
+    holder_snapshot = take_snapshot(
+        config=config,
+        rpc_batch_size=rpc_batch_size,
+        multicall=multicall,
+        concurrency=concurrency,
+        infer_eoas_from_senders=infer_eoas_from_senders,
+        balances_from_events=balances_from_events,
+        staked_balances_from_events=staked_balances_from_events,
+        cache_dir=cache_dir,
+        checkpoint_file=checkpoint_file,
+        resume=resume,
+    )
+    echo_excluded_addresses(holder_snapshot.excluded_addresses)
+    click.echo(f"Saving holder snapshot to {snapshot_file!r}")
+    holder_snapshot.to_file(snapshot_file)
+    remove_checkpoint(checkpoint_file)
+
+
+@cli.command()
+@config_file_option
+@snapshot_file_option
+@click.option('-p', '--plan-file', required=True, metavar='PATH', help='Path to write the plan file to')
+@click.option(
+    '--start-nonce',
+    type=click.IntRange(min=0),
+    multiple=True,
+    metavar='N',
+    help=(
+        'Nonce of the first airdrop transaction, given once for every rewarder account in the order of the config '
+        '(fetched from the chain if not given)'
     )
+)
+def allocate(
+    config_file: str,
+    snapshot_file: str,
+    plan_file: str,
+    start_nonce: Tuple[int, ...],
+):
+    """
+    Allocate the rewards between the token holders of a snapshot file, generating a plan file that can be used
+    to execute the airdrop.
+
+    Nothing is fetched from the chain if --start-nonce is given.
+    """
+    holder_snapshot = HolderSnapshot.from_file(snapshot_file)
+    config = Config.from_file(config_file, known_tokens=holder_snapshot.tokens)
+    echo(f'Allocating airdrop with config {config}')
+    if (
+        holder_snapshot.snapshot_block_number != config.snapshot_block_number or
+        holder_snapshot.holding_token.address != config.holding_token.address
+    ):
+        raise click.UsageError(
+            f'Snapshot file {snapshot_file!r} is of {holder_snapshot.holding_token.symbol} at block '
+            f'{holder_snapshot.snapshot_block_number}, which does not match the config'
+        )
+    if start_nonce and len(start_nonce) != len(config.rewarder_account_addresses):
+        raise click.UsageError(
+            f'--start-nonce must be given for all {len(config.rewarder_account_addresses)} rewarder accounts'
+        )
+    echo_reward_info(config)
 
     if os.path.exists(plan_file):
         click.confirm(f'A plan file already exists at {plan_file!r}, overwrite?', abort=True)
 
+    allocate_and_save_plan(
+        config=config,
+        snapshot=holder_snapshot,
+        plan_file=plan_file,
+        start_nonces=start_nonce or None,
+    )
+
+
+@cli.command()
+@config_file_option
+@snapshot_file_option
+@click.option(
+    '--total-reward-wei',
+    type=int,
+    multiple=True,
+    metavar='WEI',
+    help='Total reward amount to try (can be given multiple times, defaults to totalRewardAmountWei from the config)'
+)
+@click.option(
+    '--min-reward-wei',
+    type=int,
+    multiple=True,
+    metavar='WEI',
+    help='Minimum reward amount to try (can be given multiple times, defaults to minRewardWei from the config)'
+)
+def sweep(
+    config_file: str,
+    snapshot_file: str,
+    total_reward_wei: Sequence[int],
+    min_reward_wei: Sequence[int],
+):
+    """
+    Show how many token holders of a snapshot file would get a reward, and how big the rewards would be, for every
+    combination of the given total and minimum reward amounts. Nothing is fetched from the chain.
+    """
+    holder_snapshot = HolderSnapshot.from_file(snapshot_file)
+    config = Config.from_file(config_file, known_tokens=holder_snapshot.tokens)
+    reward_token = config.reward_token
+    allocator = RewardAllocator([t.total_holding_token_balance_wei for t in holder_snapshot.token_holders])
+    results = allocator.sweep(itertools.product(
+        total_reward_wei or [config.total_reward_amount_wei],
+        min_reward_wei or [config.min_reward_wei],
+    ))
+    echo(
+        'Allocating rewards in',
+        hilight(reward_token.symbol),
+        'between',
+        hilight(allocator.num_holders),
+        'token holders:'
+    )
+    echo(
+        bold('Total reward'.rjust(30)),
+        bold('Min reward'.rjust(30)),
+        bold('Recipients'.rjust(12)),
+        bold('Excluded'.rjust(12)),
+        bold('Smallest reward'.rjust(30)),
+        bold('Largest reward'.rjust(30)),
+    )
+    for result in results:
+        echo(
+            reward_token.str_amount(result.total_reward_wei).rjust(30),
+            reward_token.str_amount(result.min_reward_wei).rjust(30),
+            str(result.num_recipients).rjust(12),
+            str(result.num_excluded).rjust(12),
+            reward_token.str_amount(result.smallest_reward_wei).rjust(30),
+            reward_token.str_amount(result.largest_reward_wei).rjust(30),
+        )
+
+
+def take_snapshot(
+    *,
+    config: Config,
+    rpc_batch_size: int,
+    multicall: bool,
+    concurrency: int,
+    infer_eoas_from_senders: bool,
+    balances_from_events: bool,
+    staked_balances_from_events: bool,
+    cache_dir: Optional[str],
+    checkpoint_file: Optional[str] = None,
+    resume: bool = False,
+) -> HolderSnapshot:
+    """
+    Find the token holders and their balances at the snapshot block.
+
+    If checkpoint_file is given, the found addresses and the fetched balances are written to it as they come. With
+    resume, a snapshot is continued from its checkpoint, without scanning the events again (unless balances are
+    computed from them) or fetching the balances that are already in it.
+    """
+    if multicall and not config.multicall_address:
+        raise click.UsageError('--multicall requires multicallAddress to be set in the config')
+
     web3 = config.web3
     holding_token = config.holding_token
     echo_token_info(holding_token, "Holding token")
@@ -67,107 +376,319 @@ def plan(config_file: str, plan_file: str):
 
     # Find token holders
     click.echo('Finding non-contract token holder addresses and balances (this might take a while)')
-    possible_addresses = set()
-    possible_addresses |= fetch_possible_token_holders(config, holding_token)
-    possible_addresses |= fetch_possible_token_holders(config, lp_token)
-    echo(
-        "Found a total of",
-        hilight(len(possible_addresses)),
-        'possible token holder addresses (including contracts)',
-        f'from {holding_token.symbol} and/or {lp_token.symbol} transfers.'
-    )
-
-    # Find token holder balances
-    token_holders = []
-    excluded_addresses = dict()
-    with click.progressbar(
-        possible_addresses,
-        label=f'Fetching snapshot balances and filtering out contracts'
-    ) as bar:
-        for address in bar:
-            # Special cases, though unnecessary if we exclude all contracts anyway
-            if (
-                (liquidity_mining and address.lower() == liquidity_mining.address.lower()) or
-                address.lower() == config.holding_token_liquidity_pool_address.lower() or
-                address.lower() == config.rewarder_account_address.lower()
-            ):
-                excluded_addresses[address] = 'is_special_address'
-                continue
+    event_cache = None
+    contract_cache = None
+    if cache_dir:
+        event_cache = EventLogCache(os.path.join(cache_dir, 'events.sqlite'))
+        contract_cache = ContractClassificationCache(os.path.join(cache_dir, 'contracts.sqlite'))
+        echo('Using event cache at', hilight(event_cache.path))
+        echo('Using contract classification cache at', hilight(contract_cache.path))
+    snapshot_identity = {
+        'chainId': holding_token.chain_id,
+        'snapshotBlockNumber': config.snapshot_block_number,
+        'firstScannedBlockNumber': config.first_scanned_block_number,
+        'holdingTokenAddress': holding_token.address,
+        'lpTokenAddress': lp_token.address,
+        # Where the balances come from. Balances from different sources should agree, but a resumed snapshot must not
+        # mix them if they don't.
+        'liquidityMiningAddress': liquidity_mining.address if liquidity_mining else None,
+        'multicallAddress': config.multicall_address if multicall else None,
+        'balancesFromEvents': balances_from_events,
+        'stakedBalancesFromEvents': staked_balances_from_events,
+    }
+    checkpoint = None
+    if checkpoint_file and resume:
+        checkpoint = load_resumable_checkpoint(checkpoint_file, identity=snapshot_identity)
 
-            if is_contract(
-                web3=web3,
-                address=address
-            ):
-                # We don't want to include contract addresses here
-                #print('\nis_contract', address)
-                excluded_addresses[address] = 'is_contract'
-                continue
+    possible_addresses = AddressSet()
+    ledgers = {}
+    staked_balances = None
+    known_eoas = None
+    # The candidates are in the checkpoint, but balances computed from events need the events anyway
+    if checkpoint is None or balances_from_events or staked_balances_from_events:
+        transaction_hashes = set() if infer_eoas_from_senders else None
+        for token in (holding_token, lp_token):
+            if balances_from_events:
+                ledgers[token.address] = BalanceLedger(target_block_number=config.snapshot_block_number)
+            possible_addresses |= fetch_possible_token_holders(
+                config,
+                token,
+                event_cache=event_cache,
+                concurrency=concurrency,
+                transaction_hashes=transaction_hashes,
+                ledger=ledgers.get(token.address),
+            )
+        echo(
+            "Found a total of",
+            hilight(len(possible_addresses)),
+            'possible token holder addresses (including contracts)',
+            f'from {holding_token.symbol} and/or {lp_token.symbol} transfers.'
+        )
+        log_provider_stats(web3, 'the Transfer event scans')
 
-            holding_token_balance_wei = fetch_balance_in_block(
+        if balances_from_events:
+            verify_ledger(
+                ledger=ledgers[holding_token.address],
                 token=holding_token,
-                address=address,
-                block_number=config.snapshot_block_number
+                total_supply=holding_token.contract.functions.totalSupply().call(
+                    block_identifier=config.snapshot_block_number
+                ),
             )
-            lp_token_balance_on_account_wei = fetch_balance_in_block(
+            verify_ledger(
+                ledger=ledgers[lp_token.address],
                 token=lp_token,
-                address=address,
-                block_number=config.snapshot_block_number
+                total_supply=lp_token_total_supply,
+            )
+
+        if staked_balances_from_events and liquidity_mining:
+            staked_balances = fetch_staked_balances(
+                config,
+                liquidity_mining=liquidity_mining,
+                lp_token=lp_token,
+                event_cache=event_cache,
+                concurrency=concurrency,
             )
-            lp_token_balance_on_liquidity_mining_wei = fetch_balance_on_liquidity_mining_in_block(
-                pool_token=lp_token,
-                address=address,
-                block_number=config.snapshot_block_number,
+            verify_staked_balances(
+                index=staked_balances,
                 liquidity_mining=liquidity_mining,
+                lp_token=lp_token,
+                candidate_addresses=possible_addresses,
+            )
+            # Users that staked all their LP tokens don't necessarily show up in the LP token transfers between the
+            # scanned blocks
+            possible_addresses |= staked_balances.get_nonzero_balance_addresses()
+            log_provider_stats(web3, 'the LiquidityMining event scans')
+
+        if infer_eoas_from_senders:
+            known_eoas = fetch_transaction_senders(
+                web3=web3,
+                transaction_hashes=transaction_hashes,
+                batch_size=rpc_batch_size or 100,
             )
-            lp_token_balance_wei = lp_token_balance_on_account_wei + lp_token_balance_on_liquidity_mining_wei
-            if holding_token_balance_wei + lp_token_balance_on_account_wei + lp_token_balance_wei == 0:
-                # The address is not a holder after all
-                #print('zero_balance', address)
-                excluded_addresses[address] = 'zero_balance'
-                continue
-
-            # Calculate holding token balance on liquidity pool by multiplying LP token balance in user wallet with the
-            # fraction of the holding token one LP token represents.
-            holding_token_balance_on_lp_wei = (
-                lp_token_balance_wei * holding_token_reserve_balance // lp_token_total_supply
+            echo(
+                hilight(len(known_eoas)),
+                'addresses sent the Transfer transactions and are known not to be contracts.'
             )
-            token_holder = TokenHolder(
-                address=address,
-                holding_token_balance_on_account_wei=holding_token_balance_wei,
-                lp_token_balance_on_account_wei=lp_token_balance_on_account_wei,
-                lp_token_balance_on_liquidity_mining_wei=lp_token_balance_on_liquidity_mining_wei,
-                holding_token_balance_on_lp_wei=holding_token_balance_on_lp_wei,
+
+    # Find token holder balances
+    token_holders = []
+    excluded_addresses = dict()
+    candidate_addresses = []
+    # Special cases, though unnecessary if we exclude all contracts anyway
+    special_addresses = AddressSet([
+        config.holding_token_liquidity_pool_address,
+        *config.rewarder_account_addresses,
+    ])
+    if liquidity_mining:
+        special_addresses.add(liquidity_mining.address)
+    # Sorted, so that the results are in the same order on every run
+    if checkpoint is not None:
+        possible_addresses = AddressSet(checkpoint.possible_addresses)
+    for address in possible_addresses.sorted():
+        if address in special_addresses:
+            excluded_addresses[address] = 'is_special_address'
+            continue
+        candidate_addresses.append(address)
+
+    balance_fetcher = get_balance_fetcher(
+        config=config,
+        lp_token=lp_token,
+        liquidity_mining=liquidity_mining,
+        rpc_batch_size=rpc_batch_size,
+        use_multicall=multicall,
+        contract_cache=contract_cache,
+        known_eoas=known_eoas,
+        holding_token_ledger=ledgers.get(holding_token.address),
+        lp_token_ledger=ledgers.get(lp_token.address),
+        staked_balances=staked_balances,
+    )
+
+    def add_balances(balances: AddressBalances):
+        address = balances.address
+        if balances.is_contract:
+            # We don't want to include contract addresses here
+            excluded_addresses[address] = 'is_contract'
+            return
+
+        holding_token_balance_wei = balances.holding_token_balance_on_account_wei
+        lp_token_balance_on_account_wei = balances.lp_token_balance_on_account_wei
+        lp_token_balance_on_liquidity_mining_wei = balances.lp_token_balance_on_liquidity_mining_wei
+        lp_token_balance_wei = lp_token_balance_on_account_wei + lp_token_balance_on_liquidity_mining_wei
+        if holding_token_balance_wei + lp_token_balance_on_account_wei + lp_token_balance_wei == 0:
+            # The address is not a holder after all
+            excluded_addresses[address] = 'zero_balance'
+            return
+
+        # Calculate holding token balance on liquidity pool by multiplying LP token balance in user wallet with
+        # the fraction of the holding token one LP token represents.
+        holding_token_balance_on_lp_wei = (
+            lp_token_balance_wei * holding_token_reserve_balance // lp_token_total_supply
+        )
+        token_holder = TokenHolder(
+            address=to_address(address),
+            holding_token_balance_on_account_wei=holding_token_balance_wei,
+            lp_token_balance_on_account_wei=lp_token_balance_on_account_wei,
+            lp_token_balance_on_liquidity_mining_wei=lp_token_balance_on_liquidity_mining_wei,
+            holding_token_balance_on_lp_wei=holding_token_balance_on_lp_wei,
+        )
+        token_holders.append(token_holder)
+
+    remaining_addresses = candidate_addresses
+    if checkpoint is not None:
+        fetched_addresses = AddressSet()
+        for balances in checkpoint.balances:
+            fetched_addresses.add(balances.address)
+            add_balances(balances)
+        remaining_addresses = [address for address in candidate_addresses if address not in fetched_addresses]
+
+    checkpoint_writer = None
+    if checkpoint_file:
+        if checkpoint is not None:
+            checkpoint_writer = SnapshotCheckpoint(checkpoint_file)
+        else:
+            checkpoint_writer = SnapshotCheckpoint.create(
+                checkpoint_file,
+                identity=snapshot_identity,
+                possible_addresses=possible_addresses.sorted(),
             )
-            token_holders.append(token_holder)
+    try:
+        with click.progressbar(
+            length=len(candidate_addresses),
+            label=f'Fetching snapshot balances and filtering out contracts'
+        ) as bar:
+            bar.update(len(candidate_addresses) - len(remaining_addresses))
+            for chunk in balance_fetcher.iter_balances(remaining_addresses, concurrency=concurrency):
+                if checkpoint_writer:
+                    checkpoint_writer.record_balances(chunk)
+                bar.update(len(chunk))
+                for balances in chunk:
+                    add_balances(balances)
+    finally:
+        if checkpoint_writer:
+            checkpoint_writer.close()
 
     echo("Found", hilight(len(token_holders)), f'actual token holders (excluding contracts and zero balances)')
+    log_provider_stats(web3, 'fetching the snapshot balances')
 
     token_holders.sort(key=lambda t: t.total_holding_token_balance_wei, reverse=True)
-    echo_balance_table(
+    return HolderSnapshot(
+        chain_id=holding_token.chain_id,
+        snapshot_block_number=config.snapshot_block_number,
+        first_scanned_block_number=config.first_scanned_block_number,
         holding_token=holding_token,
         lp_token=lp_token,
+        holding_token_reserve_balance_wei=holding_token_reserve_balance,
+        lp_token_total_supply_wei=lp_token_total_supply,
+        token_holders=token_holders,
+        excluded_addresses={
+            to_address(address): reason
+            for (address, reason) in excluded_addresses.items()
+        },
+        extra_tokens=[reward_token],
+    )
+
+
+def load_resumable_checkpoint(checkpoint_file: str, *, identity: Dict[str, Any]) -> Optional[SnapshotCheckpointData]:
+    """Load the checkpoint to resume a snapshot from, refusing to resume a snapshot that differs from identity"""
+    checkpoint = load_checkpoint(checkpoint_file)
+    if checkpoint is None:
+        echo('No checkpoint found at', hilight(checkpoint_file), '- starting from the beginning')
+        return None
+    if checkpoint.identity != identity:
+        differences = [
+            f'{key} is {checkpoint.identity.get(key)!r} instead of {identity.get(key)!r}'
+            for key in identity
+            if key not in checkpoint.identity or checkpoint.identity[key] != identity[key]
+        ]
+        raise click.UsageError(
+            f'Checkpoint file {checkpoint_file!r} is of another snapshot ({", ".join(differences)}), '
+            f'delete it or run without --resume'
+        )
+    echo(
+        'Resuming from checkpoint',
+        hilight(checkpoint_file),
+        'with the balances of',
+        hilight(len(checkpoint.balances)),
+        'addresses'
+    )
+    return checkpoint
+
+
+def allocate_and_save_plan(
+    *,
+    config: Config,
+    snapshot: HolderSnapshot,
+    plan_file: str,
+    start_nonces: Optional[Sequence[int]] = None,
+):
+    """
+    Allocate the rewards between the token holders of the snapshot and save the airdrop plan.
+
+    The transfers are dealt to the rewarder accounts in turns, largest rewards first, so that every account sends
+    about the same number and amount of transfers. start_nonces are the first nonces of the rewarder accounts.
+    """
+    token_holders = snapshot.token_holders
+    echo_balance_table(
+        holding_token=snapshot.holding_token,
+        lp_token=snapshot.lp_token,
         token_holders=token_holders
     )
 
-    total_holding_token_balance_wei = sum(t.total_holding_token_balance_wei for t in token_holders)
+    rewarder_account_addresses = config.rewarder_account_addresses
+    if start_nonces is None:
+        start_nonces = [
+            config.web3.eth.get_transaction_count(rewarder_account_address)
+            for rewarder_account_address in rewarder_account_addresses
+        ]
+    excluded_addresses = dict(snapshot.excluded_addresses)
+    # Rewards under the minimum are redistributed to the rest, and all of the total reward is distributed
+    allocator = RewardAllocator([t.total_holding_token_balance_wei for t in token_holders])
+    rewards_wei = allocator.allocate(
+        total_reward_wei=config.total_reward_amount_wei,
+        min_reward_wei=config.min_reward_wei,
+    )
     airdrop = Airdrop(
         config=config
     )
-    current_nonce = web3.eth.get_transaction_count(config.rewarder_account_address)
-    for token_holder in token_holders:
-        # Calculate proportional reward amount
-        balance_wei = token_holder.total_holding_token_balance_wei
-        reward_amount_wei = config.total_reward_amount_wei * balance_wei // total_holding_token_balance_wei
-        if reward_amount_wei < config.min_reward_wei:
+    next_nonces = list(start_nonces)
+    lane = 0
+    for token_holder, reward_amount_wei in zip(token_holders, rewards_wei):
+        if reward_amount_wei == 0:
             excluded_addresses[token_holder.address] = 'too_low_reward'
             continue
         airdrop.add_transaction(
             to_address=token_holder.address,
             reward_amount_wei=reward_amount_wei,
-            transaction_nonce=current_nonce
+            transaction_nonce=next_nonces[lane],
+            rewarder_account_address=rewarder_account_addresses[lane],
         )
-        current_nonce += 1
+        next_nonces[lane] += 1
+        lane = (lane + 1) % len(rewarder_account_addresses)
+
+    echo_excluded_addresses(excluded_addresses)
+
+    click.echo("")
+    click.echo("Airdrop plan is as follows:")
+    click.echo(airdrop.as_table())
+    click.echo(f"Saving airdrop plan to {plan_file!r}")
+    # Also removes the send journal of any earlier plan in the same file
+    airdrop.save(plan_file)
+
+
+def echo_reward_info(config: Config):
+    echo(
+        'Total reward amount:',
+        hilight(config.reward_token.str_amount(config.total_reward_amount_wei)),
+        hilight(config.reward_token.symbol)
+    )
+    echo(
+        'Minimum reward:',
+        hilight(config.reward_token.str_amount(config.min_reward_wei)),
+        hilight(config.reward_token.symbol)
+    )
+
 
+def echo_excluded_addresses(excluded_addresses: Dict[str, str]):
     echo(
         '\nA total of',
         hilight(len(excluded_addresses)),
@@ -180,12 +701,6 @@ def plan(config_file: str, plan_file: str):
             reason,
         )
 
-    click.echo("")
-    click.echo("Airdrop plan is as follows:")
-    click.echo(airdrop.as_table())
-    click.echo(f"Saving airdrop plan to {plan_file!r}")
-    airdrop.to_file(plan_file)
-
 
 def fetch_liquidity_pool_data(*, config: Config, holding_token: Token, web3: Web3):
     liquidity_pool = web3.eth.contract(
@@ -286,24 +801,113 @@ def fetch_liquidity_pool_data(*, config: Config, holding_token: Token, web3: Web
     return lp_token, liquidity_mining, holding_token_reserve_balance, lp_token_total_supply
 
 
-def fetch_possible_token_holders(config, token: Token) -> Set[str]:
-    possible_addresses = set()
+def get_balance_fetcher(
+    *,
+    config: Config,
+    lp_token: Token,
+    liquidity_mining: Optional[Contract],
+    rpc_batch_size: int,
+    use_multicall: bool,
+    contract_cache: Optional[ContractClassificationCache] = None,
+    known_eoas: Optional[AddressSet] = None,
+    holding_token_ledger: Optional[BalanceLedger] = None,
+    lp_token_ledger: Optional[BalanceLedger] = None,
+    staked_balances: Optional[StakedBalanceIndex] = None,
+) -> BalanceFetcher:
+    kwargs = dict(
+        contract_cache=contract_cache,
+        known_eoas=known_eoas,
+        staked_balances=staked_balances,
+        web3=config.web3,
+        holding_token=config.holding_token,
+        lp_token=lp_token,
+        liquidity_mining=liquidity_mining,
+        block_number=config.snapshot_block_number,
+    )
+    if holding_token_ledger is not None and lp_token_ledger is not None:
+        echo('Using token balances replayed from Transfer events')
+        if rpc_batch_size:
+            return LedgerBalanceFetcher(
+                holding_token_ledger=holding_token_ledger,
+                lp_token_ledger=lp_token_ledger,
+                batch_contract_checks=True,
+                chunk_size=rpc_batch_size,
+                **kwargs
+            )
+        return LedgerBalanceFetcher(
+            holding_token_ledger=holding_token_ledger,
+            lp_token_ledger=lp_token_ledger,
+            **kwargs
+        )
+    if use_multicall:
+        echo('Aggregating balance calls through Multicall2 at', hilight(config.multicall_address))
+        multicall = config.web3.eth.contract(
+            address=config.multicall_address,
+            abi=load_abi('Multicall2'),
+        )
+        if rpc_batch_size:
+            # Contract checks can't go through the aggregator, but they can be batched
+            return MulticallBalanceFetcher(
+                multicall=multicall,
+                batch_contract_checks=True,
+                chunk_size=rpc_batch_size,
+                **kwargs
+            )
+        return MulticallBalanceFetcher(multicall=multicall, **kwargs)
+    if rpc_batch_size:
+        return BatchBalanceFetcher(chunk_size=rpc_batch_size, **kwargs)
+    return BalanceFetcher(**kwargs)
+
+
+def fetch_possible_token_holders(
+    config,
+    token: Token,
+    *,
+    event_cache: Optional[EventLogCache] = None,
+    concurrency: int = 1,
+    transaction_hashes: Optional[Set[bytes]] = None,
+    ledger: Optional[BalanceLedger] = None,
+) -> AddressSet:
+    """
+    Find all addresses that sent or received token between the first scanned block and the snapshot block.
+
+    The logs are streamed batch by batch and the addresses are read directly from the topics, so memory use doesn't
+    grow with the number of Transfer events.
+
+    If transaction_hashes is given, the hashes of the transactions that emitted the events are added to it.
+    If ledger is given, the events are applied to it.
+    """
+    possible_addresses = AddressSet()
+    num_events = 0
     num_blocks = config.snapshot_block_number - config.first_scanned_block_number
     with click.progressbar(
         length=num_blocks,
         label=f'Fetching {token.symbol} Transfer events'
     ) as bar:
-        transfer_events = get_events(
+        update_bar = event_batch_progress_bar_updater(bar, config.first_scanned_block_number)
+        for batch in iter_event_log_batches(
             event=token.contract.events.Transfer,
             from_block=config.first_scanned_block_number,
             to_block=config.snapshot_block_number,
             batch_size=500,
-            on_batch_complete=event_batch_progress_bar_updater(bar, config.first_scanned_block_number)
-        )
-    echo("Found", hilight(len(transfer_events)), f'{token.symbol} Transfer events.')
-    for event in transfer_events:
-        possible_addresses.add(event.args['from'])
-        possible_addresses.add(event.args['to'])
+            adaptive=True,
+            cache=event_cache,
+            concurrency=concurrency,
+        ):
+            for log in batch.logs:
+                possible_addresses.update(get_transfer_log_addresses(log))
+                if transaction_hashes is not None:
+                    transaction_hashes.add(bytes(log['transactionHash']))
+                if ledger is not None:
+                    ledger.apply_transfer_log(log)
+            num_events += len(batch.logs)
+            update_bar(EventBatchComplete(
+                batch_from_block=batch.from_block,
+                batch_to_block=batch.to_block,
+                batch_events=batch.logs,
+                next_batch_size=batch.next_batch_size,
+            ))
+    echo("Found", hilight(num_events), f'{token.symbol} Transfer events.')
     echo(
         "Found",
         hilight(len(possible_addresses)),
@@ -312,29 +916,161 @@ def fetch_possible_token_holders(config, token: Token) -> Set[str]:
     return possible_addresses
 
 
-@retryable()
-def fetch_balance_in_block(*, token: Token, address, block_number: int) -> int:
-    return token.contract.functions.balanceOf(address).call(
-        block_identifier=block_number
+def verify_ledger(*, ledger: BalanceLedger, token: Token, total_supply: int):
+    """Check that the ledger contains all transfers of the token, aborting if it doesn't"""
+    echo(f'Verifying {token.symbol} balances replayed from {ledger.num_transfers} Transfer events')
+    error = None
+    negative_balance_addresses = ledger.get_negative_balance_addresses()
+    if negative_balance_addresses:
+        error = f'{len(negative_balance_addresses)} addresses have negative {token.symbol} balances'
+    elif ledger.total_supply != total_supply:
+        error = (
+            f'the {token.symbol} balances add up to {ledger.total_supply}, '
+            f'but the total supply is {total_supply}'
+        )
+    else:
+        mismatches = verify_ledger_sample(
+            ledger=ledger,
+            token=token,
+            addresses=ledger.get_nonzero_balance_addresses(),
+        )
+        if mismatches:
+            error = f'{len(mismatches)} sampled {token.symbol} balances differ from balanceOf'
+    if error:
+        raise click.ClickException(
+            f'Balances replayed from Transfer events are not correct: {error}. '
+            f'Make sure firstScannedBlockNumber is at or before the deployment of {token.symbol}, '
+            f'or plan without --balances-from-events.'
+        )
+    echo('Replayed balances match the total supply and the sampled balanceOf calls.')
+
+
+def fetch_staked_balances(
+    config,
+    *,
+    liquidity_mining: Contract,
+    lp_token: Token,
+    event_cache: Optional[EventLogCache] = None,
+    concurrency: int = 1,
+) -> StakedBalanceIndex:
+    """Replay the LiquidityMining events of the LP token between the first scanned block and the snapshot block"""
+    index = StakedBalanceIndex(
+        liquidity_mining=liquidity_mining,
+        pool_token_address=lp_token.address,
+        target_block_number=config.snapshot_block_number,
+    )
+    num_blocks = config.snapshot_block_number - config.first_scanned_block_number
+    for event in get_staking_events(liquidity_mining):
+        with click.progressbar(
+            length=num_blocks,
+            label=f'Fetching LiquidityMining {event.event_name} events'
+        ) as bar:
+            update_bar = event_batch_progress_bar_updater(bar, config.first_scanned_block_number)
+            for batch in iter_event_log_batches(
+                event=event,
+                from_block=config.first_scanned_block_number,
+                to_block=config.snapshot_block_number,
+                batch_size=5000,
+                adaptive=True,
+                cache=event_cache,
+                concurrency=concurrency,
+            ):
+                index.apply_logs(batch.logs)
+                update_bar(EventBatchComplete(
+                    batch_from_block=batch.from_block,
+                    batch_to_block=batch.to_block,
+                    batch_events=batch.logs,
+                    next_batch_size=batch.next_batch_size,
+                ))
+    echo(
+        "Found",
+        hilight(index.num_events),
+        f'LiquidityMining events for {lp_token.symbol} and',
+        hilight(len(index.get_nonzero_balance_addresses())),
+        'users with a staked balance.'
     )
+    return index
 
 
-@retryable()
-def fetch_balance_on_liquidity_mining_in_block(
+def verify_staked_balances(
     *,
-    pool_token: Token,
-    address,
-    block_number: int,
-    liquidity_mining: Optional[Contract]
-) -> int:
-    if liquidity_mining is None:
-        return 0
-    amount, debt, accumulated = liquidity_mining.functions.getUserInfo(
-        pool_token.contract.address,
-        address
-    ).call(block_identifier=block_number)
-    #print('lm', address, amount, debt, accumulated)
-    return amount
+    index: StakedBalanceIndex,
+    liquidity_mining: Contract,
+    lp_token: Token,
+    candidate_addresses: Iterable[Address] = (),
+):
+    """
+    Check the replayed staked amounts against the contract, aborting if they don't match.
+
+    The sample is drawn from the candidate addresses and the users in the index, so that users whose stakes were
+    missed entirely can be caught too.
+    """
+    error = None
+    negative_balance_addresses = index.get_negative_balance_addresses()
+    liquidity_mining_balance = fetch_balance_in_block(
+        token=lp_token,
+        address=liquidity_mining.address,
+        block_number=index.target_block_number,
+    )
+    if negative_balance_addresses:
+        error = f'{len(negative_balance_addresses)} users have negative staked amounts'
+    elif index.total != liquidity_mining_balance:
+        error = (
+            f'the staked amounts add up to {index.total}, '
+            f'but LiquidityMining holds {liquidity_mining_balance} {lp_token.symbol}'
+        )
+    else:
+        sample_addresses = AddressSet(candidate_addresses)
+        sample_addresses |= index.get_nonzero_balance_addresses()
+        mismatches = verify_staked_balance_sample(
+            index=index,
+            liquidity_mining=liquidity_mining,
+            pool_token=lp_token,
+            addresses=sample_addresses,
+        )
+        if mismatches:
+            error = f'{len(mismatches)} sampled staked amounts differ from getUserInfo'
+    if error:
+        raise click.ClickException(
+            f'Staked amounts replayed from LiquidityMining events are not correct: {error}. '
+            f'Make sure firstScannedBlockNumber is at or before the deployment of LiquidityMining, '
+            f'or plan without --staked-balances-from-events.'
+        )
+    echo('Replayed staked amounts match the LP balance of LiquidityMining and the sampled getUserInfo calls.')
+
+
+def fetch_transaction_senders(*, web3: Web3, transaction_hashes: Set[bytes], batch_size: int) -> AddressSet:
+    """
+    Fetch the senders of transactions with JSON-RPC batch requests.
+
+    Transaction senders are always EOAs, so they don't need to be checked for contract code.
+    """
+    senders = AddressSet()
+    hashes = sorted(transaction_hashes)
+    with click.progressbar(
+        length=len(hashes),
+        label='Fetching senders of Transfer transactions'
+    ) as bar:
+        for i in range(0, len(hashes), batch_size):
+            chunk = hashes[i:i + batch_size]
+            transactions = make_batch_request(web3, [
+                ('eth_getTransactionByHash', [to_hex(transaction_hash)])
+                for transaction_hash in chunk
+            ])
+            for transaction in transactions:
+                # Failed lookups are fine, the addresses just get their code checked
+                if isinstance(transaction, dict) and transaction.get('from'):
+                    senders.add(transaction['from'])
+            bar.update(len(chunk))
+    return senders
+
+
+def get_transfer_log_addresses(log: LogReceipt) -> Tuple[Address, Address]:
+    """Get the (from, to) addresses of a raw Transfer log as 20-byte keys, without ABI-decoding it"""
+    # Transfer(address indexed from, address indexed to, uint256 value): the addresses are the last 20 bytes
+    # of the 32-byte topics 1 and 2
+    topics = log['topics']
+    return to_address_bytes(topics[1][-20:]), to_address_bytes(topics[2][-20:])
 
 
 def event_batch_progress_bar_updater(bar, from_block: int):
@@ -343,6 +1079,8 @@ def event_batch_progress_bar_updater(bar, from_block: int):
         # Update takes the number of items to advance the bar.
         # Blocks are inclusive, hence + 1
         bar.update(data.batch_to_block - data.batch_from_block + 1)
+        if data.next_batch_size is not None:
+            logger.debug('next event batch size: %s blocks', data.next_batch_size)
     return updater
 
 
@@ -0,0 +1,274 @@
+"""A web3 provider that spreads requests over multiple RPC endpoints"""
+import contextlib
+import json
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+
+import requests
+import requests.adapters
+from web3.providers.base import JSONBaseProvider
+from web3.types import RPCEndpoint, RPCResponse
+
+from .rate_limiting import DEFAULT_MIN_RATE, RateLimiter, is_rate_limit_error, is_rate_limit_error_object
+
+logger = logging.getLogger(__name__)
+
+# Methods whose results depend on what the node has seen of the rewarder accounts' transactions. These always go to
+# the same (pinned) endpoint, so that e.g. a receipt is never looked up from a node that hasn't seen the transaction
+# mined yet, and the confirmation scan never sees a head block that the sending node doesn't have.
+# Lookups by hash of transactions that are already in blocks (e.g. the senders of scanned transfers) are the same on
+# every node, so eth_getTransactionByHash is spread over the pool like the other reads.
+# eth_getLogs is not pinned: the event scans of plan and audit are most of the traffic, and are for blocks that every
+# node has. The confirmation tracker, whose log queries go up to the latest block, pins them with pinned_requests.
+PINNED_METHODS = frozenset([
+    'eth_sendRawTransaction',
+    'eth_sendTransaction',
+    'eth_getTransactionCount',
+    'eth_getTransactionReceipt',
+    'eth_blockNumber',
+])
+# Weight of the latest request in the smoothed latency of an endpoint
+LATENCY_SMOOTHING = 0.2
+
+
+@dataclass
+class RPCEndpointState:
+    uri: str
+    rate_limiter: RateLimiter
+    latency: Optional[float] = None  # Smoothed, in seconds. None until the first successful request.
+    consecutive_failures: int = 0
+    ejected_until: float = 0.0
+    num_requests: int = 0
+    num_failures: int = 0
+
+    def is_healthy(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+
+class PooledHTTPProvider(JSONBaseProvider):
+    """
+    Sends JSON-RPC requests over HTTP to a pool of endpoints of the same chain.
+
+    Read requests are spread over the healthy endpoints at random, weighted by their observed latency, so faster
+    endpoints get more of the traffic. A read request that fails at the transport level (connection error, timeout,
+    HTTP error status) is tried again on another endpoint right away. An endpoint that fails max_failures times in a
+    row is ejected from the pool for ejection_seconds, after which it gets one request to prove itself again.
+
+    Requests for PINNED_METHODS always go to the pinned endpoint (the first one given) and are not tried elsewhere.
+    The pin only moves, for good, if the pinned endpoint gets ejected.
+
+    Every endpoint has its own RateLimiter, which all requests to it go through. HTTP 429 responses, timeouts and
+    JSON-RPC rate limiting errors lower its rate, down to min_request_rate. Rate limiting doesn't count as a failure
+    of the endpoint.
+    With a single endpoint, this is a plain HTTP provider with rate limiting.
+    """
+    def __init__(
+        self,
+        endpoint_uris: Sequence[str],
+        *,
+        session: Optional[requests.Session] = None,
+        timeout: float = 10.0,
+        max_failures: int = 3,
+        ejection_seconds: float = 30.0,
+        min_request_rate: float = DEFAULT_MIN_RATE,
+    ):
+        if not endpoint_uris:
+            raise ValueError('At least one endpoint is required')
+        if len(set(endpoint_uris)) != len(endpoint_uris):
+            raise ValueError('Endpoint URIs contain duplicates')
+        super().__init__()
+        self.endpoints = [
+            RPCEndpointState(uri=uri, rate_limiter=RateLimiter(name=uri, min_rate=min_request_rate))
+            for uri in endpoint_uris
+        ]
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.ejection_seconds = ejection_seconds
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=len(self.endpoints))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self._pinned = self.endpoints[0]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __str__(self):
+        return f'RPC connection pool {", ".join(endpoint.uri for endpoint in self.endpoints)}'
+
+    @property
+    def pinned_endpoint_uri(self) -> str:
+        return self._pinned.uri
+
+    @contextlib.contextmanager
+    def pinned_requests(self):
+        """
+        Send every request that the current thread makes inside the block to the pinned endpoint, e.g. to get logs
+        up to a block number that the pinned endpoint returned
+        """
+        previous = getattr(self._local, 'pinned', False)
+        self._local.pinned = True
+        try:
+            yield
+        finally:
+            self._local.pinned = previous
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        request_data = self.encode_rpc_request(method, params)
+        raw_response = self.post(request_data, pinned=method in PINNED_METHODS)
+        return self.decode_rpc_response(raw_response)
+
+    def post(self, data: bytes, *, pinned: bool = False) -> bytes:
+        """POST a raw JSON-RPC request (or batch) to an endpoint of the pool and return the raw response"""
+        if pinned or getattr(self._local, 'pinned', False):
+            return self._post_to(self._get_pinned_endpoint(), data)
+        tried = []
+        while True:
+            endpoint = self._choose_endpoint(exclude=tried)
+            try:
+                return self._post_to(endpoint, data)
+            except requests.RequestException as e:
+                tried.append(endpoint)
+                if len(tried) >= len(self.endpoints):
+                    raise
+                logger.warning('Request to %s failed (%s), trying another endpoint', endpoint.uri, e)
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        """Get the state of every endpoint, e.g. for logging"""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    'uri': endpoint.uri,
+                    'latency': endpoint.latency,
+                    'healthy': endpoint.is_healthy(now),
+                    'pinned': endpoint is self._pinned,
+                    'rate': endpoint.rate_limiter.rate,
+                    'max_rate': endpoint.rate_limiter.max_rate,
+                    'requests': endpoint.num_requests,
+                    'failures': endpoint.num_failures,
+                }
+                for endpoint in self.endpoints
+            ]
+
+    def log_stats(self, stage: str):
+        """
+        Log the request rate and counts of every endpoint, e.g. after a stage of a long run. Endpoints that are still
+        slowed down by rate limiting are logged as warnings, the rest as info.
+        """
+        for stats in self.get_stats():
+            logger.log(
+                logging.WARNING if stats['rate'] < stats['max_rate'] else logging.INFO,
+                'RPC endpoint %s after %s: %.1f requests/s, %s requests, %s failures, latency %s%s%s',
+                stats['uri'],
+                stage,
+                stats['rate'],
+                stats['requests'],
+                stats['failures'],
+                f"{stats['latency']:.3f}s" if stats['latency'] is not None else 'unknown',
+                '' if stats['healthy'] else ', ejected',
+                ', pinned' if stats['pinned'] else '',
+            )
+
+    def _post_to(self, endpoint: RPCEndpointState, data: bytes) -> bytes:
+        endpoint.rate_limiter.acquire()
+        start = time.monotonic()
+        try:
+            response = self.session.post(
+                endpoint.uri,
+                data=data,
+                headers={'Content-Type': 'application/json'},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+        except requests.RequestException as e:
+            if is_rate_limit_error(e):
+                endpoint.rate_limiter.throttled()
+            else:
+                if isinstance(e, requests.exceptions.Timeout):
+                    endpoint.rate_limiter.throttled()
+                self._record_failure(endpoint)
+            raise
+        self._record_success(endpoint, time.monotonic() - start)
+        # Only parsed here if there are errors in it, which is rare
+        if b'"error"' in response.content and is_rate_limited_response(response.content):
+            endpoint.rate_limiter.throttled()
+        return response.content
+
+    def _choose_endpoint(self, *, exclude: Sequence[RPCEndpointState] = ()) -> RPCEndpointState:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+            healthy = [endpoint for endpoint in candidates if endpoint.is_healthy(now)]
+            if not healthy:
+                # Better to try the one that comes back first than to fail without trying
+                return min(candidates, key=lambda endpoint: endpoint.ejected_until)
+            latencies = [endpoint.latency for endpoint in healthy if endpoint.latency is not None]
+            # Endpoints without measurements are treated like the fastest one, so that they get measured soon
+            best_latency = min(latencies) if latencies else 1.0
+            weights = [
+                1 / max(endpoint.latency if endpoint.latency is not None else best_latency, 0.001)
+                for endpoint in healthy
+            ]
+        return random.choices(healthy, weights=weights)[0]
+
+    def _get_pinned_endpoint(self) -> RPCEndpointState:
+        now = time.monotonic()
+        with self._lock:
+            if not self._pinned.is_healthy(now):
+                healthy = [endpoint for endpoint in self.endpoints if endpoint.is_healthy(now)]
+                if healthy:
+                    previous = self._pinned
+                    self._pinned = min(
+                        healthy,
+                        key=lambda endpoint: endpoint.latency if endpoint.latency is not None else float('inf')
+                    )
+                    logger.warning(
+                        'Pinned endpoint %s is unhealthy, pinning %s instead',
+                        previous.uri,
+                        self._pinned.uri,
+                    )
+            return self._pinned
+
+    def _record_success(self, endpoint: RPCEndpointState, latency: float):
+        with self._lock:
+            endpoint.num_requests += 1
+            endpoint.consecutive_failures = 0
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency += LATENCY_SMOOTHING * (latency - endpoint.latency)
+
+    def _record_failure(self, endpoint: RPCEndpointState):
+        with self._lock:
+            endpoint.num_requests += 1
+            endpoint.num_failures += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.max_failures:
+                logger.warning(
+                    'Ejecting endpoint %s for %s seconds after %s failures in a row',
+                    endpoint.uri,
+                    self.ejection_seconds,
+                    endpoint.consecutive_failures,
+                )
+                endpoint.ejected_until = time.monotonic() + self.ejection_seconds
+                # One more failure after the ejection ends puts it back out
+                endpoint.consecutive_failures = self.max_failures - 1
+
+
+def is_rate_limited_response(raw_response: bytes) -> bool:
+    """Is there a JSON-RPC rate limiting error in the raw response (or batch response)?"""
+    try:
+        response = json.loads(raw_response)
+    except ValueError:
+        return False
+    responses = response if isinstance(response, list) else [response]
+    return any(
+        isinstance(r, dict) and r.get('error') is not None and is_rate_limit_error_object(r['error'])
+        for r in responses
+    )
@@ -0,0 +1,207 @@
+"""Adapting the request rate to what the RPC node allows, and telling errors worth retrying from fatal ones"""
+import collections
+import logging
+import threading
+import time
+from typing import Any, Optional
+
+import requests
+from web3.exceptions import (
+    ABIFunctionNotFound,
+    BadFunctionCallOutput,
+    ContractLogicError,
+    InvalidAddress,
+    MismatchedABI,
+    NoABIFunctionsFound,
+    ValidationError,
+)
+
+logger = logging.getLogger(__name__)
+
+# The rate limiter never goes below this many requests per second, by default. Low enough to wait out per-minute quotas.
+DEFAULT_MIN_RATE = 0.1
+# JSON-RPC error code for "Limit exceeded" (EIP-1474)
+LIMIT_EXCEEDED_ERROR_CODE = -32005
+# Substrings of error messages that nodes use when they rate limit the client
+RATE_LIMIT_ERROR_MESSAGES = (
+    'rate limit',
+    'too many requests',
+    'request limit',
+    'rate exceeded',
+    'limit exceeded',
+)
+# ...except when the limit is on the size of the response (e.g. eth_getLogs for too many blocks)
+RESPONSE_TOO_LARGE_ERROR_MESSAGES = (
+    'more than',
+    'results',
+    'response size',
+    'block range',
+    'too large',
+)
+# Errors that will be the same however many times the request is made
+FATAL_ERROR_TYPES = (
+    TypeError,
+    AttributeError,
+    KeyError,
+    NotImplementedError,
+    ContractLogicError,
+    BadFunctionCallOutput,
+    ValidationError,
+    InvalidAddress,
+    MismatchedABI,
+    ABIFunctionNotFound,
+    NoABIFunctionsFound,
+)
+FATAL_ERROR_CODES = (
+    -32601,  # Method not found
+    -32602,  # Invalid params
+    3,  # Execution reverted
+)
+FATAL_ERROR_MESSAGES = (
+    'execution reverted',
+    'method not found',
+    'invalid argument',
+    'nonce too low',
+    'insufficient funds',
+    'intrinsic gas too low',
+    'already known',
+)
+
+
+class RateLimiter:
+    """
+    Token bucket whose rate adapts to the node, AIMD style (like TCP congestion control).
+
+    Every request takes a token, waiting for one if there are none. The rate grows by additive_increase requests per
+    second every second, up to max_rate. When the node rate limits a request (see throttled), the rate is cut to
+    multiplicative_decrease times the rate of the last second, down to min_rate. Rate limiting responses to
+    requests that were already in flight are only counted once per decrease_interval.
+
+    Safe to use from multiple threads.
+    """
+    def __init__(
+        self,
+        *,
+        name: str = '',
+        # High enough not to slow anything down until the node starts rate limiting
+        initial_rate: float = 1000.0,
+        min_rate: float = DEFAULT_MIN_RATE,
+        max_rate: float = 1000.0,
+        additive_increase: float = 1.0,
+        multiplicative_decrease: float = 0.5,
+        burst: float = 10.0,
+        decrease_interval: float = 0.5,
+    ):
+        if not 0 < min_rate <= initial_rate <= max_rate:
+            raise ValueError('Rates must be 0 < min_rate <= initial_rate <= max_rate')
+        self.name = name
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.additive_increase = additive_increase
+        self.multiplicative_decrease = multiplicative_decrease
+        self.burst = burst
+        self.decrease_interval = decrease_interval
+        self._rate = initial_rate
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._decreased_at = float('-inf')
+        self._recent_requests = collections.deque()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'<RateLimiter {self.name} at {self.rate:.1f} requests/s>'
+
+    @property
+    def rate(self) -> float:
+        """The current rate, in requests per second"""
+        with self._lock:
+            self._update(time.monotonic())
+            return self._rate
+
+    def acquire(self):
+        """Wait until a request can be made"""
+        with self._lock:
+            now = time.monotonic()
+            self._update(now)
+            self._recent_requests.append(now)
+            # Tokens can go negative, which reserves the next ones for the requests already waiting
+            self._tokens -= 1
+            wait_time = -self._tokens / self._rate if self._tokens < 0 else 0.0
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def throttled(self):
+        """Slow down after the node rate limited a request"""
+        with self._lock:
+            now = time.monotonic()
+            self._update(now)
+            if now - self._decreased_at < self.decrease_interval:
+                return
+            while self._recent_requests and self._recent_requests[0] < now - 1.0:
+                self._recent_requests.popleft()
+            # The requests of the last second were too many, however high the rate was allowed to be
+            current_rate = min(self._rate, max(len(self._recent_requests), self.min_rate))
+            self._rate = max(self.min_rate, current_rate * self.multiplicative_decrease)
+            self._tokens = min(self._tokens, 0.0)
+            self._decreased_at = now
+            rate = self._rate
+        logger.warning('Rate limited by %s, lowering the request rate to %.1f requests/s', self.name, rate)
+
+    def _update(self, now: float):
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self._tokens = min(self._tokens + elapsed * self._rate, self.burst)
+        self._rate = min(self._rate + elapsed * self.additive_increase, self.max_rate)
+
+
+def get_error_object(e: Exception) -> Optional[Any]:
+    """Get the JSON-RPC error object (or message) of an error returned by the node, if e is one"""
+    # JSONRPCError from batch requests
+    error = getattr(e, 'error', None)
+    if error is not None:
+        return error
+    # web3 raises ValueError(error object) for error responses
+    if isinstance(e, ValueError) and e.args:
+        return e.args[0]
+    return None
+
+
+def is_rate_limit_error_object(error: Any) -> bool:
+    if isinstance(error, dict):
+        code = error.get('code')
+        message = str(error.get('message', '')).lower()
+    else:
+        code = None
+        message = str(error).lower()
+    if any(m in message for m in RESPONSE_TOO_LARGE_ERROR_MESSAGES):
+        return False
+    return code == LIMIT_EXCEEDED_ERROR_CODE or any(m in message for m in RATE_LIMIT_ERROR_MESSAGES)
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    """Did the node refuse the request because of rate limiting?"""
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code == 429
+    error = get_error_object(e)
+    return error is not None and is_rate_limit_error_object(error)
+
+
+def is_throttling_error(e: Exception) -> bool:
+    """Is the node overwhelmed by the requests? Handled by lowering the request rate instead of backing off."""
+    return isinstance(e, requests.exceptions.Timeout) or is_rate_limit_error(e)
+
+
+def is_retryable_error(e: Exception) -> bool:
+    """Could the request succeed if made again? Programming errors, reverts and rejected transactions won't."""
+    if isinstance(e, FATAL_ERROR_TYPES):
+        return False
+    error = get_error_object(e)
+    if isinstance(error, dict):
+        if error.get('code') in FATAL_ERROR_CODES:
+            return False
+        error = error.get('message', '')
+    if error is not None:
+        message = str(error).lower()
+        if any(m in message for m in FATAL_ERROR_MESSAGES):
+            return False
+    return True
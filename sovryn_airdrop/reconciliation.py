@@ -0,0 +1,184 @@
+"""Reconciling the Transfers found on the chain with the rows of an airdrop plan"""
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from eth_typing import Address
+from eth_utils import to_hex
+from hexbytes import HexBytes
+from web3.types import LogReceipt
+
+from .addresses import to_address_bytes, to_hex_address
+from .airdrop import AirdropTransaction
+
+ISSUE_MISSING = 'missing'
+ISSUE_WRONG_AMOUNT = 'wrong_amount'
+ISSUE_WRONG_TRANSACTION_HASH = 'wrong_transaction_hash'
+ISSUE_WRONG_NONCE = 'wrong_nonce'
+ISSUE_DUPLICATE = 'duplicate'
+ISSUE_UNEXPECTED = 'unexpected'
+
+
+@dataclass
+class TransferRecord:
+    """A Transfer log of the reward token, parsed without ABI-decoding"""
+    from_address: Address
+    to_address: Address
+    amount_wei: int
+    transaction_hash: str
+    block_number: int
+    log_index: int
+
+    @classmethod
+    def from_log(cls, log: LogReceipt) -> 'TransferRecord':
+        # Transfer(address indexed from, address indexed to, uint256 value)
+        topics = log['topics']
+        return cls(
+            from_address=to_address_bytes(topics[1][-20:]),
+            to_address=to_address_bytes(topics[2][-20:]),
+            amount_wei=int.from_bytes(HexBytes(log['data'])[:32], 'big'),
+            transaction_hash=to_hex(HexBytes(log['transactionHash'])),
+            block_number=log['blockNumber'],
+            log_index=log['logIndex'],
+        )
+
+
+@dataclass
+class AuditIssue:
+    kind: str
+    message: str
+    transaction: Optional[AirdropTransaction] = None  # The plan row, if any
+    transfer: Optional[TransferRecord] = None  # The Transfer found on the chain, if any
+
+
+@dataclass
+class AuditResult:
+    num_rows: int
+    num_transfers: int
+    num_matched: int
+    issues: List[AuditIssue]
+
+
+def reconcile(
+    *,
+    transactions: Sequence[AirdropTransaction],
+    transfers: Iterable[TransferRecord],
+    transaction_nonces: Optional[Dict[str, int]] = None,
+) -> AuditResult:
+    """
+    Match every plan row with a Transfer from its rewarder account to its recipient, and report the differences.
+
+    Transfers in the transaction that the plan row has are matched first. The rest are matched by sender, recipient
+    and amount, or only by sender and recipient (wrong amount). Transfers left over go to plan recipients (duplicate)
+    or to addresses that aren't in the plan (unexpected). If transaction_nonces ({transaction hash: nonce}) are given,
+    the nonces of the matched transactions are checked too.
+
+    Rows sent in a Disperse batch are matched like single transfers: disperseTokenSimple emits a Transfer from the
+    rewarder account to every recipient of the batch, all in the batch's transaction.
+    """
+    transfers = sorted(transfers, key=lambda t: (t.block_number, t.log_index))
+    transaction_hashes = [normalize_hash(t.transaction_hash) for t in transactions]
+    unmatched_by_amount = defaultdict(list)
+    for transfer in transfers:
+        unmatched_by_amount[transfer.from_address, transfer.to_address, transfer.amount_wei].append(transfer)
+    matches: List[Optional[TransferRecord]] = [None] * len(transactions)
+    keys = [
+        (to_address_bytes(t.rewarder_account_address), to_address_bytes(t.to_address), t.reward_amount_wei)
+        for t in transactions
+    ]
+    issues = []
+
+    # Exact matches first, so that rows matched by amount can't take the Transfers of others
+    for i, key in enumerate(keys):
+        candidates = unmatched_by_amount.get(key)
+        if not candidates or transaction_hashes[i] is None:
+            continue
+        for j, transfer in enumerate(candidates):
+            if normalize_hash(transfer.transaction_hash) == transaction_hashes[i]:
+                matches[i] = candidates.pop(j)
+                break
+
+    for i, key in enumerate(keys):
+        if matches[i] is not None:
+            continue
+        candidates = unmatched_by_amount.get(key)
+        if not candidates:
+            continue
+        matches[i] = candidates.pop(0)
+        issues.append(AuditIssue(
+            kind=ISSUE_WRONG_TRANSACTION_HASH,
+            message=(
+                f'Transfer found in transaction {matches[i].transaction_hash}, but the plan has '
+                f'{transactions[i].transaction_hash or "no transaction hash"}'
+            ),
+            transaction=transactions[i],
+            transfer=matches[i],
+        ))
+
+    unmatched_by_recipient = defaultdict(list)
+    for transfer_list in unmatched_by_amount.values():
+        for transfer in transfer_list:
+            unmatched_by_recipient[transfer.from_address, transfer.to_address].append(transfer)
+    for i, (from_address, to_address, amount_wei) in enumerate(keys):
+        if matches[i] is not None:
+            continue
+        candidates = unmatched_by_recipient.get((from_address, to_address))
+        if candidates:
+            transfer = candidates.pop(0)
+            issues.append(AuditIssue(
+                kind=ISSUE_WRONG_AMOUNT,
+                message=f'Transferred {transfer.amount_wei} wei instead of {amount_wei} wei',
+                transaction=transactions[i],
+                transfer=transfer,
+            ))
+        else:
+            issues.append(AuditIssue(
+                kind=ISSUE_MISSING,
+                message='No Transfer found',
+                transaction=transactions[i],
+            ))
+
+    if transaction_nonces is not None:
+        for transaction, transfer in zip(transactions, matches):
+            if transfer is None:
+                continue
+            nonce = transaction_nonces.get(normalize_hash(transfer.transaction_hash))
+            if nonce is not None and nonce != transaction.transaction_nonce:
+                issues.append(AuditIssue(
+                    kind=ISSUE_WRONG_NONCE,
+                    message=f'Sent with nonce {nonce} instead of {transaction.transaction_nonce}',
+                    transaction=transaction,
+                    transfer=transfer,
+                ))
+
+    recipients = set(to_address for (_, to_address, _) in keys)
+    for transfer_list in unmatched_by_recipient.values():
+        for transfer in transfer_list:
+            if transfer.to_address in recipients:
+                issues.append(AuditIssue(
+                    kind=ISSUE_DUPLICATE,
+                    message=f'Extra Transfer of {transfer.amount_wei} wei to {to_hex_address(transfer.to_address)}',
+                    transfer=transfer,
+                ))
+            else:
+                issues.append(AuditIssue(
+                    kind=ISSUE_UNEXPECTED,
+                    message=(
+                        f'Transfer of {transfer.amount_wei} wei to {to_hex_address(transfer.to_address)}, '
+                        f'which is not in the plan'
+                    ),
+                    transfer=transfer,
+                ))
+
+    return AuditResult(
+        num_rows=len(transactions),
+        num_transfers=len(transfers),
+        num_matched=sum(1 for transfer in matches if transfer is not None),
+        issues=issues,
+    )
+
+
+def normalize_hash(transaction_hash: Optional[str]) -> Optional[str]:
+    if not transaction_hash:
+        return None
+    return to_hex(HexBytes(transaction_hash))
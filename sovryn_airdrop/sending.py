@@ -1,51 +1,120 @@
+import itertools
 import os
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Sequence
 
 import click
 
 from eth_account import Account
 from eth_account.signers.local import LocalAccount
+from eth_typing import ChecksumAddress
+from eth_utils import to_hex
+from web3 import Web3
 
-from .airdrop import Airdrop, AirdropTransaction
+from .airdrop import Airdrop, AirdropBatch, SendUnit, get_disperse_batch_size
 from .cli_base import cli, config_file_option, echo, echo_token_info, hilight
+from .confirmations import ConfirmationTracker, get_confirmation_start_block, wait_for_confirmations
 from .config import Config
+from .journal import JOURNAL_STATUS_MINED, JOURNAL_STATUS_SENT, SendJournal, get_journal_file_path
+from .signing import (
+    DEFAULT_TRANSFER_GAS_LIMIT,
+    SignedTransaction,
+    SignedTransactionKey,
+    get_gas_price,
+    get_signed_transactions_file_path,
+    load_signed_transactions,
+    save_signed_transactions,
+    sign_transactions,
+)
 from .tokens import load_token
-from .web3_utils import get_web3, set_web3_account
+from .web3_utils import get_web3, log_provider_stats, set_web3_accounts
+
+RECEIPT_POLL_INTERVAL = 2.0
+RECEIPT_TIMEOUT = 600.0
 
 
 @cli.command()
 @config_file_option
 @click.option('-p', '--plan-file', required=True, metavar='PATH', help='Path to read the plan file from')
-def send(config_file: str, plan_file: str):
+@click.option(
+    '--max-pending',
+    type=click.IntRange(min=1),
+    default=4,  # conservative default, for RSK
+    metavar='N',
+    help='Maximum number of sent transactions waiting to be mined at a time'
+)
+@click.option(
+    '--presign',
+    is_flag=True,
+    default=False,
+    help=(
+        'Sign all remaining transactions up front with a fixed gas limit and gas price, store them next to the '
+        'plan file, and only broadcast them when sending'
+    )
+)
+@click.option(
+    '--gas-limit',
+    type=click.IntRange(min=21000),
+    default=DEFAULT_TRANSFER_GAS_LIMIT,
+    metavar='GAS',
+    help='Gas limit of the pre-signed transfers'
+)
+@click.option(
+    '--disperse',
+    is_flag=True,
+    default=False,
+    help=(
+        'Send the remaining transfers in batches through the Disperse contract at disperseAddress from the config, '
+        'one transaction per batch'
+    )
+)
+@click.option(
+    '--batch-size',
+    type=click.IntRange(min=0),
+    default=0,
+    metavar='N',
+    help='Number of recipients per Disperse batch (0 to fit the batches in half of the block gas limit)'
+)
+def send(
+    config_file: str,
+    plan_file: str,
+    max_pending: int,
+    presign: bool,
+    gas_limit: int,
+    disperse: bool,
+    batch_size: int,
+):
     config = Config.from_file(config_file)
     echo('Config:', config)
+    if disperse and not config.disperse_address:
+        raise click.UsageError('--disperse requires disperseAddress to be set in the config')
     airdrop = Airdrop.from_file(
         file_path=plan_file,
         config=config
     )
-    echo("Rewarder account", config.rewarder_account_address)
-    echo("Reward token balance:", config.reward_token.formatted_amount(
-        config.reward_token.contract.functions.balanceOf(config.rewarder_account_address).call()
-    ))
-    echo("Next nonce:", config.web3.eth.get_transaction_count(config.rewarder_account_address))
+    web3 = config.web3
+    # Every rewarder account (lane) sends its own rows of the plan with its own nonces
+    rewarder_account_addresses = list(airdrop.get_lanes(airdrop.transactions))
+    for rewarder_account_address in rewarder_account_addresses:
+        echo("Rewarder account", rewarder_account_address)
+        echo("  Reward token balance:", config.reward_token.formatted_amount(
+            config.reward_token.contract.functions.balanceOf(rewarder_account_address).call()
+        ))
+        echo("  Next nonce:", web3.eth.get_transaction_count(rewarder_account_address))
     echo("\nPreparing to send Airdrop:")
     echo(airdrop.as_table())
     click.confirm('Execute airdrop?', abort=True)
-    private_key = os.getenv('REWARDER_PRIVATE_KEY')
-    if not private_key:
-        private_key = click.prompt(
-            f'Enter private key for rewarder address {config.rewarder_account_address} (input hidden)',
-            hide_input=True
-        )
-    rewarder_account: LocalAccount = Account.from_key(private_key)
-    if rewarder_account.address != config.rewarder_account_address:
-        raise click.Abort(
-            f"Address from private key {rewarder_account.address} does not match configured address "
-            f"{config.rewarder_account_address}."
-        )
-
-    web3 = config.web3
-    set_web3_account(web3=web3, account=rewarder_account)
+    # Verifying sent transactions needs no keys, so only the accounts with something left to send are asked for
+    rewarder_accounts = get_rewarder_accounts(
+        rewarder_account_addresses,
+        required_addresses=[
+            rewarder_account_address
+            for (rewarder_account_address, lane_transactions) in airdrop.get_lanes(airdrop.unsent_transactions).items()
+            if lane_transactions
+        ],
+    )
+    if rewarder_accounts:
+        set_web3_accounts(web3=web3, accounts=list(rewarder_accounts.values()))
 
     backup_file_path = plan_file + '.bak'
     echo(f'Backing up airdrop plan file to {backup_file_path}')
@@ -56,55 +125,325 @@ def send(config_file: str, plan_file: str):
             hilight(len(airdrop.sent_transactions)),
             'transactions have already been sent, verifying.'
         )
-        for transaction in airdrop.sent_transactions:
-            echo('Verifying', transaction.as_row())
-            transaction.verify()
+        sent_units = airdrop.group_into_units(airdrop.sent_transactions)
+        tracker = ConfirmationTracker(
+            airdrop=airdrop,
+            rewarder_account_addresses=rewarder_account_addresses,
+            from_block=get_confirmation_start_block(airdrop, sent_units),
+        )
+        for unit in sent_units:
+            tracker.add(unit)
+        while tracker.num_outstanding:
+            for unit in wait_for_confirmations(tracker, poll_interval=RECEIPT_POLL_INTERVAL, timeout=RECEIPT_TIMEOUT):
+                echo('Verified', unit.as_row())
 
-    num_total = len(airdrop.unsent_transactions)
-    echo(
-        'Sending',
-        hilight(num_total),
-        'transactions...'
-    )
-    max_pending = 4  # hardcoded for now, for RSK
-    pending = []
-    for i, transaction in enumerate(airdrop.unsent_transactions, start=1):
-        if len(pending) >= max_pending:
-            verify_pending_transactions(pending)
+    check_lane_balances(airdrop)
 
+    unbatched_transactions = [t for t in airdrop.unsent_transactions if t.batch_number is None]
+    if disperse and unbatched_transactions:
+        start_nonces = {}
+        for rewarder_account_address, lane_transactions in airdrop.get_lanes(unbatched_transactions).items():
+            if not lane_transactions:
+                continue
+            next_nonce = check_next_nonce(
+                web3=web3,
+                rewarder_account_address=rewarder_account_address,
+                expected_nonce=min(t.transaction_nonce for t in lane_transactions),
+            )
+            # The first nonce is reserved for approving the Disperse contract, if needed
+            needs_approval = (
+                get_disperse_allowance(airdrop, rewarder_account_address) <
+                sum(t.reward_amount_wei for t in lane_transactions)
+            )
+            start_nonces[rewarder_account_address] = next_nonce + 1 if needs_approval else next_nonce
+        if not batch_size:
+            batch_size = get_disperse_batch_size(web3)
+        batches = airdrop.assign_batches(batch_size=batch_size, start_nonces=start_nonces)
         echo(
-            f'Sending ({i}/{num_total}):',
-            hilight(config.reward_token.formatted_amount(transaction.reward_amount_wei)),
-            'to',
-            hilight(transaction.to_address),
-            'with nonce',
-            hilight(transaction.transaction_nonce),
+            'Grouped the remaining transfers into',
+            hilight(len(batches)),
+            'Disperse batches of up to',
+            hilight(batch_size),
+            'recipients, saving them to the plan file.'
         )
-        transaction.send()
-        pending.append(transaction)
-        echo('Sent', transaction.transaction_hash)
-        airdrop.to_file(plan_file)
+        airdrop.save(plan_file)
 
-    verify_pending_transactions(pending)
+    lanes = {
+        rewarder_account_address: airdrop.group_into_units(lane_transactions)
+        for (rewarder_account_address, lane_transactions) in airdrop.get_lanes(airdrop.unsent_transactions).items()
+        if lane_transactions
+    }
+    num_total = sum(len(units) for units in lanes.values())
+    for rewarder_account_address, units in lanes.items():
+        ensure_disperse_allowance(airdrop, units)
+        check_next_nonce(
+            web3=web3,
+            rewarder_account_address=rewarder_account_address,
+            expected_nonce=units[0].transaction_nonce,
+        )
+    signed_transactions = None
+    if presign and lanes:
+        signed_transactions_file = get_signed_transactions_file_path(plan_file)
+        gas_price_wei = get_gas_price(web3)
+        echo(
+            'Signing',
+            hilight(num_total),
+            'transactions with gas limit',
+            hilight(gas_limit),
+            'and gas price',
+            hilight(gas_price_wei),
+            'wei'
+        )
+        signed_transactions = sign_transactions(
+            itertools.chain.from_iterable(lanes.values()),
+            accounts=rewarder_accounts,
+            gas_limit=gas_limit,
+            gas_price_wei=gas_price_wei,
+            chain_id=web3.eth.chain_id,
+            existing=load_signed_transactions(signed_transactions_file),
+        )
+        echo('Saving signed transactions to', signed_transactions_file)
+        save_signed_transactions(signed_transactions_file, signed_transactions)
+
+    echo(
+        'Sending',
+        hilight(num_total),
+        'transactions from',
+        hilight(len(lanes)),
+        'rewarder accounts with up to',
+        hilight(max_pending),
+        'pending at a time per account...'
+    )
+    try:
+        with SendJournal(get_journal_file_path(plan_file)) as journal:
+            send_lanes(
+                lanes=lanes,
+                journal=journal,
+                max_pending=max_pending,
+                signed_transactions=signed_transactions,
+            )
+    finally:
+        echo('Compacting the send journal into', plan_file)
+        airdrop.save(plan_file)
+        log_provider_stats(web3, 'sending')
     if num_total:
         click.echo("Airdrop sent")
     else:
         click.echo("Airdrop already sent successfully!")
 
 
-def verify_pending_transactions(pending: List[AirdropTransaction]):
-    if not pending:
+def get_rewarder_accounts(
+    rewarder_account_addresses: Sequence[ChecksumAddress],
+    *,
+    required_addresses: Optional[Sequence[ChecksumAddress]] = None,
+) -> Dict[str, LocalAccount]:
+    """
+    Get the accounts of the required addresses (by default all rewarder addresses), from the comma-separated private
+    keys in REWARDER_PRIVATE_KEY, or by prompting for the missing ones. REWARDER_PRIVATE_KEY may contain keys of any
+    of the rewarder addresses.
+    """
+    if required_addresses is None:
+        required_addresses = rewarder_account_addresses
+    accounts = {}
+    for private_key in os.getenv('REWARDER_PRIVATE_KEY', '').split(','):
+        if not private_key.strip():
+            continue
+        account: LocalAccount = Account.from_key(private_key.strip())
+        if account.address not in rewarder_account_addresses:
+            raise click.Abort(
+                f"Address from private key {account.address} is not one of the rewarder addresses "
+                f"{', '.join(rewarder_account_addresses)}."
+            )
+        accounts[account.address] = account
+    for rewarder_account_address in required_addresses:
+        if rewarder_account_address in accounts:
+            continue
+        private_key = click.prompt(
+            f'Enter private key for rewarder address {rewarder_account_address} (input hidden)',
+            hide_input=True
+        )
+        account: LocalAccount = Account.from_key(private_key)
+        if account.address != rewarder_account_address:
+            raise click.Abort(
+                f"Address from private key {account.address} does not match configured address "
+                f"{rewarder_account_address}."
+            )
+        accounts[account.address] = account
+    return {address: accounts[address] for address in required_addresses}
+
+
+def check_lane_balances(airdrop: Airdrop):
+    """Check that every rewarder account has enough reward tokens for its unsent transactions, before sending any"""
+    reward_token = airdrop.reward_token
+    errors = []
+    for rewarder_account_address, lane_transactions in airdrop.get_lanes(airdrop.unsent_transactions).items():
+        required_wei = sum(t.reward_amount_wei for t in lane_transactions)
+        if not required_wei:
+            continue
+        balance_wei = reward_token.contract.functions.balanceOf(rewarder_account_address).call()
+        if balance_wei < required_wei:
+            errors.append(
+                f'{rewarder_account_address} has {reward_token.formatted_amount(balance_wei)} but needs '
+                f'{reward_token.formatted_amount(required_wei)} for {len(lane_transactions)} transfers'
+            )
+    if errors:
+        raise click.ClickException('Not enough reward tokens:\n' + '\n'.join(errors))
+
+
+def check_next_nonce(*, web3: Web3, rewarder_account_address: str, expected_nonce: int) -> int:
+    """Check that the next nonce of the rewarder account is the expected one, and return it"""
+    next_nonce = web3.eth.get_transaction_count(rewarder_account_address)
+    if next_nonce != expected_nonce:
+        raise click.ClickException(
+            f'The next nonce of the rewarder account {rewarder_account_address} is {next_nonce}, but the next '
+            f'transaction in the plan has nonce {expected_nonce}'
+        )
+    return next_nonce
+
+
+def get_disperse_allowance(airdrop: Airdrop, rewarder_account_address: str) -> int:
+    return airdrop.reward_token.contract.functions.allowance(
+        rewarder_account_address,
+        airdrop.config.disperse_address,
+    ).call()
+
+
+def ensure_disperse_allowance(airdrop: Airdrop, units: Sequence[SendUnit]):
+    """
+    Approve the Disperse contract to transfer the reward tokens of the unsent batches of a rewarder account, if it
+    can't already. The approval is sent with the nonce reserved for it, right before the first unsent batch.
+    """
+    batches = [unit for unit in units if isinstance(unit, AirdropBatch)]
+    if not batches:
+        return
+    config = airdrop.config
+    rewarder_account_address = units[0].rewarder_account_address
+    required_allowance = sum(batch.reward_amount_wei for batch in batches)
+    allowance = get_disperse_allowance(airdrop, rewarder_account_address)
+    if allowance >= required_allowance:
         return
+    approval_nonce = units[0].transaction_nonce - 1
+    next_nonce = config.web3.eth.get_transaction_count(rewarder_account_address)
+    if next_nonce != approval_nonce:
+        raise click.ClickException(
+            f'The Disperse contract at {config.disperse_address} is only allowed to transfer {allowance} wei '
+            f'from {rewarder_account_address}, but {required_allowance} wei are needed, and no nonce is reserved '
+            f'for approving it. Approve it manually.'
+        )
     echo(
-        'verifying',
-        hilight(len(pending)),
-        'pending transactions...'
+        'Approving Disperse at',
+        hilight(config.disperse_address),
+        'to transfer',
+        hilight(airdrop.reward_token.formatted_amount(required_allowance)),
+        'from',
+        hilight(rewarder_account_address),
+        'with nonce',
+        hilight(approval_nonce),
+    )
+    tx_hash = airdrop.reward_token.contract.functions.approve(
+        config.disperse_address,
+        required_allowance,
+    ).transact({
+        'from': rewarder_account_address,
+        'nonce': approval_nonce,
+    })
+    receipt = config.web3.eth.wait_for_transaction_receipt(tx_hash, timeout=RECEIPT_TIMEOUT)
+    if not receipt.status:
+        raise click.ClickException(f'Approving Disperse failed: {to_hex(tx_hash)}')
+    echo('Approved', to_hex(tx_hash))
+
+
+def send_lanes(
+    *,
+    lanes: Dict[str, Sequence[SendUnit]],
+    journal: SendJournal,
+    max_pending: int,
+    signed_transactions: Optional[Dict[SignedTransactionKey, SignedTransaction]] = None,
+):
+    """
+    Send the transactions of every rewarder account concurrently, each with its own window of max_pending
+    transactions. Pending transaction limits of nodes apply per sender, so the lanes don't slow each other down.
+    """
+    with ThreadPoolExecutor(max_workers=max(len(lanes), 1), thread_name_prefix='lanes') as executor:
+        futures = [
+            executor.submit(
+                send_transactions,
+                transactions=units,
+                journal=journal,
+                max_pending=max_pending,
+                signed_transactions=signed_transactions,
+            )
+            for units in lanes.values()
+        ]
+        # The other lanes keep sending if one fails
+        for future in futures:
+            future.result()
+
+
+def send_transactions(
+    *,
+    transactions: Sequence[SendUnit],
+    journal: SendJournal,
+    max_pending: int,
+    signed_transactions: Optional[Dict[SignedTransactionKey, SignedTransaction]] = None,
+    poll_interval: float = RECEIPT_POLL_INTERVAL,
+    timeout: float = RECEIPT_TIMEOUT,
+):
+    """
+    Send transactions of a rewarder account in nonce order, keeping up to max_pending transactions in flight.
+    If signed_transactions are given, they are broadcast as is.
+
+    The pending transactions are confirmed together by scanning the Transfer logs of new blocks (see
+    ConfirmationTracker), and a new transaction is sent as soon as any pending transaction is mined. Every sent
+    and mined transaction is recorded in the journal, instead of rewriting the plan file.
+    """
+    if not transactions:
+        return
+    airdrop = transactions[0].airdrop
+    num_total = len(transactions)
+    unsent = iter(enumerate(transactions, start=1))
+    tracker = ConfirmationTracker(
+        airdrop=airdrop,
+        rewarder_account_addresses=[transactions[0].rewarder_account_address],
+        # Nothing sent from here on can be mined before the current block
+        from_block=airdrop.config.web3.eth.block_number,
+    )
+    while True:
+        while tracker.num_outstanding < max_pending:
+            i, transaction = next(unsent, (None, None))
+            if transaction is None:
+                break
+            echo(
+                f'Sending ({i}/{num_total}):',
+                hilight(airdrop.reward_token.formatted_amount(transaction.reward_amount_wei)),
+                'to',
+                hilight(transaction.to_address),
+                'from',
+                hilight(transaction.rewarder_account_address),
+                'with nonce',
+                hilight(transaction.transaction_nonce),
+            )
+            if signed_transactions is not None:
+                signed = signed_transactions[transaction.rewarder_account_address, transaction.transaction_nonce]
+                if not signed.matches(transaction):
+                    raise ValueError(f'Signed transaction does not match the plan: {transaction.as_row()}')
+                transaction.send_raw(signed.raw_transaction, signed.transaction_hash)
+            else:
+                transaction.send()
+            tracker.add(transaction)
+            echo('Sent', transaction.transaction_hash)
+            record_in_journal(journal, transaction, JOURNAL_STATUS_SENT)
+        if not tracker.num_outstanding:
+            break
+        for transaction in wait_for_confirmations(tracker, poll_interval=poll_interval, timeout=timeout):
+            echo('Verified', transaction.as_row())
+            record_in_journal(journal, transaction, JOURNAL_STATUS_MINED)
+
+
+def record_in_journal(journal: SendJournal, transaction: SendUnit, status: str):
+    journal.record(
+        rewarder_account_address=transaction.rewarder_account_address,
+        transaction_nonce=transaction.transaction_nonce,
+        transaction_hash=transaction.transaction_hash,
+        status=status,
     )
-    for transaction in pending.copy():
-        echo(
-            'Verifying',
-            hilight(transaction.as_row()),
-            '...'
-        )
-        transaction.verify()
-        pending.remove(transaction)
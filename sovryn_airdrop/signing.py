@@ -0,0 +1,160 @@
+"""Signing airdrop transactions up front, so that sending them is only broadcasting"""
+import json
+import os
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, Optional, Tuple
+
+import rlp
+from eth_account import Account
+from eth_account._utils.legacy_transactions import Transaction
+from eth_account.signers.local import LocalAccount
+from eth_utils import to_checksum_address, to_hex
+from hexbytes import HexBytes
+from web3 import Web3
+
+from .airdrop import AirdropBatch, SendUnit
+
+# (rewarder account address, nonce)
+SignedTransactionKey = Tuple[str, int]
+
+# Generous for an ERC20 transfer, which takes ~52k gas at most (when the recipient has no balance yet)
+DEFAULT_TRANSFER_GAS_LIMIT = 100_000
+
+
+@dataclass
+class SignedTransaction:
+    transaction_nonce: int
+    to_address: str
+    reward_amount_wei: int
+    gas_limit: int
+    gas_price_wei: int
+    transaction_hash: str
+    raw_transaction: str
+    # Missing from files signed before there were multiple rewarder accounts
+    from_address: Optional[str] = None
+
+    @property
+    def key(self) -> SignedTransactionKey:
+        return (self.from_address, self.transaction_nonce)
+
+    def matches(self, transaction: SendUnit) -> bool:
+        """
+        Is this the signed version of the planned transaction? The raw transaction itself is checked too, since it's
+        what gets broadcast: it must be signed by the rewarder account and make exactly the planned contract call
+        (e.g. with the same recipients and amounts for a Disperse batch).
+        """
+        if not (
+            self.from_address == transaction.rewarder_account_address and
+            self.transaction_nonce == transaction.transaction_nonce and
+            self.to_address.lower() == transaction.to_address.lower() and
+            self.reward_amount_wei == transaction.reward_amount_wei
+        ):
+            return False
+        raw_transaction = HexBytes(self.raw_transaction)
+        # Signed with gasPrice, so always a legacy transaction
+        decoded = rlp.decode(raw_transaction, Transaction)
+        function = transaction.get_contract_function()
+        return (
+            Account.recover_transaction(raw_transaction) == transaction.rewarder_account_address and
+            decoded.nonce == transaction.transaction_nonce and
+            to_checksum_address(decoded.to) == function.address and
+            decoded.value == 0 and
+            HexBytes(decoded.data) == HexBytes(function._encode_transaction_data())
+        )
+
+
+def sign_transaction(
+    transaction: SendUnit,
+    *,
+    account: LocalAccount,
+    gas_limit: int,
+    gas_price_wei: int,
+    chain_id: int,
+) -> SignedTransaction:
+    """Build and sign the transaction without fetching anything from the chain"""
+    # Nothing is filled in from the node, since every field is given
+    tx = transaction.get_contract_function().buildTransaction({
+        'from': account.address,
+        'nonce': transaction.transaction_nonce,
+        'gas': gas_limit,
+        'gasPrice': gas_price_wei,
+        'chainId': chain_id,
+    })
+    signed = account.sign_transaction(tx)
+    return SignedTransaction(
+        transaction_nonce=transaction.transaction_nonce,
+        to_address=transaction.to_address,
+        reward_amount_wei=transaction.reward_amount_wei,
+        gas_limit=gas_limit,
+        gas_price_wei=gas_price_wei,
+        transaction_hash=to_hex(signed.hash),
+        raw_transaction=to_hex(signed.rawTransaction),
+        from_address=account.address,
+    )
+
+
+def sign_transactions(
+    transactions: Iterable[SendUnit],
+    *,
+    accounts: Dict[str, LocalAccount],
+    gas_limit: int,
+    gas_price_wei: int,
+    chain_id: int,
+    existing: Optional[Dict[SignedTransactionKey, SignedTransaction]] = None,
+) -> Dict[SignedTransactionKey, SignedTransaction]:
+    """
+    Sign transactions with the accounts of their rewarder account addresses, returning
+    {(rewarder account address, nonce): signed transaction}. Disperse batches get a gas limit based on the number
+    of recipients instead of gas_limit.
+
+    Existing signed transactions that match the plan are reused, so that the transaction hashes stay the same
+    between runs.
+    """
+    ret = {}
+    for transaction in transactions:
+        key = (transaction.rewarder_account_address, transaction.transaction_nonce)
+        signed = (existing or {}).get(key)
+        if signed is None or not signed.matches(transaction):
+            signed = sign_transaction(
+                transaction,
+                account=accounts[transaction.rewarder_account_address],
+                gas_limit=transaction.gas_limit if isinstance(transaction, AirdropBatch) else gas_limit,
+                gas_price_wei=gas_price_wei,
+                chain_id=chain_id,
+            )
+        ret[key] = signed
+    return ret
+
+
+def get_gas_price(web3: Web3) -> int:
+    """Get the gas price from the gas price strategy of web3 if one is set (e.g. for RSK), else from the node"""
+    # Strategies get the params of the transaction to price, and there's none here
+    gas_price = web3.eth.generate_gas_price({})
+    if gas_price is None:
+        gas_price = web3.eth.gas_price
+    return gas_price
+
+
+def get_signed_transactions_file_path(plan_file: str) -> str:
+    return plan_file + '.signed.json'
+
+
+def save_signed_transactions(file_path: str, signed_transactions: Dict[SignedTransactionKey, SignedTransaction]):
+    temp_file_path = file_path + '.tmp'
+    with open(temp_file_path, 'w') as f:
+        json.dump(
+            [asdict(signed) for signed in signed_transactions.values()],
+            f,
+            indent=2
+        )
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file_path, file_path)
+
+
+def load_signed_transactions(file_path: str) -> Dict[SignedTransactionKey, SignedTransaction]:
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path) as f:
+        signed_transactions = [SignedTransaction(**raw) for raw in json.load(f)]
+    return {signed.key: signed for signed in signed_transactions}
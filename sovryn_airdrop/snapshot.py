@@ -0,0 +1,143 @@
+"""Holder snapshots, stored on disk so that rewards can be allocated without re-scanning the chain"""
+import json
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from eth_typing import ChecksumAddress
+from web3 import Web3
+
+from .tokens import Token
+from .web3_utils import get_erc20_contract, to_address
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+
+@dataclass
+class TokenHolder:
+    address: ChecksumAddress
+    holding_token_balance_on_account_wei: int
+    lp_token_balance_on_account_wei: int
+    lp_token_balance_on_liquidity_mining_wei: int
+    holding_token_balance_on_lp_wei: int
+
+    @property
+    def total_holding_token_balance_wei(self) -> int:
+        return self.holding_token_balance_on_account_wei + self.holding_token_balance_on_lp_wei
+
+
+@dataclass
+class HolderSnapshot:
+    """
+    Everything fetched from the chain that is needed to allocate the rewards.
+
+    Token holders are sorted by their total holding token balance, descending. Excluded addresses are
+    checksummed addresses mapped to the reason of exclusion.
+    """
+    chain_id: int
+    snapshot_block_number: int
+    first_scanned_block_number: int
+    holding_token: Token
+    lp_token: Token
+    holding_token_reserve_balance_wei: int
+    lp_token_total_supply_wei: int
+    token_holders: List[TokenHolder]
+    excluded_addresses: Dict[str, str] = field(default_factory=dict)
+    # Other tokens (e.g. the reward token), so that their info doesn't need to be fetched again
+    extra_tokens: List[Token] = field(default_factory=list)
+
+    @property
+    def tokens(self) -> List[Token]:
+        ret = {}
+        for token in [self.holding_token, self.lp_token] + self.extra_tokens:
+            ret.setdefault(token.address, token)
+        return list(ret.values())
+
+    def to_file(self, file_path: str):
+        data = {
+            'version': SNAPSHOT_FORMAT_VERSION,
+            'chainId': self.chain_id,
+            'snapshotBlockNumber': self.snapshot_block_number,
+            'firstScannedBlockNumber': self.first_scanned_block_number,
+            'holdingTokenAddress': self.holding_token.address,
+            'lpTokenAddress': self.lp_token.address,
+            'tokens': [token_to_json(token) for token in self.tokens],
+            # Large numbers are stored as strings, like in the plan files
+            'holdingTokenReserveBalanceWei': str(self.holding_token_reserve_balance_wei),
+            'lpTokenTotalSupplyWei': str(self.lp_token_total_supply_wei),
+            'tokenHolders': [
+                {
+                    'address': token_holder.address,
+                    'holdingTokenBalanceOnAccountWei': str(token_holder.holding_token_balance_on_account_wei),
+                    'lpTokenBalanceOnAccountWei': str(token_holder.lp_token_balance_on_account_wei),
+                    'lpTokenBalanceOnLiquidityMiningWei': str(token_holder.lp_token_balance_on_liquidity_mining_wei),
+                    'holdingTokenBalanceOnLpWei': str(token_holder.holding_token_balance_on_lp_wei),
+                }
+                for token_holder in self.token_holders
+            ],
+            'excludedAddresses': self.excluded_addresses,
+        }
+        with open(file_path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    @classmethod
+    def from_file(cls, file_path: str, *, web3: Optional[Web3] = None) -> 'HolderSnapshot':
+        """
+        Load a snapshot without connecting to the chain. The token contracts are bound to web3, or to a web3
+        instance without a provider if not given.
+        """
+        if web3 is None:
+            web3 = Web3()
+        with open(file_path) as f:
+            data = json.load(f)
+        if data.get('version') != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f'Unsupported snapshot version: {data.get("version")!r}')
+        chain_id = data['chainId']
+        tokens = {
+            token.address: token
+            for token in (token_from_json(raw, web3=web3, chain_id=chain_id) for raw in data['tokens'])
+        }
+        holding_token = tokens.pop(data['holdingTokenAddress'])
+        lp_token = tokens.pop(data['lpTokenAddress'])
+        return cls(
+            chain_id=chain_id,
+            snapshot_block_number=data['snapshotBlockNumber'],
+            first_scanned_block_number=data['firstScannedBlockNumber'],
+            holding_token=holding_token,
+            lp_token=lp_token,
+            holding_token_reserve_balance_wei=int(data['holdingTokenReserveBalanceWei']),
+            lp_token_total_supply_wei=int(data['lpTokenTotalSupplyWei']),
+            token_holders=[
+                TokenHolder(
+                    # Already checksummed when written
+                    address=raw['address'],
+                    holding_token_balance_on_account_wei=int(raw['holdingTokenBalanceOnAccountWei']),
+                    lp_token_balance_on_account_wei=int(raw['lpTokenBalanceOnAccountWei']),
+                    lp_token_balance_on_liquidity_mining_wei=int(raw['lpTokenBalanceOnLiquidityMiningWei']),
+                    holding_token_balance_on_lp_wei=int(raw['holdingTokenBalanceOnLpWei']),
+                )
+                for raw in data['tokenHolders']
+            ],
+            excluded_addresses=data['excludedAddresses'],
+            extra_tokens=list(tokens.values()),
+        )
+
+
+def token_to_json(token: Token) -> Dict[str, Any]:
+    return {
+        'address': token.address,
+        'name': token.name,
+        'symbol': token.symbol,
+        'decimals': token.decimals,
+    }
+
+
+def token_from_json(raw: Dict[str, Any], *, web3: Web3, chain_id: int) -> Token:
+    address = to_address(raw['address'])
+    return Token(
+        contract=get_erc20_contract(token_address=address, web3=web3),
+        address=address,
+        chain_id=chain_id,
+        name=raw['name'],
+        symbol=raw['symbol'],
+        decimals=raw['decimals'],
+    )
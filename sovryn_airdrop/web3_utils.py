@@ -1,28 +1,78 @@
 """Various web3"""
+import contextlib
+import dataclasses
 import functools
+import itertools
 import json
 import logging
 import os
+import queue
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from time import sleep
-from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
+import requests
+import requests.adapters
+from eth_abi.exceptions import DecodingError
 from eth_account.signers.local import LocalAccount
 from eth_typing import AnyAddress
-from eth_utils import to_checksum_address
+from eth_utils import event_abi_to_log_topic, to_checksum_address, to_hex
+from hexbytes import HexBytes
 from web3 import Web3
-from web3.contract import Contract, ContractEvent, EventData
+from web3._utils.abi import get_abi_output_types, map_abi_data
+from web3._utils.encoding import Web3JsonEncoder
+from web3._utils.events import get_event_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from web3._utils.request import make_post_request
+from web3.contract import Contract, ContractEvent, ContractFunction, EventData
+from web3.exceptions import BadFunctionCallOutput
 from web3.middleware import construct_sign_and_send_raw_middleware, geth_poa_middleware
+from web3.types import BlockIdentifier, LogReceipt
+
+from .cache import EventLogCache, ResponseCache
+from .providers import PINNED_METHODS, PooledHTTPProvider
+from .rate_limiting import is_rate_limit_error, is_retryable_error, is_throttling_error
 
 THIS_DIR = os.path.dirname(__file__)
 ABI_DIR = os.path.join(THIS_DIR, 'abi')
 logger = logging.getLogger(__name__)
 
 
-def get_web3(rpc_url: str, *, account: Optional[LocalAccount] = None) -> Web3:
-    web3 = Web3(Web3.HTTPProvider(rpc_url))
+def get_web3(
+    rpc_url: Union[str, Sequence[str]],
+    *,
+    account: Optional[LocalAccount] = None,
+    max_connections: Optional[int] = None,
+    chain_id: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+    min_request_rate: Optional[float] = None,
+) -> Web3:
+    """
+    Get a Web3 instance connected to rpc_url. The chain id is fetched from the node, unless given.
+
+    If rpc_url is a list of URLs, requests are spread over all of them. All requests go through the rate limiter of
+    their node (see PooledHTTPProvider), which doesn't slow down below min_request_rate requests per second, if given.
+
+    If cache_dir is given, the results of requests for finalized historical blocks are cached there
+    (see construct_response_cache_middleware).
+    """
+    rpc_urls = [rpc_url] if isinstance(rpc_url, str) else list(rpc_url)
+    session = None
+    if max_connections:
+        # Share one connection pool per node, big enough for all worker threads, between all requests to the node
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(rpc_urls), pool_maxsize=max_connections)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    provider_kwargs = {}
+    if min_request_rate is not None:
+        provider_kwargs['min_request_rate'] = min_request_rate
+    web3 = Web3(PooledHTTPProvider(rpc_urls, session=session, **provider_kwargs))
     if account:
         set_web3_account(
             web3=web3,
@@ -35,22 +85,178 @@ def get_web3(rpc_url: str, *, account: Optional[LocalAccount] = None) -> Web3:
     # Refer to http://web3py.readthedocs.io/en/stable/middleware.html#geth-style-proof-of-authority for more details.
     web3.middleware_onion.inject(geth_poa_middleware, layer=0)
 
-    if web3.eth.chain_id in (30, 31):
+    if chain_id is None:
+        chain_id = web3.eth.chain_id
+    if cache_dir:
+        # Innermost, so that it sees the raw JSON-RPC responses
+        web3.middleware_onion.inject(
+            construct_response_cache_middleware(
+                ResponseCache(os.path.join(cache_dir, 'responses.sqlite')),
+                chain_id=chain_id,
+            ),
+            name='response_cache',
+            layer=0,
+        )
+    if chain_id in (30, 31):
         web3.eth.set_gas_price_strategy(
             create_constant_gas_price_strategy(Web3.toWei(0.065, 'gwei'))
         )
     return web3
 
 
+# Methods whose results only depend on the block they're made for
+CACHEABLE_METHODS = ('eth_call', 'eth_getCode', 'eth_getLogs')
+# How often the latest block number is fetched at most, to find out if requested blocks are finalized
+FINALIZED_BLOCK_REFRESH_INTERVAL = 30.0
+
+
+def pinned_requests(web3: Web3):
+    """
+    Context manager that sends the requests of the current thread to a single node, if web3 is connected to many
+    (see PooledHTTPProvider.pinned_requests)
+    """
+    if isinstance(web3.provider, PooledHTTPProvider):
+        return web3.provider.pinned_requests()
+    return contextlib.nullcontext()
+
+
+class ResponseCacheMiddleware:
+    """
+    Middleware that caches the results of eth_call, eth_getCode and eth_getLogs requests for explicit block numbers
+    that are finalized (FINALITY_CONFIRMATIONS deep), which never change. Requests for block tags like 'latest', or for
+    recent blocks, always go to the node. The chain id is answered without asking the node.
+
+    JSON-RPC batches (see make_batch_request) don't go through the middlewares, so they use get_cache_key, get and
+    store directly.
+    """
+    def __init__(self, cache: ResponseCache, *, chain_id: int):
+        self.cache = cache
+        self.chain_id = chain_id
+        self._lock = threading.Lock()
+        self._last_final_block = -1
+        self._refreshed_at = None  # When the latest block number was last fetched
+
+    def __call__(self, make_request, web3):
+        def get_block_number() -> Optional[int]:
+            response = make_request('eth_blockNumber', [])
+            if 'result' not in response:
+                return None
+            return int(response['result'], 16)
+
+        def middleware(method, params):
+            if method == 'eth_chainId':
+                # web3 asks for this a lot (e.g. for every eth_call), and it's already known
+                return {'jsonrpc': '2.0', 'result': hex(self.chain_id)}
+            key = self.get_cache_key(method, params, get_block_number=get_block_number)
+            if key is None:
+                return make_request(method, params)
+            result = self.get(method, key)
+            if result is not None:
+                return {'jsonrpc': '2.0', 'result': result}
+            response = make_request(method, params)
+            if response.get('result') is not None and 'error' not in response:
+                self.store(method, key, response['result'])
+            return response
+        return middleware
+
+    def get_cache_key(
+        self,
+        method: str,
+        params: Sequence[Any],
+        *,
+        get_block_number: Callable[[], Optional[int]],
+    ) -> Optional[str]:
+        """Get the key that the result of the request is cached by, or None if the result can't be cached"""
+        if method not in CACHEABLE_METHODS:
+            return None
+        block_number = get_request_block_number(method, params)
+        if block_number is None or not self._is_finalized(block_number, get_block_number):
+            return None
+        return json.dumps(params, sort_keys=True, cls=Web3JsonEncoder)
+
+    def get(self, method: str, key: str) -> Optional[Any]:
+        return self.cache.get(chain_id=self.chain_id, method=method, params=key)
+
+    def store(self, method: str, key: str, result: Any):
+        self.cache.store(chain_id=self.chain_id, method=method, params=key, result=result)
+
+    def _is_finalized(self, block_number: int, get_block_number: Callable[[], Optional[int]]) -> bool:
+        with self._lock:
+            if block_number <= self._last_final_block:
+                return True
+            if (
+                self._refreshed_at is not None and
+                time.monotonic() - self._refreshed_at < FINALIZED_BLOCK_REFRESH_INTERVAL
+            ):
+                return False
+            self._refreshed_at = time.monotonic()
+        latest_block_number = get_block_number()
+        if latest_block_number is None:
+            return False
+        last_final_block = latest_block_number - FINALITY_CONFIRMATIONS
+        with self._lock:
+            self._last_final_block = max(self._last_final_block, last_final_block)
+        return block_number <= last_final_block
+
+
+def construct_response_cache_middleware(cache: ResponseCache, *, chain_id: int) -> ResponseCacheMiddleware:
+    """Get a middleware that caches the results of requests for finalized blocks (see ResponseCacheMiddleware)"""
+    return ResponseCacheMiddleware(cache, chain_id=chain_id)
+
+
+def get_response_cache_middleware(web3: Web3) -> Optional[ResponseCacheMiddleware]:
+    """Get the response cache of web3, if get_web3 set one up"""
+    if 'response_cache' not in web3.middleware_onion:
+        return None
+    return web3.middleware_onion['response_cache']
+
+
+def log_provider_stats(web3: Web3, stage: str):
+    """Log the request rates of the RPC endpoints of web3 after stage, if it has a pool of them"""
+    if isinstance(web3.provider, PooledHTTPProvider):
+        web3.provider.log_stats(stage)
+
+
+def get_request_block_number(method: str, params: Sequence[Any]) -> Optional[int]:
+    """Get the explicit block number a request is made for, or None if it's for a block tag or a block hash"""
+    if method == 'eth_getLogs':
+        log_filter = params[0] if params else {}
+        if 'blockHash' in log_filter:
+            return None
+        if parse_block_number(log_filter.get('fromBlock')) is None:
+            return None
+        return parse_block_number(log_filter.get('toBlock'))
+    # eth_call(transaction, block) and eth_getCode(address, block)
+    if len(params) < 2:
+        return None
+    return parse_block_number(params[1])
+
+
+def parse_block_number(block_identifier: Any) -> Optional[int]:
+    if isinstance(block_identifier, int):
+        return block_identifier
+    if isinstance(block_identifier, str) and block_identifier.startswith('0x'):
+        if len(block_identifier) == 66:
+            # Block hash
+            return None
+        return int(block_identifier, 16)
+    return None
+
+
 def create_constant_gas_price_strategy(wei: int):
     def gas_price_strategy(web3, transaction_params):
-        return transaction_params.get('gasPrice', wei)
+        return (transaction_params or {}).get('gasPrice', wei)
     return gas_price_strategy
 
 
 def set_web3_account(*, web3: Web3, account: LocalAccount) -> Web3:
-    web3.middleware_onion.add(construct_sign_and_send_raw_middleware(account))
-    web3.eth.default_account = account.address
+    return set_web3_accounts(web3=web3, accounts=[account])
+
+
+def set_web3_accounts(*, web3: Web3, accounts: Sequence[LocalAccount]) -> Web3:
+    """Sign transactions from any of the accounts locally. The first account is the default account."""
+    web3.middleware_onion.add(construct_sign_and_send_raw_middleware(list(accounts)))
+    web3.eth.default_account = accounts[0].address
     return web3
 
 
@@ -103,7 +309,73 @@ def get_erc20_contract(*, token_address: Union[str, AnyAddress], web3: Web3) ->
 class EventBatchComplete:
     batch_from_block: int
     batch_to_block: int
-    batch_events: Iterable[EventData]
+    batch_events: Iterable[Union[EventData, LogReceipt]]  # decoded in get_events, raw elsewhere
+    next_batch_size: Optional[int] = None
+
+
+@dataclass()
+class EventLogBatch:
+    """Raw (undecoded) logs of an event in an inclusive block range"""
+    from_block: int
+    to_block: int
+    logs: List[LogReceipt]
+    from_cache: bool = False
+    next_batch_size: Optional[int] = None
+
+
+# Successful requests in a row after which the block range may grow past a size that was too large again
+TOO_LARGE_RECOVERY_SUCCESSES = 10
+
+
+@dataclass()
+class AdaptiveBatchSize:
+    """
+    Controls the block range of eth_getLogs requests.
+
+    The range is doubled while the responses are small and fast, halved when they get too large or slow,
+    and halved immediately (without sleeping) when the node rejects the range as too large or the request times out.
+    The range then doesn't grow past the halved size until TOO_LARGE_RECOVERY_SUCCESSES requests in a row have
+    succeeded, so that a dense part of the chain doesn't keep the range small for the rest of the scan.
+    """
+    batch_size: int
+    min_batch_size: int = 0
+    max_batch_size: int = 100_000
+    target_num_events: int = 1000
+    target_duration: float = 3.0
+    _too_large_ceiling: Optional[int] = dataclasses.field(default=None, init=False, repr=False)
+    _num_successes: int = dataclasses.field(default=0, init=False, repr=False)
+
+    def on_success(self, *, num_events: int, duration: float):
+        if self._too_large_ceiling is not None:
+            self._num_successes += 1
+            if self._num_successes >= TOO_LARGE_RECOVERY_SUCCESSES:
+                self._too_large_ceiling = None
+        if num_events > self.target_num_events or duration > self.target_duration:
+            self.shrink()
+        elif num_events < self.target_num_events // 2 and duration < self.target_duration / 2:
+            self.batch_size = min(max(self.batch_size * 2, 1), self.current_max_batch_size)
+
+    def shrink(self):
+        self.batch_size = max(self.batch_size // 2, self.min_batch_size)
+
+    def on_too_large(self):
+        self.shrink()
+        self._too_large_ceiling = self.batch_size
+        self._num_successes = 0
+
+    @property
+    def current_max_batch_size(self) -> int:
+        if self._too_large_ceiling is None:
+            return self.max_batch_size
+        return min(self.max_batch_size, max(self._too_large_ceiling, self.min_batch_size))
+
+    @property
+    def can_shrink(self) -> bool:
+        return self.batch_size > self.min_batch_size
+
+
+# Blocks with at least this many confirmations are considered final and can be cached
+FINALITY_CONFIRMATIONS = 100
 
 
 def get_events(
@@ -112,89 +384,559 @@ def get_events(
     from_block: int,
     to_block: int,
     batch_size: int = None,
-    on_batch_complete: Optional[Callable[[EventBatchComplete], None]] = None
+    on_batch_complete: Optional[Callable[[EventBatchComplete], None]] = None,
+    cache: Optional[EventLogCache] = None,
+    adaptive: bool = False,
+    concurrency: int = 1,
+    argument_topics: Sequence[Any] = (),
 ):
     """Load events in batches"""
+    ret = []
+    for batch in iter_event_log_batches(
+        event=event,
+        from_block=from_block,
+        to_block=to_block,
+        batch_size=batch_size,
+        cache=cache,
+        adaptive=adaptive,
+        concurrency=concurrency,
+        argument_topics=argument_topics,
+    ):
+        events = [decode_event_log(event, log) for log in batch.logs]
+        ret.extend(events)
+        if on_batch_complete:
+            on_batch_complete(EventBatchComplete(
+                batch_from_block=batch.from_block,
+                batch_to_block=batch.to_block,
+                batch_events=events,
+                next_batch_size=batch.next_batch_size,
+            ))
+    # Batches are not necessarily in block order when fetched concurrently
+    ret.sort(key=lambda e: (e.blockNumber, e.logIndex))
+    logger.info(f'found %s events in total', len(ret))
+    return ret
+
+
+def iter_event_log_batches(
+    *,
+    event: ContractEvent,
+    from_block: int,
+    to_block: int,
+    batch_size: int = None,
+    cache: Optional[EventLogCache] = None,
+    adaptive: bool = False,
+    concurrency: int = 1,
+    argument_topics: Sequence[Any] = (),
+) -> Iterator[EventLogBatch]:
+    """
+    Load raw logs of event in batches, in block order, optionally filtered by argument_topics
+    (see fetch_event_logs).
+
+    If a cache is given, block ranges that are already in it are read from the cache, and the logs of the finalized
+    blocks that are fetched from the node are stored in it.
+
+    If adaptive is true, batch_size is only the initial batch size and is adjusted based on the responses
+    (see AdaptiveBatchSize).
+
+    If concurrency > 1, the block ranges to fetch are split into shards that are fetched by that many worker threads.
+    The batches are then yielded as soon as they are fetched, which is NOT in block order.
+    """
     if to_block < from_block:
         raise ValueError(f'to_block {to_block} is smaller than from_block {from_block}')
+    if cache is not None and argument_topics:
+        # The cache only has complete block ranges of all logs of an event
+        raise ValueError('Logs filtered by argument topics cannot be cached')
 
     if batch_size is None:
         batch_size = 100
+    if adaptive:
+        batch_size = AdaptiveBatchSize(batch_size=batch_size)
+
+    if cache is None:
+        segments = [(from_block, to_block, False)]
+    else:
+        web3 = event.web3
+        cache_key = dict(
+            chain_id=web3.eth.chain_id,
+            address=event.address,
+            topic=get_event_topic(event),
+        )
+        last_final_block = web3.eth.block_number - FINALITY_CONFIRMATIONS
+        segments = cache.split_range(
+            from_block=from_block,
+            to_block=to_block,
+            **cache_key
+        )
 
-    logger.info('fetching events from %s to %s with batch size %s', from_block, to_block, batch_size)
-    ret = []
+    def fetch_from_node(ranges: List[Tuple[int, int]]) -> Iterator[EventLogBatch]:
+        if concurrency > 1:
+            batches = _iter_event_log_batches_from_node_sharded(
+                event=event,
+                ranges=ranges,
+                batch_size=batch_size,
+                concurrency=concurrency,
+                argument_topics=argument_topics,
+            )
+        else:
+            batches = (
+                batch
+                for (range_from_block, range_to_block) in ranges
+                for batch in _iter_event_log_batches_from_node(
+                    event=event,
+                    from_block=range_from_block,
+                    to_block=range_to_block,
+                    batch_size=batch_size,
+                    argument_topics=argument_topics,
+                )
+            )
+        for batch in batches:
+            if cache is not None and batch.from_block <= last_final_block:
+                cache.store_logs(
+                    from_block=batch.from_block,
+                    to_block=min(batch.to_block, last_final_block),
+                    logs=[log for log in batch.logs if log['blockNumber'] <= last_final_block],
+                    **cache_key
+                )
+            yield batch
+
+    def read_from_cache(segment_from_block: int, segment_to_block: int) -> EventLogBatch:
+        logger.info('reading events from %s to %s from cache', segment_from_block, segment_to_block)
+        return EventLogBatch(
+            from_block=segment_from_block,
+            to_block=segment_to_block,
+            logs=cache.get_logs(from_block=segment_from_block, to_block=segment_to_block, **cache_key),
+            from_cache=True,
+        )
+
+    if concurrency > 1:
+        for segment_from_block, segment_to_block, is_cached in segments:
+            if is_cached:
+                yield read_from_cache(segment_from_block, segment_to_block)
+        yield from fetch_from_node([
+            (segment_from_block, segment_to_block)
+            for (segment_from_block, segment_to_block, is_cached) in segments
+            if not is_cached
+        ])
+    else:
+        for segment_from_block, segment_to_block, is_cached in segments:
+            if is_cached:
+                yield read_from_cache(segment_from_block, segment_to_block)
+            else:
+                yield from fetch_from_node([(segment_from_block, segment_to_block)])
+
+
+# Each worker gets this many shards on average, so that a dense shard doesn't leave the others idle at the end
+SHARDS_PER_WORKER = 4
+# Fetched batches waiting for the consumer, per worker. Workers wait when the consumer falls behind, so that the logs
+# don't pile up in memory.
+QUEUED_BATCHES_PER_WORKER = 2
+# How often workers waiting to queue a batch check whether the consumer has stopped, in seconds
+QUEUE_PUT_TIMEOUT = 0.1
+
+
+def _iter_event_log_batches_from_node_sharded(
+    *,
+    event: ContractEvent,
+    ranges: List[Tuple[int, int]],
+    batch_size: Union[int, AdaptiveBatchSize],
+    concurrency: int,
+    argument_topics: Sequence[Any] = (),
+) -> Iterator[EventLogBatch]:
+    total_blocks = sum(range_to_block - range_from_block + 1 for (range_from_block, range_to_block) in ranges)
+    if not total_blocks:
+        return
+    shard_size = max(-(-total_blocks // (concurrency * SHARDS_PER_WORKER)), 1)
+    shards = [
+        shard
+        for (range_from_block, range_to_block) in ranges
+        for shard in split_block_range(range_from_block, range_to_block, shard_size)
+    ]
+    logger.info('fetching events in %s shards of up to %s blocks with %s workers', len(shards), shard_size, concurrency)
+
+    results = queue.Queue(maxsize=concurrency * QUEUED_BATCHES_PER_WORKER)
+    shard_done = object()
+    stopped = threading.Event()
+
+    def put_result(result) -> bool:
+        """Queue a result for the consumer, giving up (and returning False) if the consumer has stopped"""
+        while not stopped.is_set():
+            try:
+                results.put(result, timeout=QUEUE_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch_shard(shard_from_block: int, shard_to_block: int):
+        try:
+            if stopped.is_set():
+                return
+            for batch in _iter_event_log_batches_from_node(
+                event=event,
+                from_block=shard_from_block,
+                to_block=shard_to_block,
+                # Each shard adapts its own batch size
+                batch_size=dataclasses.replace(batch_size) if isinstance(batch_size, AdaptiveBatchSize) else batch_size,
+                argument_topics=argument_topics,
+            ):
+                if not put_result(batch):
+                    return
+        except BaseException as e:
+            put_result(e)
+        finally:
+            put_result(shard_done)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='events') as executor:
+        for shard_from_block, shard_to_block in shards:
+            executor.submit(fetch_shard, shard_from_block, shard_to_block)
+        num_done = 0
+        try:
+            while num_done < len(shards):
+                result = results.get()
+                if result is shard_done:
+                    num_done += 1
+                elif isinstance(result, BaseException):
+                    raise result
+                else:
+                    yield result
+        finally:
+            # Make the remaining workers stop early if the consumer stops or a shard fails. Workers waiting for room in
+            # the queue give up within QUEUE_PUT_TIMEOUT, so the executor doesn't wait for them forever.
+            stopped.set()
+
+
+def split_block_range(from_block: int, to_block: int, shard_size: int) -> List[Tuple[int, int]]:
+    """Split the inclusive block range from_block...to_block into consecutive ranges of at most shard_size blocks"""
+    return [
+        (shard_from_block, min(shard_from_block + shard_size - 1, to_block))
+        for shard_from_block in range(from_block, to_block + 1, shard_size)
+    ]
+
+
+def _iter_event_log_batches_from_node(
+    *,
+    event: ContractEvent,
+    from_block: int,
+    to_block: int,
+    batch_size: Union[int, AdaptiveBatchSize],
+    argument_topics: Sequence[Any] = (),
+) -> Iterator[EventLogBatch]:
+    adaptive = batch_size if isinstance(batch_size, AdaptiveBatchSize) else None
+    logger.info(
+        'fetching events from %s to %s with %sbatch size %s',
+        from_block,
+        to_block,
+        'adaptive ' if adaptive else '',
+        adaptive.batch_size if adaptive else batch_size,
+    )
     batch_from_block = from_block
     while batch_from_block <= to_block:
-        batch_to_block = min(batch_from_block + batch_size, to_block)
+        current_batch_size = adaptive.batch_size if adaptive else batch_size
+        batch_to_block = min(batch_from_block + current_batch_size, to_block)
         logger.info('fetching batch from %s to %s (up to %s)', batch_from_block, batch_to_block, to_block)
 
-        events = get_event_batch_with_retries(
-            event=event,
+        if adaptive:
+            start_time = time.monotonic()
+            try:
+                logs = fetch_event_logs(
+                    event=event,
+                    from_block=batch_from_block,
+                    to_block=batch_to_block,
+                    argument_topics=argument_topics,
+                )
+            except Exception as e:
+                if not is_retryable_error(e):
+                    raise
+                if (
+                    # A request that times out is most likely for a block range with too many logs for the node to
+                    # answer in time. Retrying it unchanged wouldn't help, so it's split like a rejected range.
+                    (is_block_range_too_large_error(e) or isinstance(e, requests.exceptions.Timeout)) and
+                    adaptive.can_shrink and
+                    batch_to_block > batch_from_block
+                ):
+                    adaptive.on_too_large()
+                    logger.info('block range too large (%s), decreasing batch size to %s', e, adaptive.batch_size)
+                    continue
+                logs = get_event_batch_with_retries(
+                    event=event,
+                    from_block=batch_from_block,
+                    to_block=batch_to_block,
+                    argument_topics=argument_topics,
+                )
+            else:
+                adaptive.on_success(num_events=len(logs), duration=time.monotonic() - start_time)
+        else:
+            logs = get_event_batch_with_retries(
+                event=event,
+                from_block=batch_from_block,
+                to_block=batch_to_block,
+                argument_topics=argument_topics,
+            )
+
+        if len(logs) > 0:
+            logger.info(f'found %s events in batch', len(logs))
+        yield EventLogBatch(
             from_block=batch_from_block,
             to_block=batch_to_block,
+            logs=logs,
+            next_batch_size=adaptive.batch_size if adaptive else batch_size,
         )
-        if len(events) > 0:
-            logger.info(f'found %s events in batch', len(events))
-        ret.extend(events)
-
-        if on_batch_complete:
-            on_batch_complete(EventBatchComplete(
-                batch_from_block=batch_from_block,
-                batch_to_block=batch_to_block,
-                batch_events=events
-            ))
         batch_from_block = batch_to_block + 1
-    logger.info(f'found %s events in total', len(ret))
-    return ret
 
 
-def get_event_batch_with_retries(event, from_block, to_block, *, retries=6):
-    original_retries = retries
-    while True:
-        try:
-            return event.getLogs(
-                fromBlock=from_block,
-                toBlock=to_block,
-            )
-        except ValueError as e:
-            if retries <= 0:
-                raise e
-            logger.warning('error in get_all_entries: %s, retrying (%s)', e, retries)
-            retries -= 1
-            attempt = original_retries - retries
-            exponential_sleep(attempt)
+def get_event_batch_with_retries(event, from_block, to_block, *, retries=6, argument_topics=()):
+    return retryable(max_attempts=retries)(fetch_event_logs)(
+        event=event,
+        from_block=from_block,
+        to_block=to_block,
+        argument_topics=argument_topics,
+    )
 
 
-def exponential_sleep(attempt, max_sleep_time=256.0):
+def fetch_event_logs(
+    *,
+    event: ContractEvent,
+    from_block: int,
+    to_block: int,
+    argument_topics: Sequence[Any] = (),
+) -> List[LogReceipt]:
+    """
+    Fetch the raw logs of event. argument_topics filter by the indexed arguments, in order
+    (None matches anything, a list matches any of the topics in it).
+    """
+    return event.web3.eth.get_logs({
+        'address': event.address,
+        'topics': [get_event_topic(event), *argument_topics],
+        'fromBlock': from_block,
+        'toBlock': to_block,
+    })
+
+
+def address_to_topic(address: AnyAddress) -> str:
+    """Get the topic of an indexed address argument, for filtering logs"""
+    return '0x' + '00' * 12 + to_address(address)[2:].lower()
+
+
+# Substrings of error messages that nodes use for eth_getLogs requests that return too much data (or take too long
+# to answer, which the node times out itself)
+BLOCK_RANGE_TOO_LARGE_ERROR_MESSAGES = (
+    'more than',
+    'too many',
+    'too large',
+    'limit exceeded',
+    'exceeds',
+    'timeout',
+    'timed out',
+)
+
+
+def is_block_range_too_large_error(e: Exception) -> bool:
+    if is_rate_limit_error(e):
+        # The request was fine, there were just too many of them
+        return False
+    # A client side timeout could also be an overloaded node. Only the adaptive event scan, which can shrink the range,
+    # treats it as a range that is too large.
+    if isinstance(e, ValueError):
+        message = str(e).lower()
+        return any(m in message for m in BLOCK_RANGE_TOO_LARGE_ERROR_MESSAGES)
+    return False
+
+
+# Substrings of error messages for eth_calls that need too much gas or return too much data
+CALL_TOO_LARGE_ERROR_MESSAGES = (
+    'out of gas',
+    'gas required exceeds',
+    'exceeds block gas limit',
+    'response size',
+    'too large',
+)
+
+
+def is_call_too_large_error(e: Exception) -> bool:
+    """Did an eth_call fail because it does too much, e.g. an aggregated call of too many sub-calls?"""
+    if is_rate_limit_error(e):
+        return False
+    if isinstance(e, ValueError):
+        message = str(e).lower()
+        return any(m in message for m in CALL_TOO_LARGE_ERROR_MESSAGES)
+    return False
+
+
+def get_event_topic(event: ContractEvent) -> str:
+    return to_hex(event_abi_to_log_topic(event._get_event_abi()))
+
+
+def decode_event_log(event: ContractEvent, log: LogReceipt) -> EventData:
+    return get_event_data(event.web3.codec, event._get_event_abi(), log)
+
+
+def exponential_sleep(attempt, max_sleep_time=16.0):
     sleep_time = min(2 ** attempt, max_sleep_time)
     sleep(sleep_time)
 
 
-def retryable(*, max_attempts: int = 10):
+# How long requests are retried for while the node keeps rate limiting them, e.g. until a quota resets
+MAX_THROTTLED_SECONDS = 15 * 60
+MAX_THROTTLED_SLEEP_TIME = 60.0
+
+
+def retryable(*, max_attempts: int = 10, max_throttled_seconds: float = MAX_THROTTLED_SECONDS):
+    """
+    Retry the decorated function on retryable errors (see is_retryable_error), and raise fatal errors right away.
+
+    Errors caused by making too many requests (rate limiting and timeouts) don't count as attempts. The first
+    max_attempts of them in a row are retried without sleeping, since the rate limiter of the provider has already
+    lowered the request rate. If the node keeps refusing requests after that (e.g. because of a quota per minute or
+    per day), they are retried after an exponential backoff of up to a minute, until max_throttled_seconds have
+    passed. Other errors (e.g. the node being unreachable) are retried max_attempts times after an exponential
+    backoff.
+    """
     def decorator(func):
         @functools.wraps(func)
         def wrapped(*args, **kwargs):
             attempt = 0
+            throttled_attempt = 0
+            throttled_since = None
             while True:
                 try:
                     return func(*args, **kwargs)
                 except Exception as e:
+                    if not is_retryable_error(e):
+                        raise
+                    if is_throttling_error(e):
+                        now = time.monotonic()
+                        if throttled_since is None:
+                            throttled_since = now
+                        if now - throttled_since >= max_throttled_seconds:
+                            logger.warning('still rate limited after %s seconds: %s', max_throttled_seconds, e)
+                            raise
+                        logger.warning('Rate limiting error (attempt: %s): %s', throttled_attempt + 1, e)
+                        if throttled_attempt >= max_attempts:
+                            exponential_sleep(throttled_attempt - max_attempts, max_sleep_time=MAX_THROTTLED_SLEEP_TIME)
+                        throttled_attempt += 1
+                        continue
+                    throttled_attempt = 0
+                    throttled_since = None
                     if attempt >= max_attempts:
                         logger.warning('max attempts (%s) exhausted for error: %s', max_attempts, e)
                         raise
-                    logger.warning(
-                        'Retryable error (attempt: %s/%s): %s',
-                        attempt + 1,
-                        max_attempts,
-                        e,
-                    )
+                    logger.warning('Retryable error (attempt: %s/%s): %s', attempt + 1, max_attempts, e)
                     exponential_sleep(attempt)
                     attempt += 1
         return wrapped
     return decorator
 
 
-@functools.lru_cache()
-def is_contract(*, web3: Web3, address: str) -> bool:
-    code = web3.eth.get_code(to_address(address))
+def is_contract_code(code: Union[bytes, str]) -> bool:
+    code = HexBytes(code)
     return code != b'\x00' and code != b''
+
+
+@functools.lru_cache()
+def is_contract(*, web3: Web3, address: str, block_identifier: BlockIdentifier = 'latest') -> bool:
+    code = web3.eth.get_code(to_address(address), block_identifier=block_identifier)
+    return is_contract_code(code)
+
+
+class JSONRPCError(Exception):
+    """Error returned by the node for a single call in a JSON-RPC batch"""
+    def __init__(self, method: str, error: Any):
+        super().__init__(f'{method}: {error}')
+        self.method = method
+        self.error = error
+
+
+_batch_request_ids = itertools.count()
+
+
+@retryable()
+def make_batch_request(web3: Web3, calls: Sequence[Tuple[str, Sequence[Any]]]) -> List[Any]:
+    """
+    Send (method, params) pairs to the node in a single JSON-RPC batch request.
+
+    Returns the raw results in the same order as the calls. Calls that the node answered with an error are returned
+    as JSONRPCError instances instead of raising, so that the caller can handle partial failures. Transport errors
+    (and the node rejecting the whole batch) are retried as a whole.
+
+    If web3 has a response cache, calls for finalized blocks are answered from it when possible, and the rest of the
+    calls are stored in it.
+    """
+    if not calls:
+        return []
+    response_cache = get_response_cache_middleware(web3)
+    if response_cache is None:
+        cache_keys = [None] * len(calls)
+    else:
+        cache_keys = [
+            response_cache.get_cache_key(method, params, get_block_number=lambda: web3.eth.block_number)
+            for (method, params) in calls
+        ]
+    cached_results = {}
+    for i, ((method, _), key) in enumerate(zip(calls, cache_keys)):
+        if key is not None:
+            result = response_cache.get(method, key)
+            if result is not None:
+                cached_results[i] = result
+    uncached = [i for i in range(len(calls)) if i not in cached_results]
+    if not uncached:
+        return [cached_results[i] for i in range(len(calls))]
+
+    provider = web3.provider
+    ids = {i: next(_batch_request_ids) for i in uncached}
+    payload = [
+        {'jsonrpc': '2.0', 'method': calls[i][0], 'params': list(calls[i][1]), 'id': ids[i]}
+        for i in uncached
+    ]
+    request_data = json.dumps(payload).encode('utf-8')
+    if isinstance(provider, PooledHTTPProvider):
+        raw_response = provider.post(request_data, pinned=any(calls[i][0] in PINNED_METHODS for i in uncached))
+    else:
+        raw_response = make_post_request(provider.endpoint_uri, request_data, **provider.get_request_kwargs())
+    response = json.loads(raw_response)
+    if not isinstance(response, list):
+        # Nodes answer with a single error object if they reject the batch as a whole
+        raise ValueError(f'Invalid response to JSON-RPC batch request: {response}')
+
+    responses_by_id = {r.get('id'): r for r in response}
+    ret = []
+    for i, (method, _) in enumerate(calls):
+        if i in cached_results:
+            ret.append(cached_results[i])
+            continue
+        sub_response = responses_by_id.get(ids[i])
+        if sub_response is None:
+            ret.append(JSONRPCError(method, 'missing from batch response'))
+        elif 'error' in sub_response:
+            ret.append(JSONRPCError(method, sub_response['error']))
+        else:
+            result = sub_response.get('result')
+            if cache_keys[i] is not None and result is not None:
+                response_cache.store(method, cache_keys[i], result)
+            ret.append(result)
+    return ret
+
+
+def encode_contract_call(contract_function: ContractFunction) -> Dict[str, str]:
+    """Get the transaction object for an eth_call of contract_function, e.g. for batch requests"""
+    return {
+        'to': contract_function.address,
+        'data': contract_function._encode_transaction_data(),
+    }
+
+
+def decode_contract_call_result(contract_function: ContractFunction, data: Union[bytes, str]) -> Any:
+    """
+    Decode the raw return data of an eth_call the same way ContractFunction.call does, raising BadFunctionCallOutput
+    if it can't be decoded (e.g. the empty result of calling an address without code)
+    """
+    output_types = get_abi_output_types(contract_function.abi)
+    try:
+        decoded = contract_function.web3.codec.decode_abi(output_types, HexBytes(data))
+    except DecodingError as e:
+        raise BadFunctionCallOutput(
+            f'Could not decode the return data {to_hex(HexBytes(data))} of {contract_function.fn_name}: {e}'
+        ) from e
+    normalized = map_abi_data(BASE_RETURN_NORMALIZERS, output_types, decoded)
+    if len(normalized) == 1:
+        return normalized[0]
+    return normalized
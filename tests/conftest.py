@@ -0,0 +1,95 @@
+from typing import Callable
+
+import pytest
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.datastructures import AttributeDict
+
+from sovryn_airdrop.airdrop import Airdrop
+from sovryn_airdrop.config import Config
+from sovryn_airdrop.snapshot import token_from_json
+from sovryn_airdrop.web3_utils import address_to_topic
+
+from .utils import (
+    FakeNodeProvider,
+    DISPERSE_ADDRESS,
+    HOLDING_TOKEN_ADDRESS,
+    OTHER_REWARDER_ACCOUNT_ADDRESS,
+    REWARD_TOKEN_ADDRESS,
+    REWARDER_ACCOUNT_ADDRESS,
+    TRANSFER_TOPIC,
+    address,
+)
+
+
+@pytest.fixture
+def node() -> FakeNodeProvider:
+    return FakeNodeProvider()
+
+
+@pytest.fixture
+def web3(node) -> Web3:
+    # Requests that the fake node doesn't know fail the test
+    return Web3(node)
+
+
+@pytest.fixture
+def config(web3) -> Config:
+    return Config(
+        web3=web3,
+        rpc_url='http://127.0.0.1:1',
+        holding_token=token_from_json(
+            {'address': HOLDING_TOKEN_ADDRESS, 'name': 'Holding', 'symbol': 'HLD', 'decimals': 18},
+            web3=web3,
+            chain_id=31,
+        ),
+        holding_token_liquidity_pool_address=address(0x34),
+        reward_token=token_from_json(
+            {'address': REWARD_TOKEN_ADDRESS, 'name': 'Reward', 'symbol': 'RWD', 'decimals': 18},
+            web3=web3,
+            chain_id=31,
+        ),
+        rewarder_account_address=REWARDER_ACCOUNT_ADDRESS,
+        rewarder_account_addresses=[REWARDER_ACCOUNT_ADDRESS, OTHER_REWARDER_ACCOUNT_ADDRESS],
+        total_reward_amount_wei=10 ** 21,
+        min_reward_wei=1,
+        snapshot_block_number=100,
+        first_scanned_block_number=1,
+        disperse_address=DISPERSE_ADDRESS,
+    )
+
+
+@pytest.fixture
+def airdrop(config) -> Airdrop:
+    return Airdrop(config=config)
+
+
+@pytest.fixture
+def make_transfer_log() -> Callable[..., AttributeDict]:
+    """Build a raw reward token Transfer log, like eth_getLogs and receipts return them"""
+    def make(
+        *,
+        from_address: str,
+        to_address: str,
+        value: int,
+        transaction_hash: str = '0x' + 'ab' * 32,
+        block_number: int = 10,
+        log_index: int = 0,
+        token_address: str = REWARD_TOKEN_ADDRESS,
+    ) -> AttributeDict:
+        return AttributeDict({
+            'address': token_address,
+            'topics': [
+                HexBytes(TRANSFER_TOPIC),
+                HexBytes(address_to_topic(from_address)),
+                HexBytes(address_to_topic(to_address)),
+            ],
+            'data': '0x' + value.to_bytes(32, 'big').hex(),
+            'blockNumber': block_number,
+            'blockHash': HexBytes('0x' + 'cd' * 32),
+            'transactionHash': HexBytes(transaction_hash),
+            'transactionIndex': 0,
+            'logIndex': log_index,
+            'removed': False,
+        })
+    return make
@@ -0,0 +1,87 @@
+import pytest
+from web3 import Web3
+from web3.datastructures import AttributeDict
+
+from sovryn_airdrop.airdrop import AirdropBatch
+from sovryn_airdrop.addresses import to_address_bytes
+
+from .utils import DISPERSE_ADDRESS, REWARD_TOKEN_ADDRESS, REWARDER_ACCOUNT_ADDRESS, address
+
+
+@pytest.fixture
+def batch(airdrop) -> AirdropBatch:
+    for i, amount in enumerate([100, 200, 300]):
+        airdrop.add_transaction(
+            to_address=address(i + 1),
+            reward_amount_wei=amount,
+            transaction_nonce=7,
+            batch_number=1,
+            rewarder_account_address=REWARDER_ACCOUNT_ADDRESS,
+        )
+    return AirdropBatch(airdrop=airdrop, batch_number=1, transactions=list(airdrop.transactions))
+
+
+def make_receipt(logs, status=1):
+    return AttributeDict({'status': status, 'logs': logs})
+
+
+def test_batch_calls_disperse_token_simple(batch):
+    data = batch.get_contract_function()._encode_transaction_data()
+    selector = Web3.keccak(text='disperseTokenSimple(address,address[],uint256[])')[:4].hex()
+    assert data[:10] == selector
+    assert batch.get_contract_function().address == DISPERSE_ADDRESS
+
+
+def test_batch_expected_transfers_match_disperse_token_simple_logs(batch, make_transfer_log):
+    # disperseTokenSimple does transferFrom(rewarder account, recipient) for every row
+    logs = [
+        make_transfer_log(from_address=REWARDER_ACCOUNT_ADDRESS, to_address=t.to_address, value=t.reward_amount_wei,
+                          log_index=i)
+        for i, t in enumerate(batch.transactions)
+    ]
+    batch.check_receipt(make_receipt(logs))
+
+    transfer_event = batch.airdrop.reward_token.contract.events.Transfer()
+    decoded = [transfer_event.processLog(log) for log in logs]
+    assert all(event.args['from'] == REWARDER_ACCOUNT_ADDRESS for event in decoded)
+    assert batch.get_expected_transfers() == {
+        (to_address_bytes(event.args['to']), event.args['value']): 1
+        for event in decoded
+    }
+
+
+def test_batch_check_receipt_rejects_transfers_from_disperse(batch, make_transfer_log):
+    # What disperseToken would emit: one transfer to Disperse, then transfers from it
+    logs = [make_transfer_log(from_address=REWARDER_ACCOUNT_ADDRESS, to_address=DISPERSE_ADDRESS, value=600)]
+    logs.extend(
+        make_transfer_log(from_address=DISPERSE_ADDRESS, to_address=t.to_address, value=t.reward_amount_wei,
+                          log_index=i + 1)
+        for i, t in enumerate(batch.transactions)
+    )
+    with pytest.raises(ValueError, match='No Transfer found'):
+        batch.check_receipt(make_receipt(logs))
+
+
+def test_batch_check_receipt_rejects_missing_transfer(batch, make_transfer_log):
+    logs = [
+        make_transfer_log(from_address=REWARDER_ACCOUNT_ADDRESS, to_address=t.to_address, value=t.reward_amount_wei)
+        for t in batch.transactions[:2]
+    ]
+    with pytest.raises(ValueError, match='No Transfer found'):
+        batch.check_receipt(make_receipt(logs))
+
+
+def test_batch_check_receipt_ignores_other_tokens(batch, make_transfer_log):
+    logs = [
+        make_transfer_log(from_address=REWARDER_ACCOUNT_ADDRESS, to_address=t.to_address, value=t.reward_amount_wei,
+                          token_address=address(99))
+        for t in batch.transactions
+    ]
+    assert REWARD_TOKEN_ADDRESS not in {log['address'] for log in logs}
+    with pytest.raises(ValueError, match='No Transfer found'):
+        batch.check_receipt(make_receipt(logs))
+
+
+def test_failed_batch(batch):
+    with pytest.raises(ValueError, match='Transaction failed'):
+        batch.check_receipt(make_receipt([], status=0))
@@ -0,0 +1,122 @@
+import random
+
+import pytest
+
+from sovryn_airdrop.allocation import RewardAllocator
+
+
+def allocate_naively(balances, *, total_reward_wei, min_reward_wei):
+    """Exclude the smallest holders one balance at a time until everybody left gets the minimum"""
+    min_reward_wei = max(min_reward_wei, 1)
+    included = [i for (i, balance) in enumerate(balances) if balance > 0]
+    while included:
+        total_balance = sum(balances[i] for i in included)
+        smallest = min(balances[i] for i in included)
+        if total_reward_wei * smallest // total_balance >= min_reward_wei:
+            break
+        included = [i for i in included if balances[i] != smallest]
+    return set(included)
+
+
+def test_rewards_add_up_to_the_total_exactly():
+    balances = [10 ** 18 // 3, 7, 10 ** 18 // 7, 12345, 10 ** 20 + 1]
+    allocator = RewardAllocator(balances)
+    for total_reward_wei in [1, 999, 10 ** 18, 10 ** 21 + 17]:
+        rewards = allocator.allocate(total_reward_wei=total_reward_wei, min_reward_wei=1)
+        assert sum(rewards) == total_reward_wei
+        # Never more than one wei off the exact proportional share
+        total_balance = sum(balances[i] for (i, reward) in enumerate(rewards) if reward)
+        for balance, reward in zip(balances, rewards):
+            if reward:
+                assert abs(reward * total_balance - total_reward_wei * balance) < total_balance
+
+
+def test_ties_are_broken_deterministically():
+    # 10 wei between 3 equal holders: the dust goes to the earliest in the input order
+    assert RewardAllocator([5, 5, 5]).allocate(total_reward_wei=10, min_reward_wei=1) == [4, 3, 3]
+    # Equal remainders go to the larger holders first
+    assert RewardAllocator([1, 2, 1]).allocate(total_reward_wei=5, min_reward_wei=1) == [1, 3, 1]
+    balances = [3, 1, 3, 2, 1, 3]
+    first = RewardAllocator(balances).allocate(total_reward_wei=100, min_reward_wei=1)
+    assert RewardAllocator(balances).allocate(total_reward_wei=100, min_reward_wei=1) == first
+
+
+def test_no_holders():
+    allocator = RewardAllocator([])
+    assert allocator.allocate(total_reward_wei=1000, min_reward_wei=1) == []
+    [result] = allocator.sweep([(1000, 1)])
+    assert (result.num_recipients, result.num_excluded, result.smallest_reward_wei) == (0, 0, 0)
+
+
+def test_zero_balances_get_nothing():
+    assert RewardAllocator([0, 0]).allocate(total_reward_wei=1000, min_reward_wei=1) == [0, 0]
+    assert RewardAllocator([0, 5, 0]).allocate(total_reward_wei=1000, min_reward_wei=1) == [0, 1000, 0]
+
+
+def test_one_holder():
+    allocator = RewardAllocator([42])
+    assert allocator.allocate(total_reward_wei=1000, min_reward_wei=1000) == [1000]
+    assert allocator.allocate(total_reward_wei=1000, min_reward_wei=1001) == [0]
+
+
+def test_negative_balances_are_rejected():
+    with pytest.raises(ValueError):
+        RewardAllocator([1, -1])
+
+
+def test_holders_under_the_minimum_reward_are_excluded_and_their_share_redistributed():
+    allocator = RewardAllocator([600, 300, 90, 10])
+    # 10 wei would get 10, under the minimum of 20, but 90 wei gets 90 * 1000 // 990 = 90
+    assert allocator.allocate(total_reward_wei=1000, min_reward_wei=20) == [606, 303, 91, 0]
+    # Excluding 90 wei too leaves 600 and 300 with 667 and 333
+    assert allocator.allocate(total_reward_wei=1000, min_reward_wei=100) == [667, 333, 0, 0]
+    assert allocator.allocate(total_reward_wei=1000, min_reward_wei=1001) == [0, 0, 0, 0]
+
+
+def test_equal_balances_are_all_included_or_all_excluded():
+    # Splitting between all 4 would give 25 each. With a minimum of 30, 3 of them would get 33, but that's not fair.
+    allocator = RewardAllocator([1, 1, 1, 1])
+    assert allocator.allocate(total_reward_wei=100, min_reward_wei=30) == [0, 0, 0, 0]
+    assert RewardAllocator([4, 1, 1, 1]).allocate(total_reward_wei=100, min_reward_wei=20) == [100, 0, 0, 0]
+
+
+def test_sweep_smallest_and_largest_rewards():
+    allocator = RewardAllocator([600, 300, 90, 10])
+    results = allocator.sweep([(1000, 1), (1000, 20), (1000, 100), (1000, 1001)])
+    assert [(r.num_recipients, r.num_excluded) for r in results] == [(4, 0), (3, 1), (2, 2), (0, 4)]
+    assert [(r.smallest_reward_wei, r.largest_reward_wei) for r in results] == [
+        (10, 600),
+        (90, 606),
+        (333, 666),  # Before the dust is given out
+        (0, 0),
+    ]
+    for result in results:
+        rewards = [
+            reward for reward in allocator.allocate(
+                total_reward_wei=result.total_reward_wei,
+                min_reward_wei=result.min_reward_wei,
+            )
+            if reward
+        ]
+        assert len(rewards) == result.num_recipients
+        if rewards:
+            assert result.smallest_reward_wei <= min(rewards) <= result.smallest_reward_wei + 1
+            assert result.largest_reward_wei <= max(rewards) <= result.largest_reward_wei + 1
+
+
+def test_matches_naive_exclusion():
+    rng = random.Random(1)
+    for _ in range(200):
+        balances = [rng.choice([0, rng.randint(1, 100), rng.randint(1, 10 ** 6)]) for _ in range(rng.randint(1, 20))]
+        total_reward_wei = rng.randint(1, 10 ** 6)
+        min_reward_wei = rng.randint(0, 10 ** 5)
+        rewards = RewardAllocator(balances).allocate(total_reward_wei=total_reward_wei, min_reward_wei=min_reward_wei)
+        recipients = {i for (i, reward) in enumerate(rewards) if reward}
+        assert recipients == allocate_naively(
+            balances,
+            total_reward_wei=total_reward_wei,
+            min_reward_wei=min_reward_wei,
+        )
+        assert all(reward >= min_reward_wei for reward in rewards if reward)
+        if recipients:
+            assert sum(rewards) == total_reward_wei
@@ -0,0 +1,236 @@
+import pytest
+import requests
+from eth_utils import to_checksum_address
+from web3 import Web3
+
+from sovryn_airdrop import balances, web3_utils
+from sovryn_airdrop.addresses import to_address_bytes
+from sovryn_airdrop.balances import (
+    AGGREGATE_SIZE_RECOVERY_SUCCESSES,
+    BalanceFetcher,
+    BatchBalanceFetcher,
+    MulticallBalanceFetcher,
+)
+from sovryn_airdrop.cache import ContractClassificationCache
+from sovryn_airdrop.providers import PooledHTTPProvider
+from sovryn_airdrop.snapshot import token_from_json
+from sovryn_airdrop.web3_utils import load_abi
+
+from .utils import FakeSession, address
+
+NODE_URI = 'http://node.invalid'
+
+OUT_OF_GAS_ERROR = ValueError({'code': -32000, 'message': 'out of gas'})
+
+
+class FakeMulticall:
+    """Stands in for MulticallBalanceFetcher._try_aggregate, answering every balanceOf call with 1000"""
+    def __init__(self, *, max_calls=None, errors=()):
+        self.max_calls = max_calls
+        self.errors = list(errors)
+        self.aggregated_sizes = []
+
+    def __call__(self, functions):
+        self.aggregated_sizes.append(len(functions))
+        if self.errors:
+            raise self.errors.pop(0)
+        if self.max_calls is not None and len(functions) > self.max_calls:
+            raise OUT_OF_GAS_ERROR
+        return [(True, (1000).to_bytes(32, 'big')) for _ in functions]
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(web3_utils, 'exponential_sleep', lambda attempt: None)
+
+
+@pytest.fixture
+def lp_token(web3):
+    return token_from_json(
+        {'address': address(0x34), 'name': 'LP', 'symbol': 'LP', 'decimals': 18},
+        web3=web3,
+        chain_id=31,
+    )
+
+
+@pytest.fixture
+def fetcher(config, web3, lp_token) -> MulticallBalanceFetcher:
+    return MulticallBalanceFetcher(
+        web3=web3,
+        holding_token=config.holding_token,
+        lp_token=lp_token,
+        liquidity_mining=None,
+        block_number=100,
+        chunk_size=8,
+    )
+
+
+def test_too_large_aggregate_is_split_and_size_recovers(fetcher, monkeypatch):
+    # Two calls per address, so at most 2 addresses fit in one aggregated call at first
+    multicall = FakeMulticall(max_calls=4)
+    monkeypatch.setattr(fetcher, '_try_aggregate', multicall)
+
+    result = fetcher.fetch_account_balances([address(i) for i in range(8)])
+    assert [r.holding_token_balance_on_account_wei for r in result] == [1000] * 8
+    assert multicall.aggregated_sizes == [16, 8, 4, 4, 8, 4, 4]
+    assert fetcher.aggregate_size == 2
+    assert fetcher.chunk_size == 8
+
+    # The limit goes away, and the size doubles back after enough successes in a row
+    multicall.max_calls = None
+    fetcher.fetch_account_balances([address(i) for i in range(2 * AGGREGATE_SIZE_RECOVERY_SUCCESSES)])
+    assert fetcher.aggregate_size == 4
+    fetcher.fetch_account_balances([address(i) for i in range(4 * AGGREGATE_SIZE_RECOVERY_SUCCESSES)])
+    assert fetcher.aggregate_size == 8
+    multicall.aggregated_sizes.clear()
+    fetcher.fetch_account_balances([address(i) for i in range(8)])
+    assert multicall.aggregated_sizes == [16]
+
+
+def test_transient_errors_are_retried_without_splitting(fetcher, monkeypatch):
+    multicall = FakeMulticall(errors=[
+        requests.exceptions.ConnectionError('connection refused'),
+        ValueError({'code': -32000, 'message': 'header not found'}),
+    ])
+    monkeypatch.setattr(fetcher, '_try_aggregate', multicall)
+    monkeypatch.setattr(fetcher, 'fetch_account_balances_one', None)
+
+    result = fetcher.fetch_account_balances([address(i) for i in range(4)])
+    assert len(result) == 4
+    assert multicall.aggregated_sizes == [8, 8, 8]
+    assert fetcher.aggregate_size == 8
+
+
+def test_fatal_errors_are_raised(fetcher, monkeypatch):
+    multicall = FakeMulticall(errors=[ValueError({'code': -32602, 'message': 'invalid argument 0'})])
+    monkeypatch.setattr(fetcher, '_try_aggregate', multicall)
+    with pytest.raises(ValueError, match='invalid argument'):
+        fetcher.fetch_account_balances([address(i) for i in range(4)])
+    assert multicall.aggregated_sizes == [8]
+
+
+def test_single_address_too_large_is_fetched_separately(fetcher, monkeypatch):
+    monkeypatch.setattr(fetcher, '_try_aggregate', FakeMulticall(max_calls=1))
+    monkeypatch.setattr(
+        fetcher,
+        'fetch_account_balances_one',
+        lambda a: balances.AddressBalances(address=a, is_contract=False, holding_token_balance_on_account_wei=5),
+    )
+    result = fetcher.fetch_account_balances([address(1)])
+    assert result[0].holding_token_balance_on_account_wei == 5
+
+
+def test_contract_classifications_are_cached_by_snapshot_block(config, node, lp_token, tmp_path):
+    cache = ContractClassificationCache(str(tmp_path / 'contracts.sqlite'))
+    node.codes = {address(1).lower(): '0x6080', address(2).lower(): '0x6080'}
+    addresses = [address(i) for i in range(1, 5)]
+
+    def run(snapshot_block_number):
+        """Classify the addresses like a new process would, and return the addresses whose code was fetched"""
+        node.requests.clear()
+        fetcher = BalanceFetcher(
+            web3=Web3(node),
+            holding_token=config.holding_token,
+            lp_token=lp_token,
+            liquidity_mining=None,
+            block_number=snapshot_block_number,
+            contract_cache=cache,
+        )
+        assert fetcher.get_contract_flags(addresses) == [True, True, False, False]
+        code_requests = [params for (method, params) in node.requests if method == 'eth_getCode']
+        assert all(block == hex(snapshot_block_number) for (_, block) in code_requests)
+        return [to_checksum_address(code_address) for (code_address, _) in code_requests]
+
+    assert run(900) == addresses
+    # Re-running for the same snapshot makes no eth_getCode calls at all
+    assert run(900) == []
+    # Addresses without code at block 900 had none at block 800 either
+    assert run(800) == [address(1), address(2)]
+    # Contracts at block 900 are still contracts at block 1000
+    assert run(1000) == [address(3), address(4)]
+    assert run(1000) == []
+    assert cache.get_known(
+        chain_id=31,
+        addresses=[to_address_bytes(a) for a in addresses],
+        block_number=850,
+    ) == {
+        to_address_bytes(address(1)): True,
+        to_address_bytes(address(2)): True,
+        to_address_bytes(address(3)): False,
+        to_address_bytes(address(4)): False,
+    }
+
+
+@pytest.fixture
+def batch_fetcher(config, node, lp_token) -> BatchBalanceFetcher:
+    web3 = Web3(PooledHTTPProvider([NODE_URI], session=FakeSession({NODE_URI: node})))
+    # getUserInfo returns (amount, rewardDebt, accumulatedReward), balanceOf only reads the first word
+    node.call_result = '0x' + b''.join(n.to_bytes(32, 'big') for n in (1000, 1, 2)).hex()
+    return BatchBalanceFetcher(
+        web3=web3,
+        holding_token=config.holding_token,
+        lp_token=lp_token,
+        liquidity_mining=web3.eth.contract(address=address(0x77), abi=load_abi('LiquidityMining')),
+        block_number=100,
+        chunk_size=8,
+    )
+
+
+def get_call_data(function) -> str:
+    return function._encode_transaction_data()
+
+
+def test_batch_errors_are_fetched_separately(batch_fetcher, node):
+    holding_balance_call = batch_fetcher.get_balance_calls(address(2))[0]
+    node.queued_call_responses[get_call_data(holding_balance_call)] = [
+        {'error': {'code': -32000, 'message': 'header not found'}},
+    ]
+
+    result = batch_fetcher.fetch_account_balances([address(i) for i in range(1, 4)])
+    assert [r.address for r in result] == [address(i) for i in range(1, 4)]
+    assert [
+        (r.holding_token_balance_on_account_wei, r.lp_token_balance_on_account_wei,
+         r.lp_token_balance_on_liquidity_mining_wei)
+        for r in result
+    ] == [(1000, 1000, 1000)] * 3
+    # One batch for all calls, then the calls of the failed address one at a time
+    call_data = [params[0]['data'] for (method, params) in node.requests if method == 'eth_call']
+    assert call_data[9:] == [get_call_data(f) for f in batch_fetcher.get_balance_calls(address(2))]
+
+
+def test_undecodable_batch_results_are_fetched_separately(batch_fetcher, node):
+    # getUserInfo answered with empty return data instead of an error
+    user_info_call = batch_fetcher.get_balance_calls(address(2))[2]
+    node.queued_call_responses[get_call_data(user_info_call)] = [{'result': '0x'}]
+
+    result = batch_fetcher.fetch_account_balances([address(i) for i in range(1, 4)])
+    assert [r.lp_token_balance_on_liquidity_mining_wei for r in result] == [1000] * 3
+    call_data = [params[0]['data'] for (method, params) in node.requests if method == 'eth_call']
+    assert call_data[9:] == [get_call_data(f) for f in batch_fetcher.get_balance_calls(address(2))]
+
+
+def test_undecodable_aggregated_results_are_fetched_separately(fetcher, monkeypatch):
+    def try_aggregate(functions):
+        return [(True, b'' if i == 2 else (1000).to_bytes(32, 'big')) for i in range(len(functions))]
+
+    monkeypatch.setattr(fetcher, '_try_aggregate', try_aggregate)
+    monkeypatch.setattr(
+        fetcher,
+        'fetch_account_balances_one',
+        lambda a: balances.AddressBalances(address=a, is_contract=False, holding_token_balance_on_account_wei=5),
+    )
+    result = fetcher.fetch_account_balances([address(i) for i in range(3)])
+    assert [r.holding_token_balance_on_account_wei for r in result] == [1000, 5, 1000]
+
+
+def test_aggregate_size_is_shared_by_concurrent_workers(fetcher, monkeypatch):
+    multicall = FakeMulticall(max_calls=4)
+    monkeypatch.setattr(fetcher, '_try_aggregate', multicall)
+    addresses = [address(i) for i in range(200)]
+
+    chunks = list(fetcher.iter_balances(addresses, concurrency=4))
+    assert [r.address for chunk in chunks for r in chunk] == addresses
+    assert all(r.holding_token_balance_on_account_wei == 1000 for chunk in chunks for r in chunk)
+    # After enough successes the size is doubled to 4 addresses, which is too many, so it ends up at either size
+    assert fetcher.aggregate_size in (2, 4)
+    assert fetcher._num_aggregate_successes < AGGREGATE_SIZE_RECOVERY_SUCCESSES
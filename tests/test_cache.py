@@ -0,0 +1,137 @@
+import pytest
+from hexbytes import HexBytes
+from web3.datastructures import AttributeDict
+
+from sovryn_airdrop.cache import EventLogCache, merge_block_ranges
+from sovryn_airdrop.web3_utils import iter_event_log_batches
+
+from .utils import REWARD_TOKEN_ADDRESS, REWARDER_ACCOUNT_ADDRESS, TRANSFER_TOPIC, address
+
+KEY = dict(chain_id=31, address=REWARD_TOKEN_ADDRESS, topic=TRANSFER_TOPIC.hex())
+
+
+def make_log(block_number: int, log_index: int = 0) -> AttributeDict:
+    return AttributeDict({
+        'address': REWARD_TOKEN_ADDRESS,
+        'topics': [HexBytes(TRANSFER_TOPIC), HexBytes('0x' + '00' * 31 + '01')],
+        'data': '0x' + block_number.to_bytes(32, 'big').hex(),
+        'blockNumber': block_number,
+        'blockHash': HexBytes(block_number.to_bytes(32, 'big')),
+        'transactionHash': HexBytes((block_number * 100 + log_index).to_bytes(32, 'big')),
+        'transactionIndex': 0,
+        'logIndex': log_index,
+        'removed': False,
+    })
+
+
+@pytest.fixture
+def cache(tmp_path) -> EventLogCache:
+    cache = EventLogCache(str(tmp_path / 'events.sqlite'))
+    yield cache
+    cache.close()
+
+
+def test_merge_block_ranges():
+    assert merge_block_ranges([]) == []
+    assert merge_block_ranges([(20, 30), (1, 10), (11, 12), (5, 8), (32, 40)]) == [(1, 12), (20, 30), (32, 40)]
+
+
+def test_split_range_without_cached_ranges(cache):
+    assert cache.split_range(from_block=1, to_block=100, **KEY) == [(1, 100, False)]
+
+
+def test_split_range(cache):
+    cache.store_logs(from_block=10, to_block=19, logs=[], **KEY)
+    cache.store_logs(from_block=30, to_block=39, logs=[], **KEY)
+
+    assert cache.split_range(from_block=1, to_block=100, **KEY) == [
+        (1, 9, False),
+        (10, 19, True),
+        (20, 29, False),
+        (30, 39, True),
+        (40, 100, False),
+    ]
+    # Ranges that start or end inside cached ranges
+    assert cache.split_range(from_block=15, to_block=32, **KEY) == [
+        (15, 19, True),
+        (20, 29, False),
+        (30, 32, True),
+    ]
+    assert cache.split_range(from_block=12, to_block=14, **KEY) == [(12, 14, True)]
+    assert cache.split_range(from_block=20, to_block=29, **KEY) == [(20, 29, False)]
+    # Other events and chains have their own ranges
+    assert cache.split_range(from_block=10, to_block=19, **dict(KEY, topic='0x' + '00' * 32)) == [(10, 19, False)]
+    assert cache.split_range(from_block=10, to_block=19, **dict(KEY, chain_id=30)) == [(10, 19, False)]
+
+
+def test_store_logs_merges_ranges(cache):
+    cache.store_logs(from_block=10, to_block=19, logs=[], **KEY)
+    cache.store_logs(from_block=20, to_block=29, logs=[], **KEY)
+    cache.store_logs(from_block=25, to_block=34, logs=[], **KEY)
+    cache.store_logs(from_block=50, to_block=59, logs=[], **KEY)
+    assert cache.get_cached_ranges(**KEY) == [(10, 34), (50, 59)]
+    # Addresses and topics are case insensitive
+    assert cache.get_cached_ranges(**dict(KEY, address=REWARD_TOKEN_ADDRESS.lower())) == [(10, 34), (50, 59)]
+
+
+def test_store_logs_round_trip(cache):
+    logs = [make_log(10), make_log(12, 0), make_log(12, 1), make_log(19)]
+    # Stored out of order, and a range that is stored again doesn't duplicate its logs
+    cache.store_logs(from_block=10, to_block=19, logs=reversed(logs), **KEY)
+    cache.store_logs(from_block=12, to_block=12, logs=logs[1:3], **KEY)
+
+    assert cache.get_logs(from_block=10, to_block=19, **KEY) == logs
+    assert cache.get_logs(from_block=11, to_block=12, **KEY) == logs[1:3]
+    assert cache.get_logs(from_block=10, to_block=19, **dict(KEY, chain_id=30)) == []
+    stored = cache.get_logs(from_block=19, to_block=19, **KEY)[0]
+    assert isinstance(stored['transactionHash'], HexBytes)
+    assert all(isinstance(topic, HexBytes) for topic in stored['topics'])
+
+
+def test_cache_persists(tmp_path):
+    path = str(tmp_path / 'events.sqlite')
+    cache = EventLogCache(path)
+    cache.store_logs(from_block=10, to_block=19, logs=[make_log(15)], **KEY)
+    cache.close()
+
+    cache = EventLogCache(path)
+    assert cache.get_cached_ranges(**KEY) == [(10, 19)]
+    assert cache.get_logs(from_block=10, to_block=19, **KEY) == [make_log(15)]
+    cache.close()
+
+
+def test_scan_only_fetches_missing_ranges(node, config, cache):
+    node.head_block = 1000
+    for block_number in range(0, 1000, 50):
+        node.add_transfer_log(
+            from_address=REWARDER_ACCOUNT_ADDRESS,
+            to_address=address(block_number + 1),
+            value=1,
+            transaction_hash='0x' + block_number.to_bytes(32, 'big').hex(),
+            block_number=block_number,
+        )
+    transfer_event = config.reward_token.contract.events.Transfer()
+
+    def scan(from_block, to_block):
+        node.requests.clear()
+        batches = list(iter_event_log_batches(
+            event=transfer_event,
+            from_block=from_block,
+            to_block=to_block,
+            batch_size=100,
+            cache=cache,
+        ))
+        fetched_ranges = [
+            (int(params[0]['fromBlock'], 16), int(params[0]['toBlock'], 16))
+            for (method, params) in node.requests
+            if method == 'eth_getLogs'
+        ]
+        # Only the merged fetched ranges matter, not how they are batched
+        return [log['blockNumber'] for batch in batches for log in batch.logs], merge_block_ranges(fetched_ranges)
+
+    assert scan(0, 499) == (list(range(0, 500, 50)), [(0, 499)])
+    assert scan(0, 499) == (list(range(0, 500, 50)), [])
+    # Blocks after the last final block (head - FINALITY_CONFIRMATIONS) are fetched again on every scan
+    assert scan(300, 999) == (list(range(300, 1000, 50)), [(500, 999)])
+    assert cache.get_cached_ranges(**KEY) == [(0, 900)]
+    assert scan(850, 999) == (list(range(850, 1000, 50)), [(901, 999)])
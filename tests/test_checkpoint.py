@@ -0,0 +1,111 @@
+import json
+
+import pytest
+
+from sovryn_airdrop.addresses import to_address_bytes
+from sovryn_airdrop.balances import AddressBalances
+from sovryn_airdrop.checkpoint import SnapshotCheckpoint, load_checkpoint
+
+from .utils import address
+
+IDENTITY = {
+    'chainId': 31,
+    'snapshotBlockNumber': 100,
+    'firstScannedBlockNumber': 1,
+    'holdingTokenAddress': address(0x12),
+    'lpTokenAddress': address(0x13),
+}
+POSSIBLE_ADDRESSES = [to_address_bytes(address(n)) for n in range(1, 6)]
+
+
+def make_balances(n: int, *, is_contract: bool = False) -> AddressBalances:
+    if is_contract:
+        return AddressBalances(address=to_address_bytes(address(n)), is_contract=True)
+    return AddressBalances(
+        address=to_address_bytes(address(n)),
+        is_contract=False,
+        holding_token_balance_on_account_wei=n * 10 ** 30,
+        lp_token_balance_on_account_wei=n,
+        lp_token_balance_on_liquidity_mining_wei=2 * n,
+    )
+
+
+@pytest.fixture
+def checkpoint_file(tmp_path) -> str:
+    return str(tmp_path / 'snapshot.json.checkpoint')
+
+
+def test_missing_checkpoint(checkpoint_file):
+    assert load_checkpoint(checkpoint_file) is None
+
+
+def test_checkpoint_round_trip(checkpoint_file):
+    with SnapshotCheckpoint.create(
+        checkpoint_file,
+        identity=IDENTITY,
+        possible_addresses=POSSIBLE_ADDRESSES,
+    ) as checkpoint:
+        checkpoint.record_balances([make_balances(1), make_balances(2, is_contract=True)])
+        checkpoint.record_balances([make_balances(3)])
+
+    data = load_checkpoint(checkpoint_file)
+    assert data.identity == IDENTITY
+    assert data.possible_addresses == POSSIBLE_ADDRESSES
+    assert data.balances == [make_balances(1), make_balances(2, is_contract=True), make_balances(3)]
+
+
+def test_resume_after_crash(checkpoint_file):
+    with SnapshotCheckpoint.create(
+        checkpoint_file,
+        identity=IDENTITY,
+        possible_addresses=POSSIBLE_ADDRESSES,
+    ) as checkpoint:
+        checkpoint.record_balances([make_balances(1), make_balances(2)])
+    # Crash while writing the next chunk
+    with open(checkpoint_file, 'a') as f:
+        f.write('{"balances": [["' + address(3))
+
+    data = load_checkpoint(checkpoint_file)
+    assert data.possible_addresses == POSSIBLE_ADDRESSES
+    assert data.balances == [make_balances(1), make_balances(2)]
+
+    # The resumed snapshot fetches the rest and appends them after the complete chunks
+    with SnapshotCheckpoint(checkpoint_file) as checkpoint:
+        checkpoint.record_balances([make_balances(3), make_balances(4)])
+        checkpoint.record_balances([make_balances(5, is_contract=True)])
+
+    data = load_checkpoint(checkpoint_file)
+    assert data.identity == IDENTITY
+    assert data.balances == [
+        make_balances(1),
+        make_balances(2),
+        make_balances(3),
+        make_balances(4),
+        make_balances(5, is_contract=True),
+    ]
+
+
+def test_torn_header_is_no_checkpoint(checkpoint_file):
+    with open(checkpoint_file, 'w') as f:
+        f.write('{"version": 1, "identity": {')
+    assert load_checkpoint(checkpoint_file) is None
+
+
+def test_create_replaces_old_checkpoint(checkpoint_file):
+    with SnapshotCheckpoint.create(checkpoint_file, identity=IDENTITY, possible_addresses=POSSIBLE_ADDRESSES) as c:
+        c.record_balances([make_balances(1)])
+    other_identity = dict(IDENTITY, snapshotBlockNumber=200)
+    with SnapshotCheckpoint.create(checkpoint_file, identity=other_identity, possible_addresses=[]):
+        pass
+
+    data = load_checkpoint(checkpoint_file)
+    assert data.identity == other_identity
+    assert data.possible_addresses == []
+    assert data.balances == []
+
+
+def test_unsupported_version(checkpoint_file):
+    with open(checkpoint_file, 'w') as f:
+        f.write(json.dumps({'version': 999, 'identity': IDENTITY, 'possibleAddresses': []}) + '\n')
+    with pytest.raises(ValueError, match='Unsupported checkpoint version'):
+        load_checkpoint(checkpoint_file)
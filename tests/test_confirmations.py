@@ -0,0 +1,103 @@
+import pytest
+
+from sovryn_airdrop.airdrop import AirdropBatch
+from sovryn_airdrop.confirmations import ConfirmationTracker
+
+from .utils import DISPERSE_ADDRESS, OTHER_REWARDER_ACCOUNT_ADDRESS, REWARDER_ACCOUNT_ADDRESS, address
+
+BATCH_HASH = '0x' + '01' * 32
+SINGLE_HASH = '0x' + '02' * 32
+
+
+@pytest.fixture
+def batch(airdrop) -> AirdropBatch:
+    for i in range(3):
+        airdrop.add_transaction(
+            to_address=address(i + 1),
+            reward_amount_wei=100 * (i + 1),
+            transaction_nonce=5,
+            transaction_hash=BATCH_HASH,
+            batch_number=1,
+            rewarder_account_address=REWARDER_ACCOUNT_ADDRESS,
+        )
+    return AirdropBatch(airdrop=airdrop, batch_number=1, transactions=list(airdrop.transactions))
+
+
+@pytest.fixture
+def tracker(airdrop) -> ConfirmationTracker:
+    return ConfirmationTracker(
+        airdrop=airdrop,
+        rewarder_account_addresses=[REWARDER_ACCOUNT_ADDRESS, OTHER_REWARDER_ACCOUNT_ADDRESS],
+        from_block=50,
+    )
+
+
+def add_batch_logs(node, batch, *, from_address=REWARDER_ACCOUNT_ADDRESS, block_number=60):
+    for i, transaction in enumerate(batch.transactions):
+        node.add_transfer_log(
+            from_address=from_address,
+            to_address=transaction.to_address,
+            value=transaction.reward_amount_wei,
+            transaction_hash=BATCH_HASH,
+            block_number=block_number,
+            log_index=i,
+        )
+
+
+def test_batch_confirmed_from_logs(node, batch, tracker):
+    add_batch_logs(node, batch)
+    tracker.add(batch)
+    assert tracker.poll() == [batch]
+    assert tracker.num_outstanding == 0
+    assert tracker.next_block == node.head_block + 1
+
+
+def test_single_transfer_confirmed_from_logs(node, airdrop, tracker):
+    airdrop.add_transaction(
+        to_address=address(9),
+        reward_amount_wei=900,
+        transaction_nonce=6,
+        transaction_hash=SINGLE_HASH,
+        rewarder_account_address=OTHER_REWARDER_ACCOUNT_ADDRESS,
+    )
+    transaction = airdrop.transactions[-1]
+    node.add_transfer_log(
+        from_address=OTHER_REWARDER_ACCOUNT_ADDRESS,
+        to_address=transaction.to_address,
+        value=900,
+        transaction_hash=SINGLE_HASH,
+        block_number=70,
+    )
+    tracker.add(transaction)
+    assert tracker.poll() == [transaction]
+
+
+def test_unmined_transaction_stays_outstanding(node, batch, tracker):
+    tracker.add(batch)
+    assert tracker.poll() == []
+    assert tracker.outstanding == [batch]
+
+
+def test_transfers_from_other_senders_are_not_scanned(node, batch, tracker):
+    # What a disperseToken batch would emit. The scan only asks for Transfers from the rewarder accounts.
+    add_batch_logs(node, batch, from_address=DISPERSE_ADDRESS)
+    tracker.add(batch)
+    assert tracker.poll() == []
+    (method, params), = [r for r in node.requests if r[0] == 'eth_getLogs']
+    assert params[0]['fromBlock'] == hex(50)
+    assert params[0]['toBlock'] == hex(node.head_block)
+
+
+def test_wrong_transfers_raise(node, batch, tracker):
+    add_batch_logs(node, batch)
+    node.logs.pop()
+    tracker.add(batch)
+    with pytest.raises(ValueError, match='do not match the plan'):
+        tracker.poll()
+
+
+def test_used_nonce_without_logs_or_receipt_raises(node, batch, tracker):
+    node.nonces[REWARDER_ACCOUNT_ADDRESS.lower()] = 6
+    tracker.add(batch)
+    with pytest.raises(ValueError, match='used by another transaction'):
+        tracker.poll()
@@ -0,0 +1,154 @@
+import os
+
+import pytest
+
+from sovryn_airdrop import journal as journal_module
+from sovryn_airdrop.airdrop import Airdrop
+from sovryn_airdrop.journal import (
+    JOURNAL_STATUS_MINED,
+    JOURNAL_STATUS_SENT,
+    JournalRecord,
+    SendJournal,
+    get_journal_file_path,
+    read_journal,
+    truncate_incomplete_record,
+)
+
+from .utils import OTHER_REWARDER_ACCOUNT_ADDRESS, REWARDER_ACCOUNT_ADDRESS, address
+
+HASH_1 = '0x' + '01' * 32
+HASH_2 = '0x' + '02' * 32
+HASH_3 = '0x' + '03' * 32
+
+
+def record(journal: SendJournal, transaction_nonce: int, transaction_hash: str, status=JOURNAL_STATUS_SENT):
+    journal.record(
+        rewarder_account_address=REWARDER_ACCOUNT_ADDRESS,
+        transaction_nonce=transaction_nonce,
+        transaction_hash=transaction_hash,
+        status=status,
+    )
+
+
+@pytest.fixture
+def journal_file(tmp_path) -> str:
+    return str(tmp_path / 'plan.csv.journal')
+
+
+def test_read_journal_missing_file(journal_file):
+    assert list(read_journal(journal_file)) == []
+
+
+def test_records_are_read_in_order(journal_file):
+    with SendJournal(journal_file) as journal:
+        record(journal, 1, HASH_1)
+        record(journal, 1, HASH_1, JOURNAL_STATUS_MINED)
+        record(journal, 2, HASH_2)
+    assert [(r.transaction_nonce, r.status) for r in read_journal(journal_file)] == [
+        (1, JOURNAL_STATUS_SENT),
+        (1, JOURNAL_STATUS_MINED),
+        (2, JOURNAL_STATUS_SENT),
+    ]
+
+
+def test_torn_last_record_is_skipped_and_truncated(journal_file):
+    with SendJournal(journal_file) as journal:
+        record(journal, 1, HASH_1)
+    with open(journal_file) as f:
+        complete = f.read()
+    # Crash in the middle of writing the second record
+    with open(journal_file, 'a') as f:
+        f.write('{"rewarder_account_address": "0x')
+
+    assert [r.transaction_hash for r in read_journal(journal_file)] == [HASH_1]
+
+    # Appending after the torn record would make the next record unreadable too
+    with SendJournal(journal_file) as journal:
+        record(journal, 2, HASH_2)
+    with open(journal_file) as f:
+        assert f.read().startswith(complete + '{')
+    assert [r.transaction_hash for r in read_journal(journal_file)] == [HASH_1, HASH_2]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096])
+def test_truncate_incomplete_record(journal_file, chunk_size):
+    with open(journal_file, 'wb') as f:
+        f.write(b'first\nsecond\nthi')
+    truncate_incomplete_record(journal_file, chunk_size=chunk_size)
+    with open(journal_file, 'rb') as f:
+        assert f.read() == b'first\nsecond\n'
+
+    # Complete files are left as is
+    truncate_incomplete_record(journal_file, chunk_size=chunk_size)
+    with open(journal_file, 'rb') as f:
+        assert f.read() == b'first\nsecond\n'
+
+
+def test_truncate_single_incomplete_record(journal_file):
+    with open(journal_file, 'wb') as f:
+        f.write(b'{"rewarder')
+    truncate_incomplete_record(journal_file)
+    assert os.path.getsize(journal_file) == 0
+
+
+def test_record_is_fsynced_before_returning(journal_file, monkeypatch):
+    synced_sizes = []
+
+    def fsync(fd):
+        synced_sizes.append(os.fstat(fd).st_size)
+
+    monkeypatch.setattr(journal_module.os, 'fsync', fsync)
+    with SendJournal(journal_file) as journal:
+        record(journal, 1, HASH_1)
+        # The whole record reached the file before it was synced
+        assert synced_sizes == [os.path.getsize(journal_file)]
+        assert synced_sizes[0] > 0
+        record(journal, 2, HASH_2)
+        assert len(synced_sizes) == 2
+        assert synced_sizes[1] == os.path.getsize(journal_file) > synced_sizes[0]
+
+
+def test_replay_after_crash(config, tmp_path):
+    plan_file = str(tmp_path / 'plan.csv')
+    airdrop = Airdrop(config=config)
+    airdrop.add_transaction(to_address=address(1), reward_amount_wei=10, transaction_nonce=1)
+    airdrop.add_transaction(to_address=address(2), reward_amount_wei=20, transaction_nonce=2)
+    # A Disperse batch, whose rows share the nonce
+    for n in (3, 4):
+        airdrop.add_transaction(to_address=address(n), reward_amount_wei=30, transaction_nonce=3, batch_number=0)
+    # Same nonce, other sender
+    airdrop.add_transaction(
+        to_address=address(5),
+        reward_amount_wei=50,
+        transaction_nonce=1,
+        rewarder_account_address=OTHER_REWARDER_ACCOUNT_ADDRESS,
+    )
+    airdrop.save(plan_file)
+
+    # Sending crashes after journaling some transactions, without rewriting the plan
+    with SendJournal(get_journal_file_path(plan_file)) as journal:
+        record(journal, 1, HASH_1)
+        record(journal, 1, HASH_1, JOURNAL_STATUS_MINED)
+        record(journal, 3, HASH_3)
+    with open(get_journal_file_path(plan_file), 'a') as f:
+        f.write('{"rewarder_account_address": "' + REWARDER_ACCOUNT_ADDRESS)
+
+    replayed = Airdrop.from_file(plan_file, config=config)
+    assert [t.transaction_hash for t in replayed.transactions] == [HASH_1, None, HASH_3, HASH_3, None]
+
+    # Compacting writes the hashes into the plan and removes the journal
+    replayed.save(plan_file)
+    assert not os.path.exists(get_journal_file_path(plan_file))
+    reloaded = Airdrop.from_file(plan_file, config=config)
+    assert [t.transaction_hash for t in reloaded.transactions] == [HASH_1, None, HASH_3, HASH_3, None]
+
+
+def test_journal_record_fields(journal_file):
+    with SendJournal(journal_file) as journal:
+        record(journal, 7, HASH_1, JOURNAL_STATUS_MINED)
+    assert list(read_journal(journal_file)) == [JournalRecord(
+        rewarder_account_address=REWARDER_ACCOUNT_ADDRESS,
+        transaction_nonce=7,
+        transaction_hash=HASH_1,
+        status=JOURNAL_STATUS_MINED,
+    )]
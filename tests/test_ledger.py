@@ -0,0 +1,156 @@
+import random
+
+import pytest
+from hexbytes import HexBytes
+from web3.datastructures import AttributeDict
+
+from sovryn_airdrop import ledger as ledger_module
+from sovryn_airdrop.addresses import to_address_bytes
+from sovryn_airdrop.ledger import (
+    BalanceLedger,
+    LedgerMismatch,
+    StakedBalanceIndex,
+    get_staking_events,
+    verify_ledger_sample,
+)
+from sovryn_airdrop.web3_utils import address_to_topic, get_event_topic, load_abi
+
+from .utils import address
+
+ZERO = '0x' + '00' * 20
+LP_TOKEN_ADDRESS = address(0x78)
+OTHER_LP_TOKEN_ADDRESS = address(0x79)
+
+
+def test_ledger_replays_transfers(make_transfer_log):
+    ledger = BalanceLedger(target_block_number=100)
+    logs = [
+        make_transfer_log(from_address=ZERO, to_address=address(1), value=100, block_number=1),
+        make_transfer_log(from_address=address(1), to_address=address(2), value=30, block_number=2),
+        make_transfer_log(from_address=address(2), to_address=address(3), value=10, block_number=3),
+        # Burn
+        make_transfer_log(from_address=address(3), to_address=ZERO, value=10, block_number=4),
+        # After the target block
+        make_transfer_log(from_address=address(1), to_address=address(2), value=70, block_number=101),
+    ]
+    # In any order, like the sharded scans return them
+    ledger.apply_transfer_logs(reversed(logs))
+
+    assert ledger.balance_of(address(1)) == 70
+    assert ledger.balance_of(address(2)) == 20
+    assert ledger.balance_of(address(3)) == 0
+    assert ledger.balance_of(address(4)) == 0
+    assert ledger.balance_of(ZERO) == 0
+    assert ledger.total_supply == 90
+    assert ledger.num_transfers == 4
+    assert sorted(ledger.get_nonzero_balance_addresses()) == sorted(
+        to_address_bytes(a) for a in (address(1), address(2))
+    )
+    assert ledger.get_negative_balance_addresses() == []
+
+
+def test_ledger_with_missing_transfers_has_negative_balances(make_transfer_log):
+    # The scan started after the tokens of address(1) were minted
+    ledger = BalanceLedger(target_block_number=100)
+    ledger.apply_transfer_log(make_transfer_log(from_address=address(1), to_address=address(2), value=30))
+    assert ledger.get_negative_balance_addresses() == [to_address_bytes(address(1))]
+    assert ledger.total_supply == 0
+
+
+def test_verify_ledger_sample(make_transfer_log, config, monkeypatch):
+    ledger = BalanceLedger(target_block_number=100)
+    for n in range(1, 51):
+        ledger.apply_transfer_log(make_transfer_log(from_address=ZERO, to_address=address(n), value=n))
+    actual_balances = {address(n): n for n in range(1, 51)}
+    actual_balances[address(7)] = 8
+    fetched = []
+
+    def fetch_balance_in_block(*, token, address, block_number):
+        assert block_number == 100
+        fetched.append(address)
+        return actual_balances[address]
+
+    monkeypatch.setattr(ledger_module, 'fetch_balance_in_block', fetch_balance_in_block)
+    mismatches = verify_ledger_sample(
+        ledger=ledger,
+        token=config.holding_token,
+        addresses=ledger.get_nonzero_balance_addresses(),
+        sample_size=50,
+        rng=random.Random(1),
+    )
+    assert len(fetched) == 50
+    assert mismatches == [LedgerMismatch(
+        address=to_address_bytes(address(7)),
+        ledger_balance_wei=7,
+        actual_balance_wei=8,
+    )]
+
+    # The sample is the same for the same seed, whatever the order of the addresses
+    fetched.clear()
+    verify_ledger_sample(
+        ledger=ledger,
+        token=config.holding_token,
+        addresses=list(reversed(ledger.get_nonzero_balance_addresses())),
+        sample_size=5,
+        rng=random.Random(2),
+    )
+    first_sample = list(fetched)
+    fetched.clear()
+    verify_ledger_sample(
+        ledger=ledger,
+        token=config.holding_token,
+        addresses=ledger.get_nonzero_balance_addresses(),
+        sample_size=5,
+        rng=random.Random(2),
+    )
+    assert len(first_sample) == 5
+    assert fetched == first_sample
+
+
+@pytest.fixture
+def liquidity_mining(web3):
+    return web3.eth.contract(address=address(0x77), abi=load_abi('LiquidityMining'))
+
+
+def test_staked_balance_index_replays_events(liquidity_mining):
+    deposit, withdraw, emergency_withdraw = get_staking_events(liquidity_mining)
+
+    def make_log(event, user, amount, *, block_number=10, pool_token=LP_TOKEN_ADDRESS, reward=0):
+        return AttributeDict({
+            'topics': [
+                HexBytes(get_event_topic(event)),
+                HexBytes(address_to_topic(user)),
+                HexBytes(address_to_topic(pool_token)),
+            ],
+            'data': '0x' + amount.to_bytes(32, 'big').hex() + reward.to_bytes(32, 'big').hex(),
+            'blockNumber': block_number,
+        })
+
+    index = StakedBalanceIndex(
+        liquidity_mining=liquidity_mining,
+        pool_token_address=LP_TOKEN_ADDRESS,
+        target_block_number=100,
+    )
+    index.apply_logs([
+        make_log(deposit, address(1), 100),
+        make_log(withdraw, address(1), 40),
+        make_log(deposit, address(2), 50),
+        make_log(emergency_withdraw, address(2), 50, reward=123),
+        make_log(deposit, address(3), 5),
+        # Other pool tokens and blocks after the target are ignored
+        make_log(deposit, address(1), 1000, pool_token=OTHER_LP_TOKEN_ADDRESS),
+        make_log(deposit, address(3), 1000, block_number=101),
+    ])
+
+    assert index.balance_of(address(1)) == 60
+    assert index.balance_of(address(2)) == 0
+    assert index.balance_of(address(3)) == 5
+    assert index.total == 65
+    assert index.num_events == 5
+    assert sorted(index.get_nonzero_balance_addresses()) == sorted(
+        to_address_bytes(a) for a in (address(1), address(3))
+    )
+
+    # A withdrawal whose deposit was before the scanned blocks
+    index.apply_log(make_log(withdraw, address(4), 1))
+    assert index.get_negative_balance_addresses() == [to_address_bytes(address(4))]
@@ -0,0 +1,127 @@
+from typing import List
+
+import click
+import pytest
+from hexbytes import HexBytes
+from web3.datastructures import AttributeDict
+
+from sovryn_airdrop import ledger, planning
+from sovryn_airdrop.ledger import StakedBalanceIndex, get_staking_events
+from sovryn_airdrop.checkpoint import SnapshotCheckpoint
+from sovryn_airdrop.planning import load_resumable_checkpoint, verify_staked_balances
+from sovryn_airdrop.snapshot import token_from_json
+from sovryn_airdrop.web3_utils import address_to_topic, get_event_topic, load_abi, to_address
+
+from .utils import address
+
+LIQUIDITY_MINING_ADDRESS = address(0x77)
+LP_TOKEN_ADDRESS = address(0x78)
+
+
+@pytest.fixture
+def liquidity_mining(web3):
+    return web3.eth.contract(address=LIQUIDITY_MINING_ADDRESS, abi=load_abi('LiquidityMining'))
+
+
+@pytest.fixture
+def lp_token(web3):
+    return token_from_json(
+        {'address': LP_TOKEN_ADDRESS, 'name': 'Pool', 'symbol': 'LP', 'decimals': 18},
+        web3=web3,
+        chain_id=31,
+    )
+
+
+@pytest.fixture
+def staked_index(liquidity_mining) -> StakedBalanceIndex:
+    deposit = get_staking_events(liquidity_mining)[0]
+    index = StakedBalanceIndex(
+        liquidity_mining=liquidity_mining,
+        pool_token_address=LP_TOKEN_ADDRESS,
+        target_block_number=100,
+    )
+    for (log_index, (user, amount)) in enumerate([(address(1), 5), (address(2), 7)]):
+        index.apply_log(AttributeDict({
+            'topics': [
+                HexBytes(get_event_topic(deposit)),
+                HexBytes(address_to_topic(user)),
+                HexBytes(address_to_topic(LP_TOKEN_ADDRESS)),
+            ],
+            'data': '0x' + amount.to_bytes(32, 'big').hex(),
+            'blockNumber': 10,
+            'logIndex': log_index,
+        }))
+    return index
+
+
+@pytest.fixture
+def fake_balances(monkeypatch):
+    """Patch the LP balance of LiquidityMining and getUserInfo, returning the users that getUserInfo was called for"""
+    balances = {'liquidity_mining': 12, 'staked': {address(1): 5, address(2): 7}}
+    queried: List[str] = []
+
+    def fetch_staked(*, address, **kwargs):
+        queried.append(to_address(address))
+        return balances['staked'].get(to_address(address), 0)
+
+    monkeypatch.setattr(planning, 'fetch_balance_in_block', lambda **kwargs: balances['liquidity_mining'])
+    monkeypatch.setattr(ledger, 'fetch_balance_on_liquidity_mining_in_block', fetch_staked)
+    return balances, queried
+
+
+def test_verify_staked_balances_passes(staked_index, liquidity_mining, lp_token, fake_balances):
+    verify_staked_balances(index=staked_index, liquidity_mining=liquidity_mining, lp_token=lp_token)
+
+
+def test_verify_staked_balances_total_mismatch_is_fatal(staked_index, liquidity_mining, lp_token, fake_balances):
+    balances, _ = fake_balances
+    balances['liquidity_mining'] = 13
+    with pytest.raises(click.ClickException, match='LiquidityMining holds 13 LP'):
+        verify_staked_balances(index=staked_index, liquidity_mining=liquidity_mining, lp_token=lp_token)
+
+
+def test_verify_staked_balances_samples_candidates(staked_index, liquidity_mining, lp_token, fake_balances):
+    # A user that the replay missed entirely, with the total still matching by coincidence
+    balances, queried = fake_balances
+    balances['staked'][address(2)] = 4
+    balances['staked'][address(3)] = 3
+    with pytest.raises(click.ClickException, match='2 sampled staked amounts differ'):
+        verify_staked_balances(
+            index=staked_index,
+            liquidity_mining=liquidity_mining,
+            lp_token=lp_token,
+            candidate_addresses=[bytes(HexBytes(address(3)))],
+        )
+    assert sorted(queried) == sorted([address(1), address(2), address(3)])
+
+
+SNAPSHOT_IDENTITY = {
+    'chainId': 31,
+    'snapshotBlockNumber': 100,
+    'firstScannedBlockNumber': 1,
+    'holdingTokenAddress': address(0x12),
+    'lpTokenAddress': LP_TOKEN_ADDRESS,
+    'liquidityMiningAddress': LIQUIDITY_MINING_ADDRESS,
+    'multicallAddress': None,
+    'balancesFromEvents': False,
+    'stakedBalancesFromEvents': False,
+}
+
+
+def test_resume_only_with_the_same_balance_sources(tmp_path):
+    checkpoint_file = str(tmp_path / 'snapshot.json.checkpoint')
+    assert load_resumable_checkpoint(checkpoint_file, identity=SNAPSHOT_IDENTITY) is None
+
+    SnapshotCheckpoint.create(checkpoint_file, identity=SNAPSHOT_IDENTITY, possible_addresses=[]).close()
+    assert load_resumable_checkpoint(checkpoint_file, identity=dict(SNAPSHOT_IDENTITY)).identity == SNAPSHOT_IDENTITY
+
+    with pytest.raises(click.UsageError, match='balancesFromEvents is False instead of True'):
+        load_resumable_checkpoint(checkpoint_file, identity=dict(SNAPSHOT_IDENTITY, balancesFromEvents=True))
+    with pytest.raises(click.UsageError, match='multicallAddress is None instead of'):
+        load_resumable_checkpoint(checkpoint_file, identity=dict(SNAPSHOT_IDENTITY, multicallAddress=address(0x99)))
+
+    # Checkpoints from before the balance sources were recorded
+    old_identity = {key: SNAPSHOT_IDENTITY[key] for key in list(SNAPSHOT_IDENTITY)[:5]}
+    SnapshotCheckpoint.create(checkpoint_file, identity=old_identity, possible_addresses=[]).close()
+    with pytest.raises(click.UsageError, match='stakedBalancesFromEvents is None instead of False'):
+        load_resumable_checkpoint(checkpoint_file, identity=SNAPSHOT_IDENTITY)
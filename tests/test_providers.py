@@ -0,0 +1,186 @@
+import pytest
+from web3 import Web3
+
+from sovryn_airdrop import providers
+from sovryn_airdrop.providers import PINNED_METHODS, PooledHTTPProvider
+
+from .utils import FakeNodeProvider, FakeSession, address
+
+URIS = ['http://node-1.invalid', 'http://node-2.invalid', 'http://node-3.invalid']
+LOG_FILTER = {'address': address(1), 'fromBlock': '0x1', 'toBlock': '0x10'}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    # Also the clock of the rate limiters
+    monkeypatch.setattr(providers.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(providers.time, 'sleep', clock.sleep)
+    return clock
+
+
+@pytest.fixture
+def session() -> FakeSession:
+    return FakeSession({uri: FakeNodeProvider() for uri in URIS})
+
+
+@pytest.fixture
+def provider(session, clock) -> PooledHTTPProvider:
+    return PooledHTTPProvider(URIS, session=session, max_failures=3, ejection_seconds=30.0)
+
+
+def get_stats(provider):
+    return {stats['uri']: stats for stats in provider.get_stats()}
+
+
+def make_requests_until_ejected(provider, session, uri, max_requests=1000):
+    for _ in range(max_requests):
+        if not get_stats(provider)[uri]['healthy']:
+            return
+        provider.make_request('eth_getLogs', [LOG_FILTER])
+    raise AssertionError(f'{uri} was never ejected')
+
+
+def test_failed_requests_are_tried_on_another_endpoint(provider, session):
+    session.failing_uris = set(URIS[:2])
+    for _ in range(10):
+        assert provider.make_request('eth_getLogs', [LOG_FILTER])['result'] == []
+    session.failing_uris = set(URIS)
+    with pytest.raises(Exception, match='is down'):
+        provider.make_request('eth_getLogs', [LOG_FILTER])
+
+
+def test_endpoint_is_ejected_after_max_failures_in_a_row(provider, session, clock):
+    session.failing_uris = {URIS[1]}
+    make_requests_until_ejected(provider, session, URIS[1])
+    stats = get_stats(provider)[URIS[1]]
+    assert stats['failures'] == 3
+    assert stats['requests'] == 3
+
+    # Ejected endpoints get no requests
+    session.posted_uris.clear()
+    for _ in range(50):
+        provider.make_request('eth_getLogs', [LOG_FILTER])
+    assert URIS[1] not in session.posted_uris
+
+    # Successes in between reset the count
+    session.failing_uris.clear()
+    clock.now += 30.0
+    endpoint = provider.endpoints[1]
+    endpoint.consecutive_failures = 0
+    for _ in range(5):
+        provider._record_failure(endpoint)
+        provider._record_failure(endpoint)
+        provider._record_success(endpoint, 0.1)
+    assert get_stats(provider)[URIS[1]]['healthy']
+
+
+def test_ejected_endpoint_is_readmitted_after_ejection_seconds(provider, session, clock):
+    session.failing_uris = {URIS[1]}
+    make_requests_until_ejected(provider, session, URIS[1])
+
+    clock.now += 29.0
+    assert not get_stats(provider)[URIS[1]]['healthy']
+    clock.now += 1.0
+    assert get_stats(provider)[URIS[1]]['healthy']
+
+    # A single failure after the ejection puts it back out
+    make_requests_until_ejected(provider, session, URIS[1])
+    assert get_stats(provider)[URIS[1]]['failures'] == 4
+
+    # Once it works again, it gets requests again
+    clock.now += 30.0
+    session.failing_uris.clear()
+    session.posted_uris.clear()
+    for _ in range(100):
+        provider.make_request('eth_getLogs', [LOG_FILTER])
+    assert URIS[1] in session.posted_uris
+
+
+def test_pinned_methods_go_to_the_first_endpoint(provider, session):
+    web3 = Web3(provider)
+    for _ in range(20):
+        web3.eth.block_number
+        web3.eth.get_transaction_count(address(1))
+    assert set(session.posted_uris) == {URIS[0]}
+    assert {'eth_blockNumber', 'eth_getTransactionCount'} <= PINNED_METHODS
+    # Immutable once mined, so any endpoint will do
+    assert 'eth_getTransactionByHash' not in PINNED_METHODS
+
+    # Not pinned
+    session.posted_uris.clear()
+    for _ in range(50):
+        web3.eth.get_logs(LOG_FILTER)
+    assert len(set(session.posted_uris)) > 1
+
+
+def test_pinned_requests_are_not_tried_elsewhere_until_the_pinned_endpoint_is_ejected(provider, session):
+    session.failing_uris = {URIS[0]}
+    for _ in range(3):
+        with pytest.raises(Exception, match='is down'):
+            provider.make_request('eth_blockNumber', [])
+    assert set(session.posted_uris) == {URIS[0]}
+    assert not get_stats(provider)[URIS[0]]['healthy']
+
+    # The pin moves for good
+    assert provider.make_request('eth_blockNumber', [])['result'] == '0x64'
+    new_pinned_uri = provider.pinned_endpoint_uri
+    assert new_pinned_uri != URIS[0]
+    assert get_stats(provider)[new_pinned_uri]['pinned']
+
+
+def test_pinned_requests_context(provider, session):
+    with provider.pinned_requests():
+        for _ in range(20):
+            provider.make_request('eth_getLogs', [LOG_FILTER])
+    assert set(session.posted_uris) == {URIS[0]}
+
+    session.posted_uris.clear()
+    for _ in range(50):
+        provider.make_request('eth_getLogs', [LOG_FILTER])
+    assert len(set(session.posted_uris)) > 1
+
+
+def test_rate_limit_errors_lower_the_rate_without_counting_as_failures(provider, session):
+    node = session.nodes[URIS[0]]
+    node.make_request = lambda method, params: {
+        'jsonrpc': '2.0', 'id': 1, 'error': {'code': -32005, 'message': 'rate limit exceeded'},
+    }
+    rate_before = get_stats(provider)[URIS[0]]['rate']
+    response = provider.make_request('eth_blockNumber', [])
+    assert response['error']['code'] == -32005
+    stats = get_stats(provider)[URIS[0]]
+    assert stats['rate'] < rate_before
+    assert stats['failures'] == 0
+    assert stats['healthy']
+
+
+def test_log_stats(provider, session, caplog):
+    node = session.nodes[URIS[0]]
+    node.make_request = lambda method, params: {
+        'jsonrpc': '2.0', 'id': 1, 'error': {'code': -32005, 'message': 'rate limit exceeded'},
+    }
+    provider.make_request('eth_blockNumber', [])
+
+    caplog.set_level('INFO', logger=providers.__name__)
+    caplog.clear()
+    provider.log_stats('the test')
+    records = {record.getMessage().split()[2]: record for record in caplog.records}
+    assert set(records) == set(URIS)
+    # The rate limited endpoint is still slowed down
+    assert records[URIS[0]].levelname == 'WARNING'
+    assert 'after the test: 0.5 requests/s, 1 requests, 0 failures' in records[URIS[0]].getMessage()
+    assert records[URIS[0]].getMessage().endswith(', pinned')
+    assert records[URIS[1]].levelname == 'INFO'
+    assert 'latency unknown' in records[URIS[1]].getMessage()
@@ -0,0 +1,93 @@
+import pytest
+import requests
+
+from sovryn_airdrop import web3_utils
+from sovryn_airdrop.rate_limiting import RateLimiter, is_retryable_error, is_throttling_error
+from sovryn_airdrop.web3_utils import retryable
+
+RATE_LIMIT_ERROR = ValueError({'code': -32005, 'message': 'limit exceeded'})
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def exponential_sleep(self, attempt, max_sleep_time=16.0):
+        sleep_time = min(2 ** attempt, max_sleep_time)
+        self.sleeps.append(sleep_time)
+        self.now += sleep_time
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(web3_utils.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(web3_utils, 'exponential_sleep', clock.exponential_sleep)
+    return clock
+
+
+def failing(errors, result='ok'):
+    errors = list(errors)
+    calls = []
+
+    def func():
+        calls.append(None)
+        if errors:
+            raise errors.pop(0)
+        return result
+    func.calls = calls
+    return func
+
+
+def test_error_classification():
+    assert is_throttling_error(RATE_LIMIT_ERROR)
+    assert is_throttling_error(requests.exceptions.ReadTimeout())
+    assert not is_throttling_error(ValueError({'code': -32000, 'message': 'query returned more than 10000 results'}))
+    assert is_retryable_error(requests.exceptions.ConnectionError())
+    assert not is_retryable_error(ValueError({'code': -32000, 'message': 'execution reverted'}))
+    assert not is_retryable_error(ValueError({'code': -32602, 'message': 'bad params'}))
+
+
+def test_throttled_attempts_dont_count_and_back_off_when_rate_limiting_persists(clock):
+    func = failing([RATE_LIMIT_ERROR] * 8)
+    assert retryable(max_attempts=3)(func)() == 'ok'
+    assert len(func.calls) == 9
+    # Retried right away at first, since the rate limiter has slowed down already
+    assert clock.sleeps == [1, 2, 4, 8, 16]
+
+
+def test_throttled_backoff_is_capped_and_gives_up_eventually(clock):
+    func = failing([RATE_LIMIT_ERROR] * 1000)
+    with pytest.raises(ValueError, match='limit exceeded'):
+        retryable(max_attempts=3, max_throttled_seconds=600)(func)()
+    assert max(clock.sleeps) == web3_utils.MAX_THROTTLED_SLEEP_TIME
+    assert 600 <= clock.now < 600 + web3_utils.MAX_THROTTLED_SLEEP_TIME
+
+
+def test_other_errors_count_as_attempts(clock):
+    func = failing([requests.exceptions.ConnectionError('refused')] * 5)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        retryable(max_attempts=2)(func)()
+    assert len(func.calls) == 3
+    assert clock.sleeps == [1, 2]
+
+
+def test_fatal_errors_are_raised_right_away(clock):
+    func = failing([ValueError({'code': 3, 'message': 'execution reverted'})])
+    with pytest.raises(ValueError, match='reverted'):
+        retryable()(func)()
+    assert len(func.calls) == 1
+    assert clock.sleeps == []
+
+
+def test_rate_limiter_stays_above_min_rate():
+    limiter = RateLimiter(initial_rate=100.0, min_rate=0.5, decrease_interval=0.0)
+    for _ in range(20):
+        limiter.throttled()
+    assert 0.5 <= limiter.rate < 0.6
+    with pytest.raises(ValueError):
+        RateLimiter(initial_rate=1.0, min_rate=2.0)
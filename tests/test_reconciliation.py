@@ -0,0 +1,145 @@
+from collections import Counter
+
+import pytest
+
+from sovryn_airdrop.reconciliation import (
+    ISSUE_DUPLICATE,
+    ISSUE_MISSING,
+    ISSUE_UNEXPECTED,
+    ISSUE_WRONG_AMOUNT,
+    ISSUE_WRONG_NONCE,
+    ISSUE_WRONG_TRANSACTION_HASH,
+    TransferRecord,
+    reconcile,
+)
+
+from .utils import OTHER_REWARDER_ACCOUNT_ADDRESS, REWARDER_ACCOUNT_ADDRESS, address
+
+BATCH_HASH = '0x' + '01' * 32
+SINGLE_HASH = '0x' + '02' * 32
+OTHER_HASH = '0x' + '03' * 32
+
+
+@pytest.fixture
+def transactions(airdrop):
+    # A Disperse batch of three rows, and a single transfer from the other rewarder account
+    for i in range(3):
+        airdrop.add_transaction(
+            to_address=address(i + 1),
+            reward_amount_wei=100 * (i + 1),
+            transaction_nonce=5,
+            transaction_hash=BATCH_HASH,
+            batch_number=1,
+            rewarder_account_address=REWARDER_ACCOUNT_ADDRESS,
+        )
+    airdrop.add_transaction(
+        to_address=address(4),
+        reward_amount_wei=400,
+        transaction_nonce=9,
+        transaction_hash=SINGLE_HASH,
+        rewarder_account_address=OTHER_REWARDER_ACCOUNT_ADDRESS,
+    )
+    return airdrop.transactions
+
+
+@pytest.fixture
+def make_transfer(make_transfer_log):
+    log_indexes = iter(range(1000))
+
+    def make(*, to_address, value, from_address=REWARDER_ACCOUNT_ADDRESS, transaction_hash=BATCH_HASH):
+        return TransferRecord.from_log(make_transfer_log(
+            from_address=from_address,
+            to_address=to_address,
+            value=value,
+            transaction_hash=transaction_hash,
+            log_index=next(log_indexes),
+        ))
+    return make
+
+
+@pytest.fixture
+def sent_transfers(make_transfer):
+    # disperseTokenSimple emits one Transfer from the rewarder account per row of the batch
+    return [
+        make_transfer(to_address=address(1), value=100),
+        make_transfer(to_address=address(2), value=200),
+        make_transfer(to_address=address(3), value=300),
+        make_transfer(
+            to_address=address(4),
+            value=400,
+            from_address=OTHER_REWARDER_ACCOUNT_ADDRESS,
+            transaction_hash=SINGLE_HASH,
+        ),
+    ]
+
+
+def issue_kinds(result):
+    return Counter(issue.kind for issue in result.issues)
+
+
+def test_transfer_record_from_log(make_transfer_log):
+    record = TransferRecord.from_log(make_transfer_log(
+        from_address=REWARDER_ACCOUNT_ADDRESS,
+        to_address=address(1),
+        value=12345,
+        transaction_hash=BATCH_HASH,
+        block_number=77,
+        log_index=3,
+    ))
+    assert record.from_address == bytes.fromhex(REWARDER_ACCOUNT_ADDRESS[2:])
+    assert record.to_address == bytes.fromhex(address(1)[2:])
+    assert record.amount_wei == 12345
+    assert record.transaction_hash == BATCH_HASH
+    assert (record.block_number, record.log_index) == (77, 3)
+
+
+def test_batched_and_single_rows_match(transactions, sent_transfers):
+    result = reconcile(
+        transactions=transactions,
+        transfers=sent_transfers,
+        transaction_nonces={BATCH_HASH: 5, SINGLE_HASH: 9},
+    )
+    assert result.issues == []
+    assert (result.num_rows, result.num_transfers, result.num_matched) == (4, 4, 4)
+
+
+def test_missing_row_of_batch(transactions, sent_transfers):
+    result = reconcile(transactions=transactions, transfers=sent_transfers[1:])
+    assert issue_kinds(result) == {ISSUE_MISSING: 1}
+    assert result.issues[0].transaction is transactions[0]
+
+
+def test_wrong_amount_in_batch(transactions, sent_transfers, make_transfer):
+    sent_transfers[1] = make_transfer(to_address=address(2), value=201)
+    result = reconcile(transactions=transactions, transfers=sent_transfers)
+    assert issue_kinds(result) == {ISSUE_WRONG_AMOUNT: 1}
+    assert result.issues[0].transaction is transactions[1]
+
+
+def test_wrong_transaction_hash(transactions, sent_transfers, make_transfer):
+    sent_transfers[0] = make_transfer(to_address=address(1), value=100, transaction_hash=OTHER_HASH)
+    result = reconcile(transactions=transactions, transfers=sent_transfers)
+    assert issue_kinds(result) == {ISSUE_WRONG_TRANSACTION_HASH: 1}
+
+
+def test_wrong_nonce_reported_for_every_row_of_the_batch(transactions, sent_transfers):
+    result = reconcile(
+        transactions=transactions,
+        transfers=sent_transfers,
+        transaction_nonces={BATCH_HASH: 6, SINGLE_HASH: 9},
+    )
+    assert issue_kinds(result) == {ISSUE_WRONG_NONCE: 3}
+
+
+def test_duplicate_and_unexpected_transfers(transactions, sent_transfers, make_transfer):
+    sent_transfers.append(make_transfer(to_address=address(2), value=200, transaction_hash=OTHER_HASH))
+    sent_transfers.append(make_transfer(to_address=address(99), value=1, transaction_hash=OTHER_HASH))
+    result = reconcile(transactions=transactions, transfers=sent_transfers)
+    assert issue_kinds(result) == {ISSUE_DUPLICATE: 1, ISSUE_UNEXPECTED: 1}
+    assert result.num_matched == 4
+
+
+def test_transfer_from_the_wrong_rewarder_account(transactions, sent_transfers, make_transfer):
+    sent_transfers[3] = make_transfer(to_address=address(4), value=400, transaction_hash=SINGLE_HASH)
+    result = reconcile(transactions=transactions, transfers=sent_transfers)
+    assert issue_kinds(result) == {ISSUE_MISSING: 1, ISSUE_DUPLICATE: 1}
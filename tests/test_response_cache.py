@@ -0,0 +1,111 @@
+import pytest
+from web3 import Web3
+
+from sovryn_airdrop.cache import ResponseCache
+from sovryn_airdrop.providers import PooledHTTPProvider
+from sovryn_airdrop.web3_utils import (
+    FINALITY_CONFIRMATIONS,
+    construct_response_cache_middleware,
+    get_response_cache_middleware,
+    make_batch_request,
+)
+
+from .utils import FakeNodeProvider, FakeSession, address
+
+NODE_URI = 'http://node.invalid'
+HEAD_BLOCK = 1000
+FINAL_BLOCK = HEAD_BLOCK - FINALITY_CONFIRMATIONS
+
+
+@pytest.fixture
+def node() -> FakeNodeProvider:
+    return FakeNodeProvider(head_block=HEAD_BLOCK)
+
+
+@pytest.fixture
+def cache(tmp_path) -> ResponseCache:
+    return ResponseCache(str(tmp_path / 'responses.sqlite'))
+
+
+@pytest.fixture
+def web3(node, cache) -> Web3:
+    web3 = Web3(PooledHTTPProvider([NODE_URI], session=FakeSession({NODE_URI: node})))
+    web3.middleware_onion.inject(
+        construct_response_cache_middleware(cache, chain_id=31),
+        name='response_cache',
+        layer=0,
+    )
+    return web3
+
+
+def call_params(block_identifier):
+    return [{'to': address(1), 'data': '0x70a08231'}, block_identifier]
+
+
+def num_calls(node):
+    return sum(1 for (method, _) in node.requests if method == 'eth_call')
+
+
+@pytest.mark.parametrize('block_identifier, cached', [
+    (hex(FINAL_BLOCK - 1), True),
+    (hex(FINAL_BLOCK), True),
+    (hex(FINAL_BLOCK + 1), False),
+    ('latest', False),
+    ('0x' + 'ab' * 32, False),  # Block hash
+])
+def test_only_finalized_blocks_are_cached(web3, node, block_identifier, cached):
+    for _ in range(2):
+        result = web3.manager.request_blocking('eth_call', call_params(block_identifier))
+        assert result.hex() == node.call_result
+    assert num_calls(node) == (1 if cached else 2)
+
+
+def test_finality_is_not_rechecked_for_every_request(web3, node):
+    for i in range(5):
+        web3.manager.request_blocking('eth_call', call_params(hex(FINAL_BLOCK - i)))
+    assert sum(1 for (method, _) in node.requests if method == 'eth_blockNumber') == 1
+
+
+def test_cache_key(web3, cache):
+    response_cache = get_response_cache_middleware(web3)
+
+    def key(method, params):
+        return response_cache.get_cache_key(method, params, get_block_number=lambda: HEAD_BLOCK)
+
+    params = call_params(hex(FINAL_BLOCK))
+    assert key('eth_call', params) == key('eth_call', [{'data': '0x70a08231', 'to': address(1)}, hex(FINAL_BLOCK)])
+    assert key('eth_call', params) != key('eth_call', call_params(hex(FINAL_BLOCK - 1)))
+    assert key('eth_getBalance', [address(1), hex(FINAL_BLOCK)]) is None
+    assert key('eth_getCode', [address(1), hex(FINAL_BLOCK)]) is not None
+    assert key('eth_getCode', [address(1), 'latest']) is None
+    assert key('eth_getLogs', [{'fromBlock': '0x1', 'toBlock': hex(FINAL_BLOCK)}]) is not None
+    assert key('eth_getLogs', [{'fromBlock': '0x1', 'toBlock': 'latest'}]) is None
+
+    # Results are stored by chain id and method too
+    response_cache.store('eth_call', key('eth_call', params), '0x01')
+    assert cache.get(chain_id=31, method='eth_call', params=key('eth_call', params)) == '0x01'
+    assert cache.get(chain_id=30, method='eth_call', params=key('eth_call', params)) is None
+    assert cache.get(chain_id=31, method='eth_estimateGas', params=key('eth_call', params)) is None
+
+
+def test_batch_requests_use_the_cache(web3, node):
+    calls = [
+        ('eth_call', call_params(hex(FINAL_BLOCK))),
+        ('eth_call', call_params(hex(HEAD_BLOCK))),
+        ('eth_getCode', [address(1), 'latest']),
+    ]
+    assert make_batch_request(web3, calls) == [node.call_result, node.call_result, '0x']
+    assert num_calls(node) == 2
+
+    node.call_result = '0x' + '00' * 32
+    assert make_batch_request(web3, calls) == [
+        '0x' + (1000).to_bytes(32, 'big').hex(),  # from the cache
+        node.call_result,
+        '0x',
+    ]
+    assert num_calls(node) == 3
+
+    # No request at all if everything is cached
+    num_requests = len(node.requests)
+    assert make_batch_request(web3, calls[:1]) == ['0x' + (1000).to_bytes(32, 'big').hex()]
+    assert len(node.requests) == num_requests
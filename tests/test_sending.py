@@ -0,0 +1,53 @@
+import click
+import pytest
+from eth_account import Account
+
+from sovryn_airdrop import sending
+from sovryn_airdrop.sending import get_rewarder_accounts
+
+ACCOUNTS = [Account.from_key('0x' + f'{i:02x}' * 32) for i in range(1, 4)]
+ADDRESSES = [account.address for account in ACCOUNTS]
+
+
+@pytest.fixture
+def prompts(monkeypatch):
+    """Answers the private key prompts with the keys of ACCOUNTS, and records the prompted addresses"""
+    prompted = []
+    keys = {account.address: account.key.hex() for account in ACCOUNTS}
+
+    def prompt(text, hide_input):
+        assert hide_input
+        address = next(a for a in keys if a in text)
+        prompted.append(address)
+        return keys[address]
+    monkeypatch.setattr(sending.click, 'prompt', prompt)
+    monkeypatch.delenv('REWARDER_PRIVATE_KEY', raising=False)
+    return prompted
+
+
+def test_prompts_for_every_account_by_default(prompts):
+    accounts = get_rewarder_accounts(ADDRESSES)
+    assert list(accounts) == ADDRESSES
+    assert prompts == ADDRESSES
+
+
+def test_prompts_only_for_required_accounts(prompts):
+    accounts = get_rewarder_accounts(ADDRESSES, required_addresses=[ADDRESSES[2]])
+    assert list(accounts) == [ADDRESSES[2]]
+    assert prompts == [ADDRESSES[2]]
+    assert get_rewarder_accounts(ADDRESSES, required_addresses=[]) == {}
+    assert prompts == [ADDRESSES[2]]
+
+
+def test_keys_from_the_environment(prompts, monkeypatch):
+    # Keys of accounts that have nothing to send are fine too
+    monkeypatch.setenv('REWARDER_PRIVATE_KEY', f'{ACCOUNTS[0].key.hex()}, {ACCOUNTS[1].key.hex()}')
+    accounts = get_rewarder_accounts(ADDRESSES, required_addresses=ADDRESSES[1:])
+    assert list(accounts) == ADDRESSES[1:]
+    assert prompts == [ADDRESSES[2]]
+
+
+def test_keys_of_other_accounts_are_rejected(prompts, monkeypatch):
+    monkeypatch.setenv('REWARDER_PRIVATE_KEY', ACCOUNTS[2].key.hex())
+    with pytest.raises(click.Abort):
+        get_rewarder_accounts(ADDRESSES[:2], required_addresses=ADDRESSES[:1])
@@ -0,0 +1,114 @@
+import dataclasses
+
+import pytest
+from eth_account import Account
+from web3 import Web3
+
+from sovryn_airdrop.airdrop import AirdropBatch
+from sovryn_airdrop.signing import get_gas_price, sign_transactions
+from sovryn_airdrop.web3_utils import create_constant_gas_price_strategy
+
+from .utils import address
+
+ACCOUNT = Account.from_key('0x' + '42' * 32)
+RSK_GAS_PRICE_WEI = Web3.toWei(0.065, 'gwei')
+
+
+@pytest.fixture
+def rsk_web3(web3) -> Web3:
+    # Like get_web3 does for chain ids 30 and 31
+    web3.eth.set_gas_price_strategy(create_constant_gas_price_strategy(RSK_GAS_PRICE_WEI))
+    return web3
+
+
+@pytest.fixture
+def transaction(airdrop):
+    airdrop.add_transaction(
+        to_address=address(1),
+        reward_amount_wei=1000,
+        transaction_nonce=3,
+        rewarder_account_address=ACCOUNT.address,
+    )
+    return airdrop.transactions[0]
+
+
+def test_gas_price_from_the_rsk_strategy(rsk_web3, node):
+    assert get_gas_price(rsk_web3) == RSK_GAS_PRICE_WEI
+    assert not any(method == 'eth_gasPrice' for (method, _) in node.requests)
+
+
+def test_presign_with_the_rsk_strategy(rsk_web3, transaction):
+    signed_transactions = sign_transactions(
+        [transaction],
+        accounts={ACCOUNT.address: ACCOUNT},
+        gas_limit=100_000,
+        gas_price_wei=get_gas_price(rsk_web3),
+        chain_id=31,
+    )
+    signed = signed_transactions[ACCOUNT.address, 3]
+    assert signed.gas_price_wei == RSK_GAS_PRICE_WEI
+    assert signed.matches(transaction)
+    assert Account.recover_transaction(signed.raw_transaction) == ACCOUNT.address
+
+
+@pytest.fixture
+def batch(airdrop):
+    for i in range(3):
+        airdrop.add_transaction(
+            to_address=address(i + 1),
+            reward_amount_wei=100 * (i + 1),
+            transaction_nonce=5,
+            batch_number=1,
+            rewarder_account_address=ACCOUNT.address,
+        )
+    return AirdropBatch(airdrop=airdrop, batch_number=1, transactions=list(airdrop.transactions))
+
+
+def sign(unit, account=ACCOUNT):
+    return sign_transactions(
+        [unit],
+        accounts={unit.rewarder_account_address: account},
+        gas_limit=100_000,
+        gas_price_wei=RSK_GAS_PRICE_WEI,
+        chain_id=31,
+    )[unit.rewarder_account_address, unit.transaction_nonce]
+
+
+def test_signed_batch_with_other_recipients_does_not_match(batch):
+    signed = sign(batch)
+    assert signed.matches(batch)
+
+    # Same nonce and total amount, but the amounts go to different recipients
+    other_batch = dataclasses.replace(batch, transactions=[
+        dataclasses.replace(t, reward_amount_wei=amount)
+        for (t, amount) in zip(batch.transactions, [300, 200, 100])
+    ])
+    assert other_batch.reward_amount_wei == batch.reward_amount_wei
+    assert not sign(other_batch).matches(batch)
+    assert not signed.matches(other_batch)
+
+
+def test_signed_transaction_with_a_tampered_raw_transaction_does_not_match(transaction, batch):
+    signed = sign(transaction)
+    other = sign(dataclasses.replace(transaction, to_address=address(2)))
+    assert not dataclasses.replace(signed, raw_transaction=other.raw_transaction).matches(transaction)
+
+    # Signed by another account
+    other_account = Account.from_key('0x' + '43' * 32)
+    forged = sign(dataclasses.replace(transaction, rewarder_account_address=other_account.address), other_account)
+    assert not dataclasses.replace(signed, raw_transaction=forged.raw_transaction).matches(transaction)
+
+
+def test_existing_signed_transactions_are_only_reused_if_they_match(batch):
+    signed = sign(batch)
+    other_batch = dataclasses.replace(batch, transactions=list(reversed(batch.transactions)))
+    resigned = sign_transactions(
+        [other_batch],
+        accounts={ACCOUNT.address: ACCOUNT},
+        gas_limit=100_000,
+        gas_price_wei=RSK_GAS_PRICE_WEI,
+        chain_id=31,
+        existing={signed.key: signed},
+    )[signed.key]
+    assert resigned.transaction_hash != signed.transaction_hash
+    assert resigned.matches(other_batch)
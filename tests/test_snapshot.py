@@ -0,0 +1,104 @@
+import json
+
+import pytest
+
+from sovryn_airdrop.snapshot import HolderSnapshot, TokenHolder, token_from_json
+
+from .utils import address
+
+
+@pytest.fixture
+def snapshot(config) -> HolderSnapshot:
+    lp_token = token_from_json(
+        {'address': address(0x78), 'name': 'Pool', 'symbol': 'LP', 'decimals': 18},
+        web3=config.web3,
+        chain_id=31,
+    )
+    return HolderSnapshot(
+        chain_id=31,
+        snapshot_block_number=100,
+        first_scanned_block_number=1,
+        holding_token=config.holding_token,
+        lp_token=lp_token,
+        holding_token_reserve_balance_wei=10 ** 30,
+        lp_token_total_supply_wei=3 * 10 ** 25,
+        token_holders=[
+            TokenHolder(
+                address=address(1),
+                # More than a float can hold exactly
+                holding_token_balance_on_account_wei=2 ** 100 + 1,
+                lp_token_balance_on_account_wei=0,
+                lp_token_balance_on_liquidity_mining_wei=5,
+                holding_token_balance_on_lp_wei=7,
+            ),
+            TokenHolder(
+                address=address(2),
+                holding_token_balance_on_account_wei=1,
+                lp_token_balance_on_account_wei=2,
+                lp_token_balance_on_liquidity_mining_wei=0,
+                holding_token_balance_on_lp_wei=3,
+            ),
+        ],
+        excluded_addresses={address(3): 'is_contract', address(4): 'zero_balance'},
+        extra_tokens=[config.reward_token],
+    )
+
+
+def test_snapshot_round_trip(snapshot, config, tmp_path):
+    snapshot_file = str(tmp_path / 'snapshot.json')
+    snapshot.to_file(snapshot_file)
+    loaded = HolderSnapshot.from_file(snapshot_file, web3=config.web3)
+
+    assert loaded.chain_id == 31
+    assert loaded.snapshot_block_number == 100
+    assert loaded.first_scanned_block_number == 1
+    assert loaded.holding_token_reserve_balance_wei == snapshot.holding_token_reserve_balance_wei
+    assert loaded.lp_token_total_supply_wei == snapshot.lp_token_total_supply_wei
+    assert loaded.token_holders == snapshot.token_holders
+    assert loaded.excluded_addresses == snapshot.excluded_addresses
+    for (loaded_token, token) in zip(loaded.tokens, snapshot.tokens):
+        assert (loaded_token.address, loaded_token.name, loaded_token.symbol, loaded_token.decimals) == (
+            token.address,
+            token.name,
+            token.symbol,
+            token.decimals,
+        )
+        assert loaded_token.chain_id == 31
+        assert loaded_token.contract.address == token.address
+    assert [token.symbol for token in loaded.tokens] == ['HLD', 'LP', 'RWD']
+    assert loaded.extra_tokens[0].symbol == 'RWD'
+
+    # Writing the loaded snapshot gives the same file
+    other_snapshot_file = str(tmp_path / 'snapshot2.json')
+    loaded.to_file(other_snapshot_file)
+    with open(snapshot_file) as f, open(other_snapshot_file) as f2:
+        assert f.read() == f2.read()
+
+
+def test_snapshot_stores_large_numbers_as_strings(snapshot, tmp_path):
+    snapshot_file = str(tmp_path / 'snapshot.json')
+    snapshot.to_file(snapshot_file)
+    with open(snapshot_file) as f:
+        data = json.load(f)
+    assert data['tokenHolders'][0]['holdingTokenBalanceOnAccountWei'] == str(2 ** 100 + 1)
+    assert data['holdingTokenReserveBalanceWei'] == str(10 ** 30)
+
+
+def test_snapshot_loads_without_web3(snapshot, tmp_path):
+    snapshot_file = str(tmp_path / 'snapshot.json')
+    snapshot.to_file(snapshot_file)
+    loaded = HolderSnapshot.from_file(snapshot_file)
+    assert loaded.holding_token.symbol == 'HLD'
+    assert loaded.token_holders == snapshot.token_holders
+
+
+def test_unsupported_snapshot_version(snapshot, tmp_path):
+    snapshot_file = str(tmp_path / 'snapshot.json')
+    snapshot.to_file(snapshot_file)
+    with open(snapshot_file) as f:
+        data = json.load(f)
+    data['version'] = 999
+    with open(snapshot_file, 'w') as f:
+        json.dump(data, f)
+    with pytest.raises(ValueError, match='Unsupported snapshot version'):
+        HolderSnapshot.from_file(snapshot_file)
@@ -0,0 +1,134 @@
+import dataclasses
+import time
+
+import pytest
+import requests
+
+from sovryn_airdrop import web3_utils
+
+from sovryn_airdrop.web3_utils import (
+    QUEUED_BATCHES_PER_WORKER,
+    TOO_LARGE_RECOVERY_SUCCESSES,
+    AdaptiveBatchSize,
+    is_block_range_too_large_error,
+    iter_event_log_batches,
+)
+
+from .utils import REWARDER_ACCOUNT_ADDRESS, address
+
+
+def test_block_range_too_large_errors():
+    assert is_block_range_too_large_error(ValueError({'code': -32005, 'message': 'block range too large'}))
+    assert is_block_range_too_large_error(ValueError({'code': -32000, 'message': 'query timeout exceeded'}))
+    assert not is_block_range_too_large_error(ValueError({'code': -32005, 'message': 'rate limit exceeded'}))
+    assert not is_block_range_too_large_error(requests.exceptions.ReadTimeout())
+
+
+def test_adaptive_batch_size_grows_back_after_too_large():
+    adaptive = AdaptiveBatchSize(batch_size=1000)
+    adaptive.on_too_large()
+    assert adaptive.batch_size == 500
+    assert adaptive.max_batch_size == 100_000
+
+    for _ in range(TOO_LARGE_RECOVERY_SUCCESSES - 1):
+        adaptive.on_success(num_events=0, duration=0.1)
+    assert adaptive.batch_size == 500
+    adaptive.on_success(num_events=0, duration=0.1)
+    assert adaptive.batch_size == 1000
+    adaptive.on_success(num_events=0, duration=0.1)
+    assert adaptive.batch_size == 2000
+
+    # Shards start from the configured limits, not from what another shard ran into
+    adaptive.on_too_large()
+    shard = dataclasses.replace(adaptive)
+    assert shard.current_max_batch_size == 100_000
+    assert adaptive.current_max_batch_size == 1000
+
+
+@pytest.fixture
+def no_retries(monkeypatch):
+    def exponential_sleep(attempt, max_sleep_time=16.0):
+        raise AssertionError('retried instead of shrinking the block range')
+    monkeypatch.setattr(web3_utils, 'exponential_sleep', exponential_sleep)
+
+
+@pytest.mark.parametrize('log_range_times_out', [False, True])
+def test_adaptive_scan_fetches_all_logs_when_the_node_limits_the_range(node, config, no_retries, log_range_times_out):
+    node.max_log_block_range = 100
+    node.log_range_times_out = log_range_times_out
+    node.head_block = 2000
+    for block_number in range(0, 2000, 7):
+        node.add_transfer_log(
+            from_address=REWARDER_ACCOUNT_ADDRESS,
+            to_address=address(block_number + 1),
+            value=1,
+            transaction_hash='0x' + block_number.to_bytes(32, 'big').hex(),
+            block_number=block_number,
+        )
+    transfer_event = config.reward_token.contract.events.Transfer()
+    batches = list(iter_event_log_batches(
+        event=transfer_event,
+        from_block=0,
+        to_block=1999,
+        batch_size=10,
+        adaptive=True,
+    ))
+    assert sum(len(batch.logs) for batch in batches) == len(node.logs)
+    assert [(batch.from_block, batch.to_block) for batch in batches] == [
+        (batches[i - 1].to_block + 1 if i else 0, batch.to_block) for i, batch in enumerate(batches)
+    ]
+    assert batches[-1].to_block == 1999
+    assert max(batch.to_block - batch.from_block + 1 for batch in batches) <= 100
+    # Ranges that were too large were tried again after enough successes
+    num_requests = sum(1 for (method, _) in node.requests if method == 'eth_getLogs')
+    assert num_requests - len(batches) > 1
+
+
+@pytest.fixture
+def transfer_logs(node):
+    node.head_block = 2000
+    for block_number in range(0, 2000, 3):
+        node.add_transfer_log(
+            from_address=REWARDER_ACCOUNT_ADDRESS,
+            to_address=address(block_number + 1),
+            value=1,
+            transaction_hash='0x' + block_number.to_bytes(32, 'big').hex(),
+            block_number=block_number,
+        )
+    return node.logs
+
+
+def test_sharded_scan_fetches_all_logs(config, transfer_logs):
+    batches = list(iter_event_log_batches(
+        event=config.reward_token.contract.events.Transfer(),
+        from_block=0,
+        to_block=1999,
+        batch_size=10,
+        concurrency=3,
+    ))
+    assert sorted(log['blockNumber'] for batch in batches for log in batch.logs) == list(range(0, 2000, 3))
+
+
+def test_sharded_scan_waits_for_the_consumer(config, node, transfer_logs):
+    concurrency = 3
+    batches = iter_event_log_batches(
+        event=config.reward_token.contract.events.Transfer(),
+        from_block=0,
+        to_block=1999,
+        batch_size=10,
+        concurrency=concurrency,
+    )
+    next(batches)
+    # Give the workers time to fetch everything they would without waiting
+    time.sleep(0.3)
+    num_requests = sum(1 for (method, _) in node.requests if method == 'eth_getLogs')
+    # The consumed batch, the full queue and a batch waiting in each worker
+    assert num_requests <= 1 + concurrency * QUEUED_BATCHES_PER_WORKER + concurrency
+
+    # Stopping early doesn't leave the workers stuck on the full queue
+    start = time.monotonic()
+    batches.close()
+    assert time.monotonic() - start < 2
+    num_requests = sum(1 for (method, _) in node.requests if method == 'eth_getLogs')
+    time.sleep(0.3)
+    assert sum(1 for (method, _) in node.requests if method == 'eth_getLogs') == num_requests
@@ -0,0 +1,146 @@
+"""Constants and helpers shared by the tests"""
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+from eth_utils import to_checksum_address, to_hex
+from web3 import Web3
+from web3.providers.base import BaseProvider
+
+from sovryn_airdrop.web3_utils import address_to_topic
+
+REWARD_TOKEN_ADDRESS = '0x2e6B1d146064613E8f521Eb3c6e65070af964EbB'
+HOLDING_TOKEN_ADDRESS = to_checksum_address('0x' + '12' * 20)
+REWARDER_ACCOUNT_ADDRESS = to_checksum_address('0xf00f00f00f00f00f00f00f00f00f00f00f001337')
+OTHER_REWARDER_ACCOUNT_ADDRESS = to_checksum_address('0xf00f00f00f00f00f00f00f00f00f00f00f001338')
+DISPERSE_ADDRESS = to_checksum_address('0x' + 'd1' * 20)
+TRANSFER_TOPIC = Web3.keccak(text='Transfer(address,address,uint256)')
+
+
+def address(n: int) -> str:
+    """A checksummed address made of n, for recipients"""
+    return to_checksum_address('0x' + n.to_bytes(20, 'big').hex())
+
+
+class FakeNodeProvider(BaseProvider):
+    """
+    Answers the requests that confirming and auditing make from a list of raw Transfer logs, like a node would.
+    eth_call returns call_result for any call, unless a response is queued for its call data in queued_call_responses,
+    and eth_getCode the code set in codes. Anything else fails.
+    """
+    def __init__(
+        self,
+        *,
+        head_block: int = 100,
+        nonces: Optional[Dict[str, int]] = None,
+        max_log_block_range: Optional[int] = None,
+        log_range_times_out: bool = False,
+    ):
+        super().__init__()
+        self.head_block = head_block
+        # eth_getLogs for more blocks is rejected with an error, or times out if log_range_times_out is set
+        self.max_log_block_range = max_log_block_range
+        self.log_range_times_out = log_range_times_out
+        self.nonces = {address.lower(): nonce for (address, nonce) in (nonces or {}).items()}
+        self.logs: List[Dict[str, Any]] = []
+        self.requests: List[Tuple[str, Any]] = []
+        self.call_result = '0x' + (1000).to_bytes(32, 'big').hex()
+        # {call data: [response, ...]}, each response ({'result': ...} or {'error': ...}) is used once
+        self.queued_call_responses: Dict[str, List[Dict[str, Any]]] = {}
+        self.codes: Dict[str, str] = {}
+
+    def add_transfer_log(
+        self,
+        *,
+        from_address: str,
+        to_address: str,
+        value: int,
+        transaction_hash: str,
+        block_number: int,
+        log_index: int = 0,
+        token_address: str = REWARD_TOKEN_ADDRESS,
+    ):
+        self.logs.append({
+            'address': token_address.lower(),
+            'topics': [to_hex(TRANSFER_TOPIC), address_to_topic(from_address), address_to_topic(to_address)],
+            'data': '0x' + value.to_bytes(32, 'big').hex(),
+            'blockNumber': hex(block_number),
+            'blockHash': '0x' + block_number.to_bytes(32, 'big').hex(),
+            'transactionHash': transaction_hash,
+            'transactionIndex': '0x0',
+            'logIndex': hex(log_index),
+            'removed': False,
+        })
+
+    def make_request(self, method, params):
+        self.requests.append((method, params))
+        if method == 'eth_chainId':
+            result = '0x1f'
+        elif method == 'eth_blockNumber':
+            result = hex(self.head_block)
+        elif method == 'eth_getTransactionCount':
+            result = hex(self.nonces.get(params[0].lower(), 0))
+        elif method == 'eth_getTransactionReceipt':
+            result = None
+        elif method == 'eth_call':
+            queued = self.queued_call_responses.get(params[0]['data'])
+            if queued:
+                return {'jsonrpc': '2.0', 'id': 1, **queued.pop(0)}
+            result = self.call_result
+        elif method == 'eth_getCode':
+            result = self.codes.get(params[0].lower(), '0x')
+        elif method == 'eth_getLogs':
+            log_filter = params[0]
+            num_blocks = int(log_filter['toBlock'], 16) - int(log_filter['fromBlock'], 16) + 1
+            if self.max_log_block_range is not None and num_blocks > self.max_log_block_range:
+                if self.log_range_times_out:
+                    raise requests.exceptions.ReadTimeout('Read timed out')
+                return {'jsonrpc': '2.0', 'id': 1, 'error': {'code': -32005, 'message': 'block range too large'}}
+            result = [log for log in self.logs if self._matches(log, log_filter)]
+        else:
+            raise NotImplementedError(method)
+        return {'jsonrpc': '2.0', 'id': 1, 'result': result}
+
+    def _matches(self, log: Dict[str, Any], log_filter: Dict[str, Any]) -> bool:
+        if not int(log_filter['fromBlock'], 16) <= int(log['blockNumber'], 16) <= int(log_filter['toBlock'], 16):
+            return False
+        addresses = log_filter['address'] if isinstance(log_filter['address'], list) else [log_filter['address']]
+        if log['address'] not in [a.lower() for a in addresses]:
+            return False
+        for topic, wanted in zip(log['topics'], log_filter.get('topics', [])):
+            if wanted is None:
+                continue
+            wanted = wanted if isinstance(wanted, list) else [wanted]
+            if topic.lower() not in [w.lower() for w in wanted]:
+                return False
+        return True
+
+
+class FakeSession:
+    """
+    Stands in for the requests.Session of PooledHTTPProvider. The JSON-RPC requests (and batches) POSTed to a URI are
+    answered by its FakeNodeProvider, unless the URI is in failing_uris.
+    """
+    def __init__(self, nodes: Dict[str, FakeNodeProvider]):
+        self.nodes = nodes
+        self.failing_uris = set()
+        self.posted_uris: List[str] = []
+
+    def post(self, uri: str, *, data: bytes, headers: Dict[str, str], timeout: float) -> requests.Response:
+        self.posted_uris.append(uri)
+        if uri in self.failing_uris:
+            raise requests.exceptions.ConnectionError(f'{uri} is down')
+        request = json.loads(data)
+        if isinstance(request, list):
+            response_data = [self._answer(uri, r) for r in request]
+        else:
+            response_data = self._answer(uri, request)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps(response_data).encode('utf-8')
+        return response
+
+    def _answer(self, uri: str, request: Dict[str, Any]) -> Dict[str, Any]:
+        response = dict(self.nodes[uri].make_request(request['method'], request['params']))
+        response['id'] = request['id']
+        return response